@@ -0,0 +1,90 @@
+"""
+Benchmark: compressing one large fragment serially and in parallel blocks.
+
+Writes a `--size` MB file of partly compressible data, then compresses it with
+`gzip_chunks` twice: as a single gzip stream, and split into `--block` MB blocks
+compressed by a pool of threads. Reports the time, throughput and compressed size
+of each, and checks that both decompress to the original data.
+
+Usage:
+    python benchmarks/bench_compress.py [--size 512] [--block 8]
+"""
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+import zlib
+
+from quilt.tools import data_transfer
+
+
+def make_file(path, size):
+    # Half random, half repetitive, so it compresses somewhat.
+    block = os.urandom(512 * 1024)
+    block += block[:1024] * 512
+    with open(path, 'wb') as fd:
+        for _ in range(size // len(block)):
+            fd.write(block)
+        fd.write(block[:size % len(block)])
+
+
+def compress(path, parallel):
+    """
+    Returns the time it took to compress the file, the compressed size and the hash of the decompressed data.
+    """
+    data_transfer.PARALLEL_COMPRESSION_THRESHOLD = 0 if parallel else float('inf')
+    decompressor = zlib.decompressobj(data_transfer.GZIP_WBITS)
+    digest = hashlib.sha256()
+    compressed_size = 0
+    elapsed = 0
+
+    with open(path, 'rb') as fd:
+        chunks = data_transfer.gzip_chunks(fd)
+        while True:
+            start = time.time()
+            chunk = next(chunks, None)
+            elapsed += time.time() - start
+            if chunk is None:
+                break
+            compressed_size += len(chunk)
+
+            # Check the result; this isn't timed.
+            while chunk:
+                digest.update(decompressor.decompress(chunk))
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = zlib.decompressobj(data_transfer.GZIP_WBITS)
+
+    return elapsed, compressed_size, digest.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=512, help="MB")
+    parser.add_argument('--block', type=int, default=8, help="MB")
+    args = parser.parse_args()
+
+    data_transfer.COMPRESSION_BLOCK_SIZE = args.block * 1024 * 1024
+    size = args.size * 1024 * 1024
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        make_file(path, size)
+        with open(path, 'rb') as input_file:
+            expected = hashlib.sha256(input_file.read()).hexdigest()
+
+        print("%-10s %10s %12s %12s" % ('mode', 'time', 'throughput', 'compressed'))
+        for name, parallel in [('serial', False), ('parallel', True)]:
+            elapsed, compressed_size, digest = compress(path, parallel)
+            assert digest == expected, "%s compression is corrupt" % name
+            print("%-10s %9.2fs %7.1f MB/s %9.1f MB" % (
+                name, elapsed, args.size / elapsed, compressed_size / (1024.0 * 1024.0)
+            ))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark: downloading a single large fragment, in one stream vs. in parallel ranges.
+
+Serves a gzip'ed object of `--size` MB from a local HTTP server that supports
+range requests and limits each connection to `--bandwidth` MB/s (to simulate
+per-connection throughput limits of remote storage), then downloads it into a
+temporary store with `download_fragments`, with and without ranged downloads.
+
+Usage:
+    python benchmarks/bench_download.py [--size 256] [--bandwidth 20] [--part-size 16]
+"""
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+from quilt.tools import data_transfer
+from quilt.tools.const import PACKAGE_DIR_NAME
+from quilt.tools.store import PackageStore
+from quilt.tools.util import gzip_compress
+
+RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+def make_handler(body, bandwidth):
+    class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            match = RANGE_RE.match(self.headers.get('Range', ''))
+            start = int(match.group(1)) if match else 0
+            end = int(match.group(2)) if match and match.group(2) else len(body) - 1
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(body))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            end = min(end, len(body) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(body)))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+
+            chunk_size = 64 * 1024
+            for pos in range(start, end + 1, chunk_size):
+                chunk = body[pos:min(pos + chunk_size, end + 1)]
+                self.wfile.write(chunk)
+                time.sleep(len(chunk) / bandwidth)
+
+        def log_message(self, *args):
+            pass
+
+    return RangeHandler
+
+
+class ThreadedHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def make_data(size):
+    # Half random, half repetitive, so it compresses somewhat.
+    data = os.urandom(size // 2)
+    return data + data[:1024] * ((size - len(data)) // 1024 + 1)
+
+
+def bench(data, url, ranged):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = PackageStore(os.path.join(tmpdir, PACKAGE_DIR_NAME))
+        store.create_dirs()
+        obj_hash = hashlib.sha256(data).hexdigest()
+        threshold = data_transfer.RANGE_DOWNLOAD_THRESHOLD
+        if not ranged:
+            data_transfer.RANGE_DOWNLOAD_THRESHOLD = len(data) + 1
+        try:
+            start = time.time()
+            assert data_transfer.download_fragments(store, {obj_hash: url}, {obj_hash: len(data)})
+            return time.time() - start
+        finally:
+            data_transfer.RANGE_DOWNLOAD_THRESHOLD = threshold
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=256, help="Object size, in MB")
+    parser.add_argument('--bandwidth', type=float, default=20, help="Per-connection limit, in MB/s")
+    parser.add_argument('--part-size', type=int, default=16, help="Range size, in MB")
+    args = parser.parse_args()
+
+    data = make_data(args.size * 1024 * 1024)
+    body = gzip_compress(data)
+    server = ThreadedHTTPServer(('127.0.0.1', 0), make_handler(body, args.bandwidth * 1024 * 1024))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d/object' % server.server_address[1]
+
+    data_transfer.RANGE_PART_SIZE = args.part_size * 1024 * 1024
+    data_transfer.RANGE_DOWNLOAD_THRESHOLD = data_transfer.RANGE_PART_SIZE
+
+    results = [(name, bench(data, url, ranged)) for name, ranged in [('single', False), ('ranged', True)]]
+    server.shutdown()
+
+    print("%-8s %10s %12s" % ('mode', 'time', 'throughput'))
+    for name, elapsed in results:
+        print("%-8s %9.2fs %8.1f MB/s" % (name, elapsed, args.size / elapsed))
+
+
+if __name__ == '__main__':
+    main()
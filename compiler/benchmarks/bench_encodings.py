@@ -0,0 +1,109 @@
+"""
+Benchmark: gzip vs. zstd on CSV and Parquet fragments.
+
+Compresses and decompresses each fragment with gzip (at the level used for uploads)
+and zstd (at its default level, if `zstandard` is installed), and reports the
+compression ratio and the throughput of each. Without arguments, it generates a
+`--rows` row table and uses it as CSV and as Parquet (what `quilt build` stores).
+
+Usage:
+    python benchmarks/bench_encodings.py [--rows 1000000] [FRAGMENT ...]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from quilt.tools import data_transfer
+from quilt.tools.util import have_zstd
+
+
+def make_fragments(tmpdir, rows):
+    """
+    Returns the paths of a CSV file and of a Parquet file with the same table.
+    """
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame(dict(
+        id=np.arange(rows),
+        value=rng.normal(size=rows),
+        count=rng.randint(0, 1000, size=rows),
+        category=rng.choice(['alpha', 'beta', 'gamma', 'delta'], size=rows),
+        date=pd.date_range('2000-01-01', periods=rows, freq='min'),
+    ))
+    csv_path = os.path.join(tmpdir, 'table.csv')
+    df.to_csv(csv_path, index=False)
+    parquet_path = os.path.join(tmpdir, 'table.parquet')
+    df.to_parquet(parquet_path, engine='pyarrow')
+    return [csv_path, parquet_path]
+
+
+def gzip_codec():
+    def compress(data):
+        compressor = zlib.compressobj(data_transfer.ZLIB_LEVEL, zlib.DEFLATED, data_transfer.GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(data):
+        return zlib.decompress(data, data_transfer.GZIP_WBITS)
+
+    return compress, decompress
+
+
+def zstd_codec():
+    import zstandard
+
+    def compress(data):
+        return zstandard.ZstdCompressor().compress(data)
+
+    def decompress(data):
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    return compress, decompress
+
+
+def timed(func, data):
+    start = time.time()
+    result = func(data)
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('fragments', nargs='*')
+    args = parser.parse_args()
+
+    codecs = [('gzip', gzip_codec())]
+    if have_zstd():
+        codecs.append(('zstd', zstd_codec()))
+    else:
+        print("zstandard is not installed; only measuring gzip.")
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = args.fragments or make_fragments(tmpdir, args.rows)
+
+        print("%-16s %-6s %10s %8s %14s %16s" % (
+            'fragment', 'codec', 'size', 'ratio', 'compression', 'decompression'))
+        for path in paths:
+            with open(path, 'rb') as fd:
+                data = fd.read()
+            size_mb = len(data) / (1024.0 * 1024.0)
+            for name, (compress, decompress) in codecs:
+                compressed, compress_time = timed(compress, data)
+                decompressed, decompress_time = timed(decompress, compressed)
+                assert decompressed == data, "%s round trip failed" % name
+                print("%-16s %-6s %8.1fMB %7.2fx %9.1f MB/s %11.1f MB/s" % (
+                    os.path.basename(path)[:16], name, size_mb, len(data) / float(len(compressed)),
+                    size_mb / compress_time, size_mb / decompress_time
+                ))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark: import time and memory use for a large synthetic package.
+
+Builds a package with `--nodes` file nodes spread over groups of `--fanout`
+children (the objects themselves aren't created), then imports it in a fresh
+interpreter and reports the time and peak RSS of the import, with and without
+touching every node.
+
+Usage:
+    python benchmarks/bench_import.py [--nodes 1000000] [--fanout 1000]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from quilt.tools.const import PACKAGE_DIR_NAME
+from quilt.tools.core import FileNode, GroupNode, RootNode
+from quilt.tools.store import PackageStore
+
+USER = 'bench'
+PACKAGE = 'synthetic'
+
+CHILD_CODE = """
+import json, resource, sys, time
+import quilt
+rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.time()
+from quilt.data.bench import synthetic as pkg
+if sys.argv[1] == 'touch':
+    def walk(node):
+        for _, child in node._items():
+            if hasattr(child, '_items'):
+                walk(child)
+    walk(pkg)
+else:
+    pkg.g0.n0
+elapsed = time.time() - start
+rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps(dict(seconds=elapsed, rss_kb=rss_after - rss_before, keys=len(pkg._keys()))))
+"""
+
+
+def make_package(store_dir, nodes, fanout):
+    store = PackageStore(store_dir)
+    groups = {}
+    for i in range(nodes):
+        group = groups.get('g%d' % (i // fanout))
+        if group is None:
+            group = groups['g%d' % (i // fanout)] = GroupNode({})
+        group.children['n%d' % (i % fanout)] = FileNode(
+            hashes=['%064x' % i],
+            metadata=dict(q_ext='', q_path='n%d.bin' % i, q_target='file')
+        )
+    package = store.install_package(None, USER, PACKAGE, RootNode(groups))
+    start = time.time()
+    package.save_contents()
+    return time.time() - start
+
+
+def measure(store_dir, mode):
+    env = dict(os.environ, QUILT_PRIMARY_PACKAGE_DIR=store_dir)
+    output = subprocess.check_output([sys.executable, '-c', CHILD_CODE, mode], env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=1000000)
+    parser.add_argument('--fanout', type=int, default=1000)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store_dir = os.path.join(tmpdir, PACKAGE_DIR_NAME)
+        save_time = make_package(store_dir, args.nodes, args.fanout)
+        print("Synthetic package: %d nodes, %d per group (saved in %.2fs)" % (
+            args.nodes, args.fanout, save_time))
+        for mode, description in [('lazy', 'import + access one node'), ('touch', 'import + access all nodes')]:
+            result = measure(store_dir, mode)
+            print("%-28s %8.2fs %10.1f MB" % (description, result['seconds'], result['rss_kb'] / 1024.0))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
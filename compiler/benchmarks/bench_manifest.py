@@ -0,0 +1,82 @@
+"""
+Benchmark: saving and loading package manifests, JSON vs. binary.
+
+For each size, builds a synthetic tree of file nodes in groups of `--fanout`
+children and reports the time to save it, to load it fully, and (binary
+only) to look up a single node, along with the size on disk.
+
+Usage:
+    python benchmarks/bench_manifest.py [--sizes 10000 100000 1000000] [--fanout 1000]
+"""
+import argparse
+import hashlib
+import io
+import json
+import time
+
+from quilt.tools import manifest
+from quilt.tools.core import FileNode, GroupNode, RootNode, decode_node, encode_node
+
+
+def make_tree(nodes, fanout):
+    groups = {}
+    for i in range(nodes):
+        name = 'g%d' % (i // fanout)
+        group = groups.get(name)
+        if group is None:
+            group = groups[name] = GroupNode({})
+        group.children['n%d' % (i % fanout)] = FileNode(
+            hashes=[hashlib.sha256(str(i).encode()).hexdigest()],
+            metadata=dict(q_ext='csv', q_path='%s/n%d.csv' % (name, i), q_target='file')
+        )
+    return RootNode(groups)
+
+
+def walk(node):
+    for child in node.children.values():
+        if isinstance(child, GroupNode):
+            walk(child)
+
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def bench_json(tree):
+    def save():
+        buf = io.StringIO()
+        json.dump(tree, buf, default=encode_node, indent=2, sort_keys=True)
+        return buf.getvalue().encode('utf-8')
+    save_time, data = timed(save)
+    load_time, _ = timed(lambda: json.loads(data.decode('utf-8'), object_hook=decode_node))
+    return save_time, load_time, None, len(data)
+
+
+def bench_binary(tree):
+    save_time, data = timed(lambda: manifest.dumps(tree))
+    load_time, _ = timed(lambda: walk(manifest.loads(data)))
+    lookup_time, _ = timed(lambda: manifest.loads(data).children['g0'].children['n0'])
+    return save_time, load_time, lookup_time, len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--fanout', type=int, default=1000)
+    args = parser.parse_args()
+
+    print("%-10s %-7s %10s %10s %10s %12s" % ('nodes', 'format', 'save', 'load', 'lookup', 'size'))
+    for nodes in args.sizes:
+        tree = make_tree(nodes, args.fanout)
+        for name, bench in [('json', bench_json), ('binary', bench_binary)]:
+            save_time, load_time, lookup_time, size = bench(tree)
+            print("%-10d %-7s %9.3fs %9.3fs %10s %9.1f MB" % (
+                nodes, name, save_time, load_time,
+                '-' if lookup_time is None else '%.4fs' % lookup_time,
+                size / 1024.0 / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark: cold start time of `import quilt` and of the CLI.
+
+Imports each module in a fresh interpreter `--runs` times and reports the
+best time. On Python 3.7+, the time comes from `python -X importtime`
+(the cumulative import time of the module); otherwise, it's the wall-clock
+time of the whole interpreter. Exits with status 1 if any of them is over
+`--budget` milliseconds, so it can be used to catch regressions, e.g. an
+expensive dependency imported at module level again.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 5] [--budget 500]
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+MODULES = ['quilt', 'quilt.tools.main']
+
+
+def import_time(module):
+    """
+    Returns the time to import `module` in a fresh interpreter, in milliseconds.
+    """
+    if sys.version_info >= (3, 7):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+                              universal_newlines=True)
+        # Lines look like "import time:  self [us] | cumulative | imported package";
+        # the last one for the module includes everything it imported.
+        for line in reversed(proc.stderr.splitlines()):
+            fields = [field.strip() for field in line.split('|')]
+            if len(fields) == 3 and fields[2] == module:
+                return int(fields[1]) / 1000.0
+        raise RuntimeError("Could not find %s in the import times" % module)
+
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', 'import ' + module])
+    return (time.time() - start) * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=500, help="Maximum time per module, in ms")
+    args = parser.parse_args()
+
+    over_budget = False
+    print("%-20s %10s" % ('module', 'time'))
+    for module in MODULES:
+        best = min(import_time(module) for _ in range(args.runs))
+        over_budget = over_budget or best > args.budget
+        print("%-20s %8.1fms%s" % (module, best, ' OVER BUDGET' if best > args.budget else ''))
+
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""
+Benchmark: uploading and downloading many small fragments, and a few large ones.
+
+Serves the fragments from a local HTTP/1.1 server (with keep-alive, and an optional
+per-request `--latency` to simulate a remote server), then runs `download_fragments`
+into an empty temporary store and `upload_fragments` from it, with `--threads` workers.
+Reports the time, throughput and requests per second of each.
+
+Usage:
+    python benchmarks/bench_transfer.py [--threads 20] [--small 2000x16] [--large 4x64] [--latency 0]
+"""
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+from quilt.tools import data_transfer
+from quilt.tools.const import PACKAGE_DIR_NAME
+from quilt.tools.store import PackageStore
+from quilt.tools.util import gzip_compress
+
+RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+def make_handler(bodies, latency):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, status, headers=(), body=b''):
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            time.sleep(latency)
+            body = bodies[self.path.split('/')[-1]]
+            match = RANGE_RE.match(self.headers.get('Range', ''))
+            start = int(match.group(1)) if match else 0
+            end = int(match.group(2)) if match and match.group(2) else len(body) - 1
+            if start >= len(body):
+                self._reply(416, [('Content-Range', 'bytes */%d' % len(body))])
+                return
+            end = min(end, len(body) - 1)
+            self._reply(206, [('Content-Range', 'bytes %d-%d/%d' % (start, end, len(body)))],
+                        body[start:end + 1])
+
+        def do_HEAD(self):
+            time.sleep(latency)
+            self._reply(404)
+
+        def do_PUT(self):
+            time.sleep(latency)
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+            self._reply(200)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class ThreadedHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def make_data(size, seed):
+    # Half random, half repetitive, so it compresses somewhat.
+    data = os.urandom(size // 2) + seed
+    return (data + data[:1024] * ((size - len(data)) // 1024 + 1))[:size]
+
+
+def bench(objects, base_url):
+    """
+    Returns the download and upload times of `objects`, a dict of hashes to data.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = PackageStore(os.path.join(tmpdir, PACKAGE_DIR_NAME))
+        store.create_dirs()
+        sizes = {obj_hash: len(data) for obj_hash, data in objects.items()}
+
+        start = time.time()
+        get_urls = {obj_hash: '%s/%s' % (base_url, obj_hash) for obj_hash in objects}
+        assert data_transfer.download_fragments(store, get_urls, sizes)
+        download_time = time.time() - start
+
+        start = time.time()
+        put_urls = {
+            obj_hash: dict(head='%s/%s' % (base_url, obj_hash), put='%s/%s' % (base_url, obj_hash))
+            for obj_hash in objects
+        }
+        assert data_transfer.upload_fragments(store, put_urls, sizes)
+        upload_time = time.time() - start
+
+        return download_time, upload_time
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def parse_workload(value):
+    count, size = value.split('x')
+    return int(count), float(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=data_transfer.PARALLEL_DOWNLOADS)
+    parser.add_argument('--small', type=parse_workload, default='2000x16', help="COUNTxKB")
+    parser.add_argument('--large', type=parse_workload, default='4x64', help="COUNTxMB")
+    parser.add_argument('--latency', type=float, default=0, help="Per-request latency, in ms")
+    args = parser.parse_args()
+
+    data_transfer.PARALLEL_DOWNLOADS = data_transfer.PARALLEL_UPLOADS = args.threads
+
+    workloads = [
+        ('small', args.small[0], int(args.small[1] * 1024)),
+        ('large', args.large[0], int(args.large[1] * 1024 * 1024)),
+    ]
+
+    results = []
+    for name, count, size in workloads:
+        objects = {}
+        for idx in range(count):
+            data = make_data(size, str(idx).encode())
+            objects[hashlib.sha256(data).hexdigest()] = data
+        bodies = {obj_hash: gzip_compress(data) for obj_hash, data in objects.items()}
+
+        server = ThreadedHTTPServer(('127.0.0.1', 0), make_handler(bodies, args.latency / 1000.0))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            download_time, upload_time = bench(objects, 'http://127.0.0.1:%d' % server.server_address[1])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        total_mb = count * size / (1024.0 * 1024.0)
+        results.append((name, 'download', count, total_mb, download_time))
+        results.append((name, 'upload', count, total_mb, upload_time))
+
+    print("%-8s %-10s %10s %12s %12s" % ('workload', 'direction', 'time', 'throughput', 'objects/s'))
+    for name, direction, count, total_mb, elapsed in results:
+        print("%-8s %-10s %9.2fs %7.1f MB/s %12.1f" % (name, direction, elapsed, total_mb / elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,10 @@ Makes functions in .tools.command accessible directly from quilt.
 # None: CLI params have not yet been parsed to determine mode.
 _DEV_MODE = None
 
+# Names of the console scripts in setup.py's entry points. They're listed here rather than
+# looked up with `pkg_resources`, which is slow to import; test_startup checks they match.
+_CONSOLE_SCRIPTS = ('quilt',)
+
 
 # Normally a try: except: block on or in main() would be better and simpler,
 # but we load a bunch of external modules that take a lot of time, during which
@@ -29,7 +33,6 @@ def _install_interrupt_handler():
     import os
     import sys
     import signal
-    import pkg_resources
     from .tools import const
 
     # Check to see what entry points / scripts are configred to run quilt from the CLI
@@ -38,9 +41,8 @@ def _install_interrupt_handler():
     #   * Avoid calling exit() when being used as an external lib
     #   * Provide exceptions when running in Jupyter/iPython/bPython
     #   * Provide exceptions when running in unexpected circumstances
-    quilt = pkg_resources.get_distribution('quilt')
     executable = os.path.basename(sys.argv[0])
-    entry_points = quilt.get_entry_map().get('console_scripts', [])
+    entry_points = set(_CONSOLE_SCRIPTS)
 
     # When python is run with '-c', this was executed via 'python -c "<some python code>"'
     if executable == '-c':
@@ -48,7 +50,7 @@ def _install_interrupt_handler():
         # executing via 'python -c'
         if len(sys.argv) > 1 and sys.argv[1] == 'quilt testing':
             # it's us.  Let's pretend '-c' is an entry point.
-            entry_points['-c'] = 'blah'
+            entry_points.add('-c')
             sys.argv.pop(1)
     if executable not in entry_points:
         return
@@ -90,6 +92,7 @@ from .tools.command import (
     config,
     create_user,
     delete_user,
+    diff,
     enable_user,
     disable_user,
     export,
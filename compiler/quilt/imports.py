@@ -13,10 +13,7 @@ import imp
 import os.path
 import sys
 
-from six import iteritems
-
-from .nodes import DataNode, GroupNode, PackageNode
-from .tools import core
+from .nodes import _from_core_node
 from .tools.store import PackageStore
 
 
@@ -39,24 +36,6 @@ class FakeLoader(object):
         return mod
 
 
-def _from_core_node(package, core_node):
-    if isinstance(core_node, core.TableNode) or isinstance(core_node, core.FileNode):
-        node = DataNode(package, core_node)
-    else:
-        if isinstance(core_node, core.RootNode):
-            node = PackageNode(package, core_node)
-        elif isinstance(core_node, core.GroupNode):
-            node = GroupNode(package, core_node)
-        else:
-            assert "Unexpected node: %r" % core_node
-
-        for name, core_child in iteritems(core_node.children):
-            child = _from_core_node(package, core_child)
-            setattr(node, name, child)
-
-    return node
-
-
 class PackageLoader(object):
     """
     Module loader for Quilt tables.
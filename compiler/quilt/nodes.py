@@ -3,8 +3,7 @@ Nodes that represent the data in a Quilt package.
 """
 import os
 
-import pandas as pd
-from six import iteritems, string_types
+from six import string_types
 
 from .tools import core
 from .tools.const import PRETTY_MAX_LEN
@@ -40,17 +39,28 @@ class DataNode(Node):
         super(DataNode, self).__init__()
         self._package = package
         self._node = node
+        self._parent = None  # The parent's core group, if the node came from a package.
         self.__cached_data = data
 
     def __call__(self):
         return self._data()
 
+    def _is_unmodified(self):
+        """
+        Returns True if the node's data is what's stored under its hashes, i.e. the node came
+        from a package, and its dataframe (which could be modified in place) was never loaded.
+        """
+        if not self._node.hashes:
+            return False
+        return isinstance(self._node, core.FileNode) or self.__cached_data is None
+
     def _data(self):
         """
         Returns the contents of the node: a dataframe or a file path.
         """
         if self.__cached_data is None:
             # TODO(dima): Temporary code.
+            self._package.fetch_fragments(self._node, self._parent)
             store = self._package.get_store()
             if isinstance(self._node, core.TableNode):
                 self.__cached_data = store.load_dataframe(self._node.hashes)
@@ -67,7 +77,41 @@ class GroupNode(DataNode):
     Represents a group in a package. Allows accessing child objects using the dot notation.
     Warning: calling _data() on a large dataset may exceed local memory capacity in Python (Only
     supported for Parquet packages).
+
+    Children are only turned into nodes when they're first accessed; until then,
+    they're looked up in the core node.
     """
+    def __init__(self, package, node, data=None):
+        super(GroupNode, self).__init__(package, node, data)
+        # Core children that haven't been deleted, whether or not they've been accessed.
+        # Shared with the core node until a child gets deleted.
+        self._core_children = node.children if isinstance(node, core.GroupNode) else {}
+
+    def __getattr__(self, name):
+        # Only called when the attribute isn't found the normal way,
+        # i.e. for children that haven't been accessed yet.
+        if not name.startswith('_'):
+            core_child = self._core_children.get(name)
+            if core_child is not None:
+                child = _from_core_node(self._package, core_child)
+                child._parent = self._node
+                setattr(self, name, child)
+                return child
+        raise AttributeError("{cls!r} object has no attribute {name!r}".format(
+            cls=self.__class__.__name__, name=name))
+
+    def __delattr__(self, name):
+        if not name.startswith('_') and name in self._core_children:
+            core_children = dict(self._core_children)
+            del core_children[name]
+            self._core_children = core_children
+            if name in self.__dict__:
+                super(GroupNode, self).__delattr__(name)
+        else:
+            super(GroupNode, self).__delattr__(name)
+
+    def __dir__(self):
+        return sorted(set(dir(self.__class__)) | set(self.__dict__) | set(self._keys()))
 
     def __repr__(self):
         pinfo = super(GroupNode, self).__repr__()
@@ -86,26 +130,34 @@ class GroupNode(DataNode):
         return '%s\n%s' % (pinfo, data_info)
 
     def _items(self):
-        return ((name, child) for name, child in iteritems(self.__dict__)
-                if not name.startswith('_'))
+        return ((name, getattr(self, name)) for name in self._keys())
+
+    def _is_group(self, name):
+        child = self.__dict__.get(name)
+        if child is None:
+            return isinstance(self._core_children[name], core.GroupNode)
+        return isinstance(child, GroupNode)
 
     def _data_keys(self):
         """
         every child key referencing a dataframe
         """
-        return [name for name, child in self._items() if not isinstance(child, GroupNode)]
+        return [name for name in self._keys() if not self._is_group(name)]
 
     def _group_keys(self):
         """
         every child key referencing a group that is not a dataframe
         """
-        return [name for name, child in self._items() if isinstance(child, GroupNode)]
+        return [name for name in self._keys() if self._is_group(name)]
 
     def _keys(self):
         """
         keys directly accessible on this object via getattr or .
         """
-        return [name for name in self.__dict__ if not name.startswith('_')]
+        keys = list(self._core_children)
+        keys.extend(name for name in self.__dict__
+                    if not name.startswith('_') and name not in self._core_children)
+        return keys
 
     def _add_group(self, groupname):
         child = GroupNode(self._package, core.GroupNode({}))
@@ -140,6 +192,8 @@ class PackageNode(GroupNode):
         :param value:  Pandas dataframe, or a filename relative to build_dir
         :param build_dir:  Directory containing `value` if value is a filename.
         """
+        import pandas as pd
+
         assert isinstance(path, list) and len(path) > 0
 
         if isinstance(value, pd.DataFrame):
@@ -178,3 +232,17 @@ class PackageNode(GroupNode):
         key = path[-1]
         data_node = DataNode(self._package, core_node, value)
         setattr(node, key, data_node)
+
+
+def _from_core_node(package, core_node):
+    """
+    Returns the node for a core node. Children of groups are created as they're accessed.
+    """
+    if isinstance(core_node, (core.TableNode, core.FileNode)):
+        return DataNode(package, core_node)
+    elif isinstance(core_node, core.RootNode):
+        return PackageNode(package, core_node)
+    elif isinstance(core_node, core.GroupNode):
+        return GroupNode(package, core_node)
+    else:
+        assert False, "Unexpected node: %r" % core_node
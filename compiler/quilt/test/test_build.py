@@ -572,4 +572,118 @@ class BuildTest(QuiltTestCase):
         pkg = command.load('test/fromparquet')
         assert df.equals(pkg.df()) # pylint:disable=E1101
 
+    def test_build_plan(self):
+        mydir = os.path.dirname(__file__)
+        with open(os.path.join(mydir, 'data', 'foo.csv')) as fd:
+            csv = fd.read()
+        for name in ['one.csv', 'two.csv']:
+            with open(name, 'w') as fd:
+                fd.write(csv)
+        with open('notes.txt', 'w') as fd:
+            fd.write('notes')
+
+        build_contents = {
+            'contents': {
+                'one': {'file': 'one.csv'},
+                'two': {'file': 'two.csv'},
+                'group': {
+                    'notes': {'file': 'notes.txt'}
+                }
+            }
+        }
+
+        plan = build.plan_package_from_contents(None, 'test', 'planned', '.', build_contents)
+        assert plan.count(build.PlanAction.NEW) == 3
+        assert plan.parse_size == 2 * len(csv)
+        assert plan.write_size == 2 * len(csv) + len('notes')
+
+        build.build_package_from_contents(None, 'test', 'planned', '.', build_contents, plan=True)
+
+        plan = build.plan_package_from_contents(None, 'test', 'planned', '.', build_contents)
+        assert plan.count(build.PlanAction.UNCHANGED) == 3
+        assert plan.parse_size == 0
+        assert plan.write_size == 0
+
+        # Change one source, replace another node and drop a group
+        with open('two.csv', 'a') as fd:
+            fd.write(csv.splitlines()[-1] + '\n')
+        new_contents = {
+            'contents': {
+                'one': {'file': 'one.csv'},
+                'two': {'file': 'two.csv'},
+                'three': {'file': 'notes.txt'},
+            }
+        }
+        plan = build.plan_package_from_contents(None, 'test', 'planned', '.', new_contents)
+        actions = {'/'.join(entry.node_path): entry.action for entry in plan.entries}
+        assert actions == {
+            'one': build.PlanAction.UNCHANGED,
+            'two': build.PlanAction.CHANGED,
+            'three': build.PlanAction.NEW,
+            'group/notes': build.PlanAction.REMOVED,
+        }
+        # notes.txt is already in the store, so only two.csv needs work
+        assert plan.parse_size == os.path.getsize('two.csv')
+        assert plan.write_size == os.path.getsize('two.csv')
+
+        # Only the changed source gets parsed
+        with patch('quilt.tools.build._file_to_data_frame', wraps=build._file_to_data_frame) as parse:
+            build.build_package_from_contents(None, 'test', 'planned', '.', new_contents, plan=True)
+        assert parse.call_count == 1
+
+        pkg = command.load('test/planned')
+        assert len(pkg.two()) == len(pkg.one()) + 1
+        with open(pkg.three()) as fd:
+            assert fd.read() == 'notes'
+        assert 'group' not in pkg._keys()
+
+    def test_build_watch(self):
+        mydir = os.path.dirname(__file__)
+        with open(os.path.join(mydir, 'data', 'foo.csv')) as fd:
+            csv = fd.read()
+        for name in ['one.csv', 'two.csv']:
+            with open(name, 'w') as fd:
+                fd.write(csv)
+        build_data = {
+            'contents': {
+                'one': {'file': 'one.csv'},
+                'group': {
+                    'two': {'file': 'two.csv'}
+                }
+            }
+        }
+        with open('build.yml', 'w') as fd:
+            yaml.dump(build_data, fd)
+
+        watcher = build.BuildWatcher(None, 'test', 'watched', os.path.abspath('build.yml'))
+        assert not watcher.poll()
+
+        with open('two.csv', 'a') as fd:
+            fd.write(csv.splitlines()[-1] + '\n')
+        stat = os.stat('two.csv')
+        os.utime('two.csv', (stat.st_atime, stat.st_mtime + 10))
+
+        with patch('quilt.tools.build._file_to_data_frame', wraps=build._file_to_data_frame) as parse:
+            assert watcher.poll()
+        assert parse.call_count == 1
+        assert not watcher.poll()
+
+        pkg = command.load('test/watched')
+        assert len(pkg.group.two()) == len(pkg.one()) + 1
+        assert watcher.get_package().get_hash() == pkg._package.get_hash()
+
+        # Changing the build file rebuilds the package, without re-parsing unchanged sources
+        build_data['contents']['three'] = {'file': 'one.csv'}
+        with open('build.yml', 'w') as fd:
+            yaml.dump(build_data, fd)
+        stat = os.stat('build.yml')
+        os.utime('build.yml', (stat.st_atime, stat.st_mtime + 10))
+
+        with patch('quilt.tools.build._file_to_data_frame', wraps=build._file_to_data_frame) as parse:
+            assert watcher.poll()
+        assert parse.call_count == 0
+
+        pkg = command.load('test/watched')
+        assert pkg.three().equals(pkg.one())
+
     #TODO: Add test for checks on a parquet-sourced dataframe
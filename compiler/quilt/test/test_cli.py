@@ -144,12 +144,17 @@ KNOWN_PARAMS = [
     [0, 'build'],
     [0, 'build', 0],
     [0, 'build', 1],
+    [0, 'build', '--plan'],
+    [0, 'build', '--watch'],
     [0, 'check'],
     [0, 'check', '--env'],
     [0, 'check', 0],
     [0, 'config'],
     [0, 'delete'],
     [0, 'delete', 0],
+    [0, 'diff'],
+    [0, 'diff', 0],
+    [0, 'diff', 1],
     [0, 'export'],
     [0, 'export', 0],
     [0, 'export', 1],
@@ -162,6 +167,11 @@ KNOWN_PARAMS = [
     [0, 'install'],
     [0, 'install', '-f'],
     [0, 'install', '-m'],
+    [0, 'install', '--lazy'],
+    [0, 'install', '--include'],
+    [0, 'install', '--exclude'],
+    [0, 'install', '--resume'],
+    [0, 'install', '--max-bandwidth'],
     [0, 'install', '-t'],
     [0, 'install', '-v'],
     [0, 'install', '-x'],
@@ -176,6 +186,11 @@ KNOWN_PARAMS = [
     [0, 'push', '--public'],
     [0, 'push', '--team'],
     [0, 'push', '--reupload'],
+    [0, 'push', '--stream'],
+    [0, 'push', '--cache-compressed'],
+    [0, 'push', '--verify-existing'],
+    [0, 'push', '--max-bandwidth'],
+    [0, 'push', '--resume'],
     [0, 'push', 0],
     [0, 'rm'],
     [0, 'rm', '-f'],
@@ -671,6 +686,11 @@ class TestCLI(BasicQuiltTestCase):
             [0, 'push', '--reupload'],
             [0, 'push', '--team'],
             [0, 'push', '--team', '--public'],
+            [0, 'push', '--stream'],
+            [0, 'push', '--cache-compressed'],
+            [0, 'push', '--verify-existing'],
+            [0, 'push', '--max-bandwidth'],
+            [0, 'push', '--resume'],
         ])
 
         ## This section tests for circumstances expected to be rejected by argparse.
@@ -693,6 +713,11 @@ class TestCLI(BasicQuiltTestCase):
             'is_public': False,
             'package': 'fakeuser/fakepackage',
             'is_team': False,
+            'stream': False,
+            'cache_compressed': False,
+            'verify_existing': False,
+            'max_bandwidth': None,
+            'resume': False,
         }
 
         ## Test the flags as well..
@@ -705,6 +730,11 @@ class TestCLI(BasicQuiltTestCase):
             'is_public': True,
             'package': 'fakeuser/fakepackage',
             'is_team': False,
+            'stream': False,
+            'cache_compressed': False,
+            'verify_existing': False,
+            'max_bandwidth': None,
+            'resume': False,
         }
 
         # team (without reupload)
@@ -716,6 +746,150 @@ class TestCLI(BasicQuiltTestCase):
             'is_public': False,
             'package': 'blah:fakeuser/fakepackage',
             'is_team': True,
+            'stream': False,
+            'cache_compressed': False,
+            'verify_existing': False,
+            'max_bandwidth': None,
+            'resume': False,
+        }
+
+        # stream and cache compressed fragments
+        cmd = 'push --stream --cache-compressed fakeuser/fakepackage'.split()
+        result = self.execute_with_checks(cmd, funcname='push')
+
+        assert result['kwargs'] == {
+            'reupload': False,
+            'is_public': False,
+            'package': 'fakeuser/fakepackage',
+            'is_team': False,
+            'stream': True,
+            'cache_compressed': True,
+            'verify_existing': False,
+            'max_bandwidth': None,
+            'resume': False,
+        }
+
+        # verify existing fragments
+        cmd = 'push --verify-existing fakeuser/fakepackage'.split()
+        result = self.execute_with_checks(cmd, funcname='push')
+
+        assert result['kwargs'] == {
+            'reupload': False,
+            'is_public': False,
+            'package': 'fakeuser/fakepackage',
+            'is_team': False,
+            'stream': False,
+            'cache_compressed': False,
+            'verify_existing': True,
+            'max_bandwidth': None,
+            'resume': False,
+        }
+
+        # bandwidth limit
+        cmd = 'push --max-bandwidth 2.5 fakeuser/fakepackage'.split()
+        result = self.execute_with_checks(cmd, funcname='push')
+
+        assert result['kwargs'] == {
+            'reupload': False,
+            'is_public': False,
+            'package': 'fakeuser/fakepackage',
+            'is_team': False,
+            'stream': False,
+            'cache_compressed': False,
+            'verify_existing': False,
+            'max_bandwidth': 2.5,
+            'resume': False,
+        }
+
+        # resume an interrupted push
+        cmd = 'push --resume fakeuser/fakepackage'.split()
+        result = self.execute_with_checks(cmd, funcname='push')
+
+        assert result['kwargs'] == {
+            'reupload': False,
+            'is_public': False,
+            'package': 'fakeuser/fakepackage',
+            'is_team': False,
+            'stream': False,
+            'cache_compressed': False,
+            'verify_existing': False,
+            'max_bandwidth': None,
+            'resume': True,
+        }
+
+    def test_cli_command_diff(self):
+        ## This test covers the following arguments that require testing
+        TESTED_PARAMS.extend([
+            [0, 'diff'],
+            [0, 'diff', 0],
+            [0, 'diff', 1],
+            ])
+
+        ## This section tests for circumstances expected to be rejected by argparse.
+        expect_fail_2_args = [
+            'diff'.split(),
+            'diff fakeuser/fakepackage'.split(),
+            ]
+        for args in expect_fail_2_args:
+            assert self.execute(args)['return code'] == 2
+
+        ## This section tests for appropriate types and values.
+        cmd = 'diff fakeuser/fakepackage:h:abcdef fakeuser/fakepackage'.split()
+        result = self.execute_with_checks(cmd, funcname='_cli_diff')
+
+        assert result['kwargs'] == {
+            'package_a': 'fakeuser/fakepackage:h:abcdef',
+            'package_b': 'fakeuser/fakepackage',
+        }
+
+    def test_cli_command_build(self):
+        ## This test covers the following arguments that require testing
+        TESTED_PARAMS.extend([
+            [0, 'build'],
+            [0, 'build', 0],
+            [0, 'build', 1],
+            [0, 'build', '--plan'],
+            [0, 'build', '--watch'],
+            ])
+
+        ## This section tests for circumstances expected to be rejected by argparse.
+        expect_fail_2_args = [
+            'build'.split(),
+            'build fakeuser/fakepackage'.split(),
+            'build --plan fakeuser/fakepackage'.split(),
+            ]
+        for args in expect_fail_2_args:
+            assert self.execute(args)['return code'] == 2
+
+        ## This section tests for appropriate types and values.
+        cmd = 'build fakeuser/fakepackage build.yml'.split()
+        result = self.execute_with_checks(cmd, funcname='build')
+
+        assert result['kwargs'] == {
+            'package': 'fakeuser/fakepackage',
+            'path': 'build.yml',
+            'plan': False,
+            'watch': False,
+        }
+
+        cmd = 'build --plan fakeuser/fakepackage build.yml'.split()
+        result = self.execute_with_checks(cmd, funcname='build')
+
+        assert result['kwargs'] == {
+            'package': 'fakeuser/fakepackage',
+            'path': 'build.yml',
+            'plan': True,
+            'watch': False,
+        }
+
+        cmd = 'build --watch fakeuser/fakepackage build.yml'.split()
+        result = self.execute_with_checks(cmd, funcname='build')
+
+        assert result['kwargs'] == {
+            'package': 'fakeuser/fakepackage',
+            'path': 'build.yml',
+            'plan': False,
+            'watch': True,
         }
 
     def test_cli_command_export(self):
@@ -80,9 +80,10 @@ import pandas as pd
 from six import assertRaisesRegex
 
 from .utils import QuiltTestCase, patch
-from ..tools import command, store
+from ..tools import build, command, store
 from ..tools.compat import pathlib
 from ..tools.const import TEAM_ID_ERROR
+from ..tools.core import encode_node
 
 
 class CommandTest(QuiltTestCase):
@@ -473,6 +474,43 @@ class CommandTest(QuiltTestCase):
 
         command.inspect('foo/bar')
 
+    def test_diff(self):
+        mydir = os.path.dirname(__file__)
+        command.build('foo/bar', os.path.join(mydir, './build_simple.yml'))
+        old_pkg = store.PackageStore.find_package(None, 'foo', 'bar')
+        old_hash = old_pkg.get_hash()
+        command.build('foo/bar', os.path.join(mydir, './build_simple_nest.yml'))
+        new_pkg = store.PackageStore.find_package(None, 'foo', 'bar')
+        new_hash = new_pkg.get_hash()
+        nuts_hashes = new_pkg['subnode/nuts'].hashes
+        nuts_size = sum(os.path.getsize(new_pkg.get_store().object_path(h)) for h in nuts_hashes)
+
+        assert command.diff('foo/bar:h:%s' % old_hash[:8], 'foo/bar') == [
+            command.NodeDiff('subnode/nuts', 'added', None, nuts_hashes, nuts_size)
+        ]
+        assert command.diff('foo/bar', 'foo/bar:h:%s' % old_hash) == [
+            command.NodeDiff('subnode/nuts', 'removed', nuts_hashes, None, -nuts_size)
+        ]
+        assert command.diff('foo/bar:h:%s' % old_hash, 'foo/bar:h:%s' % old_hash) == []
+        assert command.diff('foo/bar/foo', 'foo/bar/foo:h:%s' % old_hash[:8]) == []
+        command._cli_diff('foo/bar:h:%s' % old_hash, 'foo/bar')
+
+        # Not installed: compare with the manifest on the registry.
+        self.requests_mock.add(
+            responses.GET,
+            '%s/api/package/foo/remote/%s' % (command.get_registry_url(None), old_hash),
+            json.dumps(dict(contents=old_pkg.get_contents()), default=encode_node)
+        )
+        assert command.diff('foo/remote:h:%s' % old_hash, 'foo/bar:h:%s' % new_hash) == [
+            command.NodeDiff('subnode/nuts', 'added', None, nuts_hashes, nuts_size)
+        ]
+
+    def test_diff_missing_node(self):
+        mydir = os.path.dirname(__file__)
+        command.build('foo/bar', os.path.join(mydir, './build_simple.yml'))
+        with assertRaisesRegex(self, command.CommandException, "not found"):
+            command.diff('foo/bar/nothing', 'foo/bar')
+
     def test_user_list(self):
         self.requests_mock.add(
             responses.GET,
@@ -1140,7 +1178,7 @@ class CommandTest(QuiltTestCase):
             command.export("export_nonexistent_user/package")
 
         # Ensure export raises correct error when user does exist
-        command.build_package_from_contents(None, 'existent_user', 'testpackage', '', {'contents': {}})
+        build.build_package_from_contents(None, 'existent_user', 'testpackage', '', {'contents': {}})
 
         from quilt.data.existent_user import testpackage
 
@@ -0,0 +1,182 @@
+"""
+Tests for the shared core data structures.
+"""
+
+import json
+
+from ..tools.core import (CompactManifest, FileNode, GroupNode, RootNode, TableNode,
+                          decode_node, diff_trees, encode_node, find_matching_object_hashes,
+                          find_object_hashes, hash_contents, subtree_hash)
+from .utils import QuiltTestCase
+
+
+def _make_tree():
+    return RootNode(dict(
+        README=FileNode(['%064x' % 1], dict(q_ext='md', q_path='README.md', q_target='file')),
+        data=GroupNode(dict(
+            foo=TableNode(['%064x' % 2, '%064x' % 3], 'PARQUET',
+                          dict(q_ext='csv', q_path='data/foo.csv', q_target='pandas')),
+            bar=FileNode(['%064x' % 4], dict(q_ext='txt', q_path='data/bar.txt', q_target='file')),
+            empty=GroupNode(dict()),
+        ), dict(note='group metadata')),
+    ))
+
+
+class CoreTest(QuiltTestCase):
+    def test_hash_contents(self):
+        tree = _make_tree()
+        expected = 'a82e5b56c3fc39415263a642fb10c4e5b3bc72a8a43fa86c6fdfd0a6aa9f85ac'
+        assert hash_contents(tree) == expected
+        assert hash_contents(tree) == expected
+
+        # Modifying any group changes the hash...
+        tree.children['data'].children['bar'] = FileNode(['%064x' % 5])
+        assert hash_contents(tree) != expected
+        del tree.children['data'].children['bar']
+        assert hash_contents(tree) != expected
+        tree.children['data'].children.update(bar=FileNode(['%064x' % 4]))
+        assert hash_contents(tree) == expected
+        tree.children['data'].children = {}
+        assert hash_contents(tree) != expected
+
+        # ... and it always matches a freshly built tree.
+        assert hash_contents(tree) == hash_contents(json.loads(
+            json.dumps(tree, default=encode_node), object_hook=decode_node))
+
+    def test_hash_deep_tree(self):
+        tree = RootNode(dict())
+        group = tree
+        for _ in range(5000):
+            group.children['child'] = GroupNode(dict())
+            group = group.children['child']
+        group.children['leaf'] = FileNode(['%064x' % 1])
+        old_hash = hash_contents(tree)
+        group.children['leaf'] = FileNode(['%064x' % 2])
+        assert hash_contents(tree) != old_hash
+
+    def test_hash_shared_children(self):
+        # A group that reuses a root's children (like package composition in build.py)
+        # hashes as a group, even though its children's hashing state is shared.
+        pkg = _make_tree()
+        hash_contents(pkg)
+        subtree_hash(pkg)
+        composed = RootNode(dict(pkg=GroupNode(pkg.children)))
+        fresh = RootNode(dict(pkg=GroupNode(_make_tree().children)))
+        assert hash_contents(composed) == hash_contents(fresh)
+        assert subtree_hash(composed) == subtree_hash(fresh)
+        assert hash_contents(composed.children['pkg']) == hash_contents(fresh.children['pkg'])
+        assert hash_contents(composed.children['pkg']) != hash_contents(pkg)
+        assert hash_contents(pkg) == hash_contents(_make_tree())
+
+    def test_hash_deep_compact_tree(self):
+        tree = RootNode(dict())
+        group = tree
+        for _ in range(5000):
+            group.children['child'] = GroupNode(dict())
+            group = group.children['child']
+        group.children['leaf'] = FileNode(['%064x' % 1])
+        assert hash_contents(CompactManifest.from_node(tree).root) == hash_contents(tree)
+
+    def test_subtree_hash(self):
+        tree1 = _make_tree()
+        tree2 = _make_tree()
+        assert subtree_hash(tree1) == subtree_hash(tree2)
+        assert subtree_hash(tree1.children['data']) == subtree_hash(tree2.children['data'])
+        assert subtree_hash(tree1.children['README']) == subtree_hash(tree2.children['README'])
+
+        tree2.children['data'].children['empty'].children['new'] = FileNode(['%064x' % 5])
+        assert subtree_hash(tree1) != subtree_hash(tree2)
+        assert subtree_hash(tree1.children['data']) != subtree_hash(tree2.children['data'])
+        compact = CompactManifest.from_node(tree2).root
+        assert subtree_hash(compact) == subtree_hash(tree2)
+        assert subtree_hash(compact.children['data']) == subtree_hash(tree2.children['data'])
+        assert subtree_hash(RootNode(dict(data=compact.children['data']))) == \
+            subtree_hash(RootNode(dict(data=tree2.children['data'])))
+
+    def test_diff_trees(self):
+        old = _make_tree()
+        new = _make_tree()
+        assert list(diff_trees(old, new)) == []
+
+        new.children['README'] = FileNode(['%064x' % 9])
+        del new.children['data'].children['bar']
+        new.children['data'].children['empty'] = FileNode(['%064x' % 10])
+        new.children['data'].children['foo'] = GroupNode(dict(
+            part=FileNode(['%064x' % 2]),
+        ))
+        changes = [('/'.join(path), old_node, new_node) for path, old_node, new_node in diff_trees(old, new)]
+        data = old.children['data'].children
+        assert changes == [
+            ('README', old.children['README'], new.children['README']),
+            ('data/bar', data['bar'], None),
+            ('data/empty', None, new.children['data'].children['empty']),
+            ('data/foo', data['foo'], None),
+            ('data/foo/part', None, new.children['data'].children['foo'].children['part']),
+        ]
+
+    def test_find_matching_object_hashes(self):
+        tree = _make_tree()
+
+        def _match(include=(), exclude=()):
+            return sorted(int(h, 16) for h in find_matching_object_hashes(tree, include, exclude))
+
+        assert _match() == [1, 2, 3, 4]
+        assert _match(include=['data']) == [2, 3, 4]
+        assert _match(include=['data/f*', 'READ??']) == [1, 2, 3]
+        assert _match(include=['**/bar']) == [4]
+        assert _match(exclude=['*/b*']) == [1, 2, 3]
+        assert _match(include=['data/**'], exclude=['data']) == []
+        assert _match(include=['*'], exclude=['data/foo']) == [1, 4]
+        # `*` doesn't match across names.
+        assert _match(include=['*r']) == []
+        assert _match(include=['*/*r']) == [4]
+
+    def test_compact_manifest(self):
+        tree = _make_tree()
+        manifest = CompactManifest.from_node(tree)
+        root = manifest.root
+        assert len(manifest) == 6
+
+        # Same Node API...
+        assert isinstance(root, RootNode)
+        assert isinstance(root.children['data'], GroupNode)
+        assert isinstance(root.children['data'].children['foo'], TableNode)
+        assert root.children['data'].metadata == dict(note='group metadata')
+        assert root.children['data'].children['foo'].hashes == ['%064x' % 2, '%064x' % 3]
+        assert root == tree
+
+        # ... and the same results.
+        assert hash_contents(root) == hash_contents(tree)
+        assert hash_contents(root.children['data']) == hash_contents(tree.children['data'])
+        assert list(find_object_hashes(root, sort=True)) == list(find_object_hashes(tree, sort=True))
+        assert sorted(find_object_hashes(root)) == sorted(find_object_hashes(tree))
+        assert (list(find_object_hashes(root.children['data'], sort=True)) ==
+                list(find_object_hashes(tree.children['data'], sort=True)))
+        assert ([node.json_type for node in root.preorder(sort=True)] ==
+                [node.json_type for node in tree.preorder(sort=True)])
+        assert (json.dumps(root, default=encode_node, sort_keys=True) ==
+                json.dumps(tree, default=encode_node, sort_keys=True))
+
+        # Keys are interned.
+        leaves = [node for node in root.preorder() if isinstance(node, (TableNode, FileNode))]
+        keys = [list(node.metadata)[0] for node in leaves]
+        assert all(key is keys[0] for key in keys)
+
+        # Converting back gives a regular tree.
+        copy = manifest.to_node()
+        assert type(copy) is RootNode
+        assert type(copy.children['data'].children['foo']) is TableNode
+        assert copy == tree
+
+    def test_compact_manifest_json(self):
+        tree = _make_tree()
+        data = json.dumps(tree, default=encode_node)
+
+        manifest = CompactManifest.loads(data)
+        assert manifest.root == json.loads(data, object_hook=decode_node)
+        assert hash_contents(manifest.root) == hash_contents(tree)
+        assert list(find_object_hashes(manifest.root, sort=True)) == list(find_object_hashes(tree, sort=True))
+
+    def test_compact_manifest_bad_hash(self):
+        with self.assertRaises(ValueError):
+            CompactManifest.from_node(RootNode(dict(foo=FileNode(['123']))))
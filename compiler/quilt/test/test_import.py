@@ -75,6 +75,37 @@ class ImportTest(QuiltTestCase):
         with self.assertRaises(ImportError):
             from quilt.data.foo.baz import blah
 
+    def test_lazy_children(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build.yml')
+        command.build('foo/lazy', build_path)
+
+        from quilt.data.foo import lazy
+
+        # Nothing is created until it's accessed...
+        assert 'dataframes' not in lazy.__dict__
+        # ...but the children are still listed.
+        assert set(lazy._keys()) == {'dataframes', 'README'}
+        assert lazy._group_keys() == ['dataframes']
+        assert lazy._data_keys() == ['README']
+        assert 'dataframes/' in repr(lazy)
+        assert 'dataframes' in dir(lazy)
+        assert 'dataframes' not in lazy.__dict__
+
+        dataframes = lazy.dataframes
+        assert isinstance(dataframes, GroupNode)
+        assert lazy.dataframes is dataframes
+        assert set(dataframes._keys()) == {'csv', 'nulls'}
+        assert isinstance(dataframes.csv, DataNode)
+        assert not hasattr(dataframes, 'foo')
+
+        # Deleted children stay deleted, whether or not they were accessed.
+        del lazy.README
+        del lazy.dataframes
+        assert lazy._keys() == []
+        assert not hasattr(lazy, 'README')
+        assert not hasattr(lazy, 'dataframes')
+
     def test_team_imports(self):
         mydir = os.path.dirname(__file__)
         build_path = os.path.join(mydir, './build.yml')
@@ -200,10 +231,10 @@ class ImportTest(QuiltTestCase):
         teststore = PackageStore(self._store_dir)
         contents1 = open(os.path.join(teststore.package_path(None, 'foo', 'package1'),
                                       Package.CONTENTS_DIR,
-                                      package1._package.get_hash())).read()
+                                      package1._package.get_hash()), 'rb').read()
         contents2 = open(os.path.join(teststore.package_path(None, 'foo', 'package2'),
                                       Package.CONTENTS_DIR,
-                                      package2._package.get_hash())).read()
+                                      package2._package.get_hash()), 'rb').read()
         assert contents1 == contents2
 
         # Rename an attribute
@@ -256,6 +287,34 @@ class ImportTest(QuiltTestCase):
         new_file = package3.new.file._data()
         assert isinstance(new_file, string_types)
 
+    def test_save_reuses_objects(self):
+        mydir = os.path.dirname(__file__)
+        build_path = os.path.join(mydir, './build.yml')
+        command.build('foo/reused1', build_path)
+
+        package = command.load('foo/reused1')
+        df = pd.DataFrame(dict(a=[1, 2, 3]))
+        package._set(['new', 'df'], df)
+
+        # Only the new dataframe gets serialized.
+        with patch.object(PackageStore, 'save_dataframe', autospec=True,
+                          side_effect=PackageStore.save_dataframe) as save_dataframe:
+            command.build('foo/reused2', package)
+        assert save_dataframe.call_count == 1
+
+        reused1 = command.load('foo/reused1')
+        reused2 = command.load('foo/reused2')
+        assert reused2.dataframes.csv._node.hashes == reused1.dataframes.csv._node.hashes
+        assert reused2.README._node.hashes == reused1.README._node.hashes
+        assert reused2.new.df().equals(df)
+
+        # Objects get copied over when saving a package from another store.
+        other_store = 'other/%s' % PACKAGE_DIR_NAME
+        with patch.dict(os.environ, {'QUILT_PRIMARY_PACKAGE_DIR': other_store}):
+            command.build('foo/reused3', reused1)
+            reused3 = command.load('foo/reused3')
+            assert reused3.dataframes.csv().equals(reused1.dataframes.csv())
+
     def test_set_non_node_attr(self):
         mydir = os.path.dirname(__file__)
         build_path = os.path.join(mydir, './build.yml')
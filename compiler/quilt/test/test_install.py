@@ -5,7 +5,9 @@ Tests for the install command.
 import hashlib
 import json
 import os
+import re
 import time
+import zlib
 import pytest
 
 import requests
@@ -14,10 +16,9 @@ from requests.exceptions import SSLError, ConnectionError
 from six import assertRaisesRegex
 from six.moves import urllib
 
-from ..tools import command
-from ..tools.const import HASH_TYPE
+from ..tools import command, data_transfer, manifest
+from ..tools.const import HASH_TYPE, PACKAGE_DIR_NAME
 from ..tools.core import (
-    decode_node,
     encode_node,
     hash_contents,
     FileNode,
@@ -26,9 +27,9 @@ from ..tools.core import (
     TableNode,
     RootNode,
 )
-from ..tools.package import Package
+from ..tools.package import LAZY_PREFETCH_ENV, Package
 from ..tools.store import PackageStore
-from ..tools.util import gzip_compress
+from ..tools.util import gzip_compress, have_zstd, zstd_compress
 
 from .utils import QuiltTestCase, patch
 
@@ -80,6 +81,56 @@ class InstallTest(QuiltTestCase):
         command.install('foo/bar')
         self.validate_file('foo', 'bar', contents_hash, contents, table_hash, table_data)
 
+    def test_install_uncompressed(self):
+        """
+        Install fragments that were uploaded without gzip, including one that's too short to tell.
+        """
+        file_data = os.urandom(1000)
+        file_hash = hashlib.new(HASH_TYPE, file_data).hexdigest()
+        short_data = b'x'
+        short_hash = hashlib.new(HASH_TYPE, short_data).hexdigest()
+        contents, contents_hash = self.make_contents(file=file_hash, short=short_hash)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [file_hash, short_hash])
+        self._mock_s3(file_hash, file_data, compress=False)
+        self._mock_s3(short_hash, short_data, compress=False)
+
+        command.install('foo/bar')
+
+        teststore = PackageStore(self._store_dir)
+        for obj_hash, data in [(file_hash, file_data), (short_hash, short_data)]:
+            with open(teststore.object_path(obj_hash), 'rb') as fd:
+                assert fd.read() == data
+
+    @pytest.mark.skipif(not have_zstd(), reason="zstandard is not installed")
+    def test_install_zstd_response(self):
+        """
+        Registries can send the manifest zstd'ed, if asked for it.
+        """
+        file_data, file_hash = self.make_file_data()
+        contents, contents_hash = self.make_contents(file=file_hash)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        pkg_url = '%s/api/package/foo/bar/%s?%s' % (
+            command.get_registry_url(None), contents_hash, urllib.parse.urlencode(dict(subpath=''))
+        )
+        body = json.dumps(dict(
+            contents=contents,
+            sizes={file_hash: 100},
+            urls={file_hash: 'https://example.com/%s' % file_hash}
+        ), default=encode_node).encode('utf-8')
+        self.requests_mock.add(responses.GET, pkg_url, body=zstd_compress(body), match_querystring=True,
+                               adding_headers={'Content-Encoding': 'zstd'})
+        self._mock_s3(file_hash, file_data)
+
+        command.install('foo/bar')
+
+        assert 'zstd' in self.requests_mock.calls[-2].request.headers['Accept-Encoding']
+        teststore = PackageStore(self._store_dir)
+        with open(teststore.object_path(file_hash), 'rb') as fd:
+            assert fd.read() == file_data
+
     def test_install_team_latest(self):
         """
         Install the latest team update of a package.
@@ -156,8 +207,8 @@ class InstallTest(QuiltTestCase):
         teststore = PackageStore(self._store_dir)
 
         with open(os.path.join(teststore.package_path(team, user, package), Package.CONTENTS_DIR,
-                               contents_hash), 'r') as fd:
-            file_contents = json.load(fd, object_hook=decode_node)
+                               contents_hash), 'rb') as fd:
+            file_contents = manifest.load(fd)
             assert file_contents == contents
 
         with open(teststore.object_path(objhash=table_hash), 'rb') as fd:
@@ -255,6 +306,40 @@ packages:
                 self.getmtime('usr','pkga', contents_hash7, team='team') <=
                 self.getmtime('usr','pkgb', contents_hash8, team='team'))
 
+    def test_install_dependencies_shared_fragments(self):
+        """
+        Fragments shared by several packages in a requirements file are downloaded once.
+        """
+        shared_data, shared_hash = self.make_file_data('shared')
+        file_data, file_hash = self.make_file_data()
+        contents1, contents_hash1 = self.make_contents(shared=shared_hash)
+        contents2, contents_hash2 = self.make_contents(shared=shared_hash, file=file_hash)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash1)
+        self._mock_package('foo/bar', contents_hash1, '', contents1, [shared_hash])
+        self._mock_tag('baz/bat', 'latest', contents_hash2)
+        self._mock_package('baz/bat', contents_hash2, '', contents2, [shared_hash, file_hash])
+        self._mock_s3(shared_hash, shared_data)
+        self._mock_s3(file_hash, file_data)
+
+        command.install("""
+packages:
+- foo/bar
+- baz/bat
+        """)
+
+        s3_urls = [call.request.url for call in self.requests_mock.calls
+                   if call.request.url.startswith('https://example.com/')]
+        assert sorted(s3_urls) == sorted('https://example.com/%s' % h for h in [shared_hash, file_hash])
+
+        # All of the metadata is downloaded before any fragments.
+        urls = [call.request.url for call in self.requests_mock.calls]
+        assert max(idx for idx, url in enumerate(urls) if '/api/' in url) < urls.index(s3_urls[0])
+
+        teststore = PackageStore(self._store_dir)
+        for pkg in ['foo/bar', 'baz/bat']:
+            assert teststore.get_package(None, *pkg.split('/')) is not None
+
     def test_install_dependencies_from_file(self):
         table_data, table_hash = self.make_table_data('table')
         contents, contents_hash = self.make_contents(table7=table_hash)
@@ -414,6 +499,664 @@ packages:
         command.install('foo/bar')
 
 
+    def test_resume_install(self):
+        """
+        Resume an interrupted install from its journal, without the package metadata.
+        """
+        file_data, file_hash = self.make_file_data()
+        other_data, other_hash = self.make_file_data('other')
+        contents, contents_hash = self.make_contents(file=file_hash, other=other_hash)
+        error = requests.exceptions.ConnectionError("Timeout")
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [file_hash, other_hash])
+        self._mock_s3(file_hash, file_data)
+        for _ in range(3):
+            self.requests_mock.add(responses.GET, 'https://example.com/%s' % other_hash, body=error)
+
+        with self.assertRaises(command.CommandException):
+            command.install('foo/bar')
+
+        teststore = PackageStore(self._store_dir)
+        journal_path = teststore.journal_path('install', None, 'foo', 'bar')
+        assert os.path.exists(journal_path)
+
+        # The URLs have expired, so the registry gets asked for the missing fragment's URL only.
+        self.requests_mock.reset()
+        self._mock_get_objects([other_hash])
+        self._mock_s3(other_hash, other_data)
+
+        with patch('quilt.tools.data_transfer.JOURNAL_URL_LIFETIME', -1):
+            command.install('foo/bar', resume=True)
+
+        assert json.loads(self.requests_mock.calls[0].request.body) == [other_hash]
+        assert not os.path.exists(journal_path)
+        pkg = command.load('foo/bar')
+        with open(pkg.group.other(), 'rb') as fd:
+            assert fd.read() == other_data
+
+    def test_resume_install_other_instance(self):
+        """
+        Resuming with a different hash, tag or version installs what was asked for instead.
+        """
+        file_data, file_hash = self.make_file_data()
+        other_data, other_hash = self.make_file_data('other')
+        contents1, contents_hash1 = self.make_contents(file=file_hash, other=other_hash)
+        contents2, contents_hash2 = self.make_contents(file=file_hash)
+        error = requests.exceptions.ConnectionError("Timeout")
+
+        self._mock_tag('foo/bar', 'latest', contents_hash1)
+        self._mock_package('foo/bar', contents_hash1, '', contents1, [file_hash, other_hash])
+        self._mock_s3(file_hash, file_data)
+        for _ in range(3):
+            self.requests_mock.add(responses.GET, 'https://example.com/%s' % other_hash, body=error)
+
+        with self.assertRaises(command.CommandException):
+            command.install('foo/bar')
+
+        # A different tag: the metadata gets downloaded again.
+        self.requests_mock.reset()
+        self._mock_tag('foo/bar', 'stable', contents_hash2)
+        self._mock_package('foo/bar', contents_hash2, '', contents2, [file_hash])
+
+        command.install('foo/bar', tag='stable', resume=True)
+
+        teststore = PackageStore(self._store_dir)
+        assert teststore.find_instance(None, 'foo', 'bar') == contents_hash2
+        assert not os.path.exists(teststore.journal_path('install', None, 'foo', 'bar'))
+
+    def test_resume_install_requirements(self):
+        """
+        Resume an interrupted install of several packages; each one's journal has its fragments.
+        """
+        file_data, file_hash = self.make_file_data()
+        other_data, other_hash = self.make_file_data('other')
+        contents1, contents_hash1 = self.make_contents(file=file_hash)
+        contents2, contents_hash2 = self.make_contents(file=file_hash, other=other_hash)
+        error = requests.exceptions.ConnectionError("Timeout")
+
+        self._mock_tag('foo/bar', 'latest', contents_hash1)
+        self._mock_package('foo/bar', contents_hash1, '', contents1, [file_hash])
+        self._mock_tag('foo/baz', 'latest', contents_hash2)
+        self._mock_package('foo/baz', contents_hash2, '', contents2, [file_hash, other_hash])
+        self._mock_s3(file_hash, file_data)
+        for _ in range(3):
+            self.requests_mock.add(responses.GET, 'https://example.com/%s' % other_hash, body=error)
+
+        requirements = "packages:\n- foo/bar\n- foo/baz"
+        with self.assertRaises(command.CommandException):
+            command.install(requirements)
+
+        teststore = PackageStore(self._store_dir)
+        for pkg in ['bar', 'baz']:
+            journal = data_transfer.TransferJournal(teststore.journal_path('install', None, 'foo', pkg))
+            assert journal.done == {file_hash}
+
+        # Only the missing fragment gets downloaded.
+        self.requests_mock.reset()
+        self._mock_get_objects([other_hash])
+        self._mock_s3(other_hash, other_data)
+
+        with patch('quilt.tools.data_transfer.JOURNAL_URL_LIFETIME', -1):
+            command.install(requirements, resume=True)
+
+        assert json.loads(self.requests_mock.calls[0].request.body) == [other_hash]
+        pkg = command.load('foo/baz')
+        with open(pkg.group.other(), 'rb') as fd:
+            assert fd.read() == other_data
+        pkg = command.load('foo/bar')
+        with open(pkg.group.file(), 'rb') as fd:
+            assert fd.read() == file_data
+
+    def test_resume_partial_download(self):
+        """
+        Test that a partially downloaded fragment is resumed where it left off.
+        """
+        file_data, file_hash = self.make_file_data('resume' * 100)
+        contents, contents_hash = self.make_contents(file=file_hash)
+        compressed = gzip_compress(file_data)
+        split = len(compressed) // 2
+
+        teststore = PackageStore(self._store_dir)
+        teststore.create_dirs()
+        with open(teststore.temporary_object_path(file_hash + '.gz'), 'wb') as fd:
+            fd.write(compressed[:split])
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [file_hash])
+        headers = {
+            'Content-Range': 'bytes %d-%d/%d' % (split, len(compressed) - 1, len(compressed))
+        }
+        self.requests_mock.add(responses.GET, 'https://example.com/%s' % file_hash,
+                               compressed[split:], headers=headers)
+
+        command.install('foo/bar')
+
+        assert self.requests_mock.calls[-1].request.headers['Range'] == 'bytes=%d-' % split
+        with open(teststore.object_path(file_hash), 'rb') as fd:
+            assert fd.read() == file_data
+        assert not os.path.exists(teststore.temporary_object_path(file_hash + '.gz'))
+        assert not os.path.exists(teststore.temporary_object_path(file_hash))
+
+    def test_install_lazy(self):
+        """
+        Install only the metadata, then download each node's fragments when it's used.
+        """
+        file_data, file_hash = self.make_file_data()
+        other_data, other_hash = self.make_file_data('other')
+        contents, contents_hash = self.make_contents(file=file_hash, other=other_hash)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [], meta_only=True)
+
+        command.install('foo/bar', lazy=True)
+
+        teststore = PackageStore(self._store_dir)
+        assert not os.path.exists(teststore.object_path(file_hash))
+        assert not os.path.exists(teststore.object_path(other_hash))
+
+        self._mock_get_objects([file_hash, other_hash])
+        self._mock_s3(file_hash, file_data)
+        self._mock_s3(other_hash, other_data)
+
+        pkg = command.load('foo/bar')
+        with open(pkg.group.file(), 'rb') as fd:
+            assert fd.read() == file_data
+        assert not os.path.exists(teststore.object_path(other_hash))
+
+        # A regular install turns it back into a complete package.
+        self._mock_package('foo/bar', contents_hash, '', contents, [file_hash, other_hash])
+        command.install('foo/bar', force=True)
+        assert teststore.get_package(None, 'foo', 'bar').get_remote() is None
+
+    def test_install_lazy_then_full(self):
+        """
+        A full install of another instance, or a failed one of the same, leaves a lazy instance lazy.
+        """
+        file_data, file_hash = self.make_file_data()
+        other_data, other_hash = self.make_file_data('other')
+        contents_a, contents_hash_a = self.make_contents(file=file_hash)
+        contents_b, contents_hash_b = self.make_contents(other=other_hash)
+        error = requests.exceptions.ConnectionError("Timeout")
+
+        self._mock_tag('foo/bar', 'a', contents_hash_a)
+        self._mock_package('foo/bar', contents_hash_a, '', contents_a, [], meta_only=True)
+        command.install('foo/bar', tag='a', lazy=True)
+
+        self._mock_tag('foo/bar', 'a', contents_hash_a)
+        self._mock_package('foo/bar', contents_hash_a, '', contents_a, [file_hash])
+        for _ in range(3):
+            self.requests_mock.add(responses.GET, 'https://example.com/%s' % file_hash, body=error)
+        with self.assertRaises(command.CommandException):
+            command.install('foo/bar', tag='a', force=True)
+
+        self._mock_tag('foo/bar', 'b', contents_hash_b)
+        self._mock_package('foo/bar', contents_hash_b, '', contents_b, [other_hash])
+        self._mock_s3(other_hash, other_data)
+        command.install('foo/bar', tag='b', force=True)
+
+        teststore = PackageStore(self._store_dir)
+        assert teststore.get_package(None, 'foo', 'bar', contents_hash_b).get_remote() is None
+        pkg_a = teststore.get_package(None, 'foo', 'bar', contents_hash_a)
+        assert pkg_a.get_remote() == dict(team=None)
+
+        # Reading A still fetches its fragments.
+        self.requests_mock.reset()
+        self._mock_get_objects([file_hash])
+        self._mock_s3(file_hash, file_data)
+        pkg_a.fetch_missing_fragments([pkg_a.get_contents()])
+        with open(teststore.object_path(file_hash), 'rb') as fd:
+            assert fd.read() == file_data
+
+    def test_install_lazy_prefetch(self):
+        file_data, file_hash = self.make_file_data()
+        other_data, other_hash = self.make_file_data('other')
+        _, nested_hash = self.make_file_data('nested')
+        contents = RootNode(dict(
+            group=GroupNode(dict(
+                file=FileNode([file_hash]),
+                other=FileNode([other_hash])
+            )),
+            side=GroupNode(dict(
+                file=FileNode([nested_hash])
+            ))
+        ))
+        contents_hash = hash_contents(contents)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [], meta_only=True)
+        self._mock_get_objects([file_hash, other_hash])
+        self._mock_s3(file_hash, file_data)
+        self._mock_s3(other_hash, other_data)
+
+        command.install('foo/bar', lazy=True)
+
+        pkg = command.load('foo/bar')
+        with patch.dict(os.environ, {LAZY_PREFETCH_ENV: '1'}):
+            pkg.group.file()
+        pkg._package._prefetch_thread.join()
+
+        teststore = PackageStore(self._store_dir)
+        with open(teststore.object_path(other_hash), 'rb') as fd:
+            assert fd.read() == other_data
+
+        # Only the siblings are prefetched; other groups aren't even decoded.
+        assert not os.path.exists(teststore.object_path(nested_hash))
+        assert not pkg._package.get_contents().children['side']._is_loaded()
+
+    def test_install_lazy_unavailable(self):
+        _, file_hash = self.make_file_data()
+        contents, contents_hash = self.make_contents(file=file_hash)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [], meta_only=True)
+        self._mock_get_objects([])
+
+        command.install('foo/bar', lazy=True)
+
+        pkg = command.load('foo/bar')
+        with assertRaisesRegex(self, command.CommandException, 'no longer available'):
+            pkg.group.file()
+
+    def _install_lazy(self):
+        """
+        Installs a lazy package with two files, and mocks the download of their fragments.
+        """
+        file_data, file_hash = self.make_file_data()
+        other_data, other_hash = self.make_file_data('other')
+        contents, contents_hash = self.make_contents(file=file_hash, other=other_hash)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [], meta_only=True)
+        command.install('foo/bar', lazy=True)
+
+        self._mock_get_objects([file_hash, other_hash])
+        self._mock_s3(file_hash, file_data)
+        self._mock_s3(other_hash, other_data)
+        return contents_hash, {file_hash: file_data, other_hash: other_data}
+
+    def _get_objects_calls(self):
+        url = '%s/api/get_objects' % command.get_registry_url(None)
+        return [call for call in self.requests_mock.calls if call.request.url == url]
+
+    def test_push_lazy(self):
+        """
+        Pushing a lazily-installed package downloads its fragments first.
+        """
+        contents_hash, objects = self._install_lazy()
+
+        pkg_url = '%s/api/package/foo/bar/%s' % (command.get_registry_url(None), contents_hash)
+        upload_urls = {obj_hash: dict(exists=True) for obj_hash in objects}
+        self.requests_mock.add(responses.PUT, pkg_url, json.dumps(dict(upload_urls=upload_urls)))
+        self.requests_mock.add(responses.PUT, pkg_url, json.dumps(dict(package_url='https://example.com/')))
+        tag_url = '%s/api/tag/foo/bar/latest' % command.get_registry_url(None)
+        self.requests_mock.add(responses.PUT, tag_url, json.dumps(dict()))
+
+        command.push('foo/bar')
+
+        teststore = PackageStore(self._store_dir)
+        for obj_hash, data in objects.items():
+            with open(teststore.object_path(obj_hash), 'rb') as fd:
+                assert fd.read() == data
+        assert len(self._get_objects_calls()) == 1
+
+    def test_push_missing_fragments(self):
+        file_data, file_hash = self.make_file_data()
+        contents, contents_hash = self.make_contents(file=file_hash)
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [file_hash])
+        self._mock_s3(file_hash, file_data)
+        command.install('foo/bar')
+
+        os.remove(PackageStore(self._store_dir).object_path(file_hash))
+        with assertRaisesRegex(self, command.CommandException, 'missing 1 fragments'):
+            command.push('foo/bar')
+
+    def test_build_from_lazy(self):
+        """
+        Building a package from a lazily-installed one copies its fragments, downloading them first.
+        """
+        contents_hash, objects = self._install_lazy()
+
+        command.build('foo/baz', command.load('foo/bar'))
+
+        teststore = PackageStore(self._store_dir)
+        assert teststore.get_package(None, 'foo', 'baz').get_hash() == contents_hash
+        for obj_hash, data in objects.items():
+            with open(teststore.object_path(obj_hash), 'rb') as fd:
+                assert fd.read() == data
+
+    def test_export_lazy(self):
+        _, objects = self._install_lazy()
+
+        command.export('foo/bar', os.path.join(self._test_dir, 'exported'))
+
+        # All the fragments are downloaded in one batch.
+        assert len(self._get_objects_calls()) == 1
+        exported = []
+        for name in ['file', 'other']:
+            with open(os.path.join(self._test_dir, 'exported', name), 'rb') as fd:
+                exported.append(fd.read())
+        assert sorted(exported) == sorted(objects.values())
+
+    def test_install_include_exclude(self):
+        """
+        Install only the nodes matching the patterns; the rest gets fetched when it's used.
+        """
+        file_data, file_hash = self.make_file_data()
+        other_data, other_hash = self.make_file_data('other')
+        table_data, table_hash = self.make_table_data()
+        contents, contents_hash = self.make_contents(file=file_hash, other=other_hash, table=table_hash)
+
+        # The registry returns all of the URLs, like an older one would.
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [file_hash, other_hash, table_hash],
+                           include=['group/*e'], exclude=['**/tab*'])
+        self._mock_s3(file_hash, file_data)
+
+        command.install('foo/bar', include=['group/*e'], exclude=['**/tab*'])
+
+        teststore = PackageStore(self._store_dir)
+        with open(teststore.object_path(file_hash), 'rb') as fd:
+            assert fd.read() == file_data
+        assert not os.path.exists(teststore.object_path(other_hash))
+        assert not os.path.exists(teststore.object_path(table_hash))
+        assert teststore.get_package(None, 'foo', 'bar').get_remote() == dict(team=None)
+
+        self._mock_get_objects([other_hash])
+        self._mock_s3(other_hash, other_data)
+
+        pkg = command.load('foo/bar')
+        with open(pkg.group.other(), 'rb') as fd:
+            assert fd.read() == other_data
+
+    def _make_shared_store(self, objects):
+        """
+        Creates another package directory with the given objects; returns $QUILT_PACKAGE_DIRS.
+        """
+        shared_dir = os.path.join(self._test_dir, 'shared', PACKAGE_DIR_NAME)
+        shared_store = PackageStore(shared_dir)
+        shared_store.create_dirs()
+        for obj_hash, data in objects.items():
+            with open(shared_store.object_path(obj_hash), 'wb') as fd:
+                fd.write(data)
+        return ':'.join([self._store_dir, shared_dir])
+
+    def test_install_from_other_stores(self):
+        """
+        Fragments found in other package directories are linked, rather than downloaded.
+        """
+        shared_data, shared_hash = self.make_file_data('sharedfile')  # 100 bytes, as the mock registry says.
+        file_data, file_hash = self.make_file_data()
+        contents, contents_hash = self.make_contents(shared=shared_hash, file=file_hash)
+        dirs = self._make_shared_store({shared_hash: shared_data})
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [shared_hash, file_hash])
+        self._mock_s3(file_hash, file_data)
+
+        with patch.dict(os.environ, {'QUILT_PACKAGE_DIRS': dirs}):
+            command.install('foo/bar')
+
+        teststore = PackageStore(self._store_dir)
+        with open(teststore.object_path(shared_hash), 'rb') as fd:
+            assert fd.read() == shared_data
+        assert os.stat(teststore.object_path(shared_hash)).st_nlink == 2
+        urls = [call.request.url for call in self.requests_mock.calls]
+        assert not any(shared_hash in url for url in urls)
+
+    def test_install_from_other_filesystem(self):
+        """
+        Fragments copied from other package directories are checked; corrupt ones are downloaded.
+        """
+        shared_data, shared_hash = self.make_file_data('sharedfile')
+        corrupt_data, corrupt_hash = self.make_file_data('corruptfile')
+        contents, contents_hash = self.make_contents(shared=shared_hash, corrupt=corrupt_hash)
+        dirs = self._make_shared_store({shared_hash: shared_data, corrupt_hash: b'x' * len(corrupt_data)})
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [shared_hash, corrupt_hash])
+        self._mock_s3(corrupt_hash, corrupt_data)
+
+        with patch.dict(os.environ, {'QUILT_PACKAGE_DIRS': dirs}), \
+                patch('os.link', side_effect=OSError("Invalid cross-device link")):
+            command.install('foo/bar')
+
+        teststore = PackageStore(self._store_dir)
+        for obj_hash, data in [(shared_hash, shared_data), (corrupt_hash, corrupt_data)]:
+            with open(teststore.object_path(obj_hash), 'rb') as fd:
+                assert fd.read() == data
+        assert os.stat(teststore.object_path(shared_hash)).st_nlink == 1
+        urls = [call.request.url for call in self.requests_mock.calls]
+        assert not any(shared_hash in url for url in urls)
+
+    def test_lazy_fetch_from_other_stores(self):
+        shared_data, shared_hash = self.make_file_data('sharedfile')
+        contents, contents_hash = self.make_contents(shared=shared_hash)
+        dirs = self._make_shared_store({shared_hash: shared_data})
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [], meta_only=True)
+        command.install('foo/bar', lazy=True)
+
+        # No registry or S3 requests.
+        pkg = command.load('foo/bar')
+        with patch.dict(os.environ, {'QUILT_PACKAGE_DIRS': dirs}):
+            with open(pkg.group.shared(), 'rb') as fd:
+                assert fd.read() == shared_data
+
+    def test_fragment_writer(self):
+        data = b'fragment' * 1000
+        expected = hashlib.new(HASH_TYPE, data + data).hexdigest()
+        partial_path = os.path.join(self._test_dir, 'partial.gz')
+        output_path = os.path.join(self._test_dir, 'output')
+
+        # Multiple gzip members, split at arbitrary points.
+        compressed = gzip_compress(data) + gzip_compress(data)
+        writer = data_transfer.FragmentWriter(partial_path, output_path)
+        for pos in range(0, len(compressed), 7):
+            writer.write(compressed[pos:pos + 7])
+        assert writer.finish() == expected
+        with open(output_path, 'rb') as fd:
+            assert fd.read() == data + data
+
+        # Resuming replays the partial file.
+        os.remove(partial_path)
+        with open(partial_path, 'wb') as fd:
+            fd.write(compressed[:30])
+        writer = data_transfer.FragmentWriter(partial_path, output_path)
+        assert writer.compressed_size == 30
+        writer.write(compressed[30:])
+        assert writer.finish() == expected
+
+        # Truncated data.
+        os.remove(partial_path)
+        writer = data_transfer.FragmentWriter(partial_path, output_path)
+        writer.write(compressed[:-10])
+        with self.assertRaises(EOFError):
+            writer.finish()
+        writer.close()
+
+    @pytest.mark.skipif(not have_zstd(), reason="zstandard is not installed")
+    def test_fragment_writer_zstd(self):
+        data = b'fragment' * 1000
+        expected = hashlib.new(HASH_TYPE, data).hexdigest()
+        partial_path = os.path.join(self._test_dir, 'partial.gz')
+        output_path = os.path.join(self._test_dir, 'output')
+
+        compressed = zstd_compress(data)
+        writer = data_transfer.FragmentWriter(partial_path, output_path)
+        for pos in range(0, len(compressed), 7):
+            writer.write(compressed[pos:pos + 7])
+        assert writer.finish(expected) == expected
+        with open(output_path, 'rb') as fd:
+            assert fd.read() == data
+
+        # Older clients uploaded data that looks zstd'ed as it is - valid or not.
+        for raw in [compressed, compressed[:4] + b'garbage' * 10]:
+            raw_hash = hashlib.new(HASH_TYPE, raw).hexdigest()
+            os.remove(partial_path)
+            writer = data_transfer.FragmentWriter(partial_path, output_path)
+            writer.write(raw)
+            assert writer.finish(raw_hash) == raw_hash
+            with open(output_path, 'rb') as fd:
+                assert fd.read() == raw
+
+        # Corrupt data.
+        os.remove(partial_path)
+        writer = data_transfer.FragmentWriter(partial_path, output_path)
+        writer.write(compressed[:4] + b'garbage' * 10)
+        with self.assertRaises(zlib.error):
+            writer.finish(expected)
+        writer.close()
+
+    @patch('quilt.tools.data_transfer.time')
+    def test_concurrency_limit(self, mock_time):
+        mock_time.time.return_value = 0
+        concurrency = data_transfer.ConcurrencyLimit(4, adaptive=True)
+        concurrency.adjust(0)
+
+        # Grows while the throughput improves...
+        for i, total in enumerate([100, 300, 600], 1):
+            mock_time.time.return_value = data_transfer.ADJUST_INTERVAL * i
+            concurrency.adjust(total)
+        assert concurrency.limit == 7
+
+        # ...stays the same when it doesn't...
+        mock_time.time.return_value = data_transfer.ADJUST_INTERVAL * 4
+        concurrency.adjust(800)
+        assert concurrency.limit == 7
+
+        # ...and is halved when the storage throttles requests.
+        response = requests.Response()
+        response.status_code = 503
+        concurrency.response_hook(response)
+        mock_time.time.return_value = data_transfer.ADJUST_INTERVAL * 5
+        concurrency.adjust(2000)
+        assert concurrency.limit == 3
+
+        # A fixed limit doesn't change.
+        concurrency = data_transfer.ConcurrencyLimit(4, adaptive=False)
+        concurrency.congestion()
+        for i, total in enumerate([0, 100, 300]):
+            mock_time.time.return_value = data_transfer.ADJUST_INTERVAL * i
+            concurrency.adjust(total)
+        assert concurrency.limit == concurrency.max_limit == 4
+
+    @patch('quilt.tools.data_transfer.time')
+    def test_bandwidth_limiter(self, mock_time):
+        mock_time.time.return_value = 10.0
+        limiter = data_transfer.BandwidthLimiter(1000)
+        limiter.consume(500)
+        limiter.consume(1500)
+        assert [call[0][0] for call in mock_time.sleep.call_args_list] == [0.5, 2.0]
+
+        # Unlimited.
+        mock_time.sleep.reset_mock()
+        limiter = data_transfer.BandwidthLimiter(None)
+        assert list(limiter.throttle([b'abc', b'def'])) == [b'abc', b'def']
+        assert not mock_time.sleep.called
+
+        with patch.dict(os.environ, {data_transfer.MAX_BANDWIDTH_ENV: '1.5'}):
+            assert data_transfer._max_bandwidth_rate(None) == 1.5 * 1024 * 1024
+            assert data_transfer._max_bandwidth_rate(2) == 2 * 1024 * 1024
+        with patch.dict(os.environ, {data_transfer.MAX_BANDWIDTH_ENV: ''}):
+            assert data_transfer._max_bandwidth_rate(None) is None
+
+    def _mock_s3_ranges(self, pkg_hash, contents, compress=True):
+        """
+        Mocks an S3 object that supports range requests; returns the list of requested ranges.
+        """
+        body = gzip_compress(contents) if compress else contents
+        requested = []
+
+        def _callback(request):
+            match = re.match(r'^bytes=(\d+)-(\d*)$', request.headers['Range'])
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(body) - 1
+            requested.append((start, end))
+            if start >= len(body):
+                return (416, {'Content-Range': 'bytes */%d' % len(body)}, '')
+            end = min(end, len(body) - 1)
+            headers = {'Content-Range': 'bytes %d-%d/%d' % (start, end, len(body))}
+            return (206, headers, body[start:end + 1])
+
+        self.requests_mock.add_callback(responses.GET, 'https://example.com/%s' % pkg_hash, callback=_callback)
+        return body, requested
+
+    @patch('quilt.tools.data_transfer.RANGE_PART_SIZE', 100)
+    @patch('quilt.tools.data_transfer.RANGE_DOWNLOAD_THRESHOLD', 50)
+    def test_ranged_download(self):
+        # The registry reports a size of 100; the parts past that are added once the
+        # actual size is known.
+        file_data = os.urandom(2000)
+        file_hash = hashlib.new(HASH_TYPE, file_data).hexdigest()
+        contents, contents_hash = self.make_contents(file=file_hash)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [file_hash])
+        body, requested = self._mock_s3_ranges(file_hash, file_data)
+
+        command.install('foo/bar')
+
+        teststore = PackageStore(self._store_dir)
+        with open(teststore.object_path(file_hash), 'rb') as fd:
+            assert fd.read() == file_data
+        # Every part is requested separately, covering the whole object.
+        assert len(requested) > len(body) // 100
+        assert all(end - start < 100 for start, end in requested)
+        assert sorted(requested)[0][0] == 0
+        assert not os.listdir(teststore.temporary_object_path(''))
+
+    @patch('quilt.tools.data_transfer.RANGE_PART_SIZE', 100)
+    @patch('quilt.tools.data_transfer.RANGE_DOWNLOAD_THRESHOLD', 50)
+    def test_ranged_download_uncompressed(self):
+        file_data = os.urandom(2000)
+        file_hash = hashlib.new(HASH_TYPE, file_data).hexdigest()
+        contents, contents_hash = self.make_contents(file=file_hash)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [file_hash])
+        self._mock_s3_ranges(file_hash, file_data, compress=False)
+
+        command.install('foo/bar')
+
+        teststore = PackageStore(self._store_dir)
+        with open(teststore.object_path(file_hash), 'rb') as fd:
+            assert fd.read() == file_data
+        assert not os.listdir(teststore.temporary_object_path(''))
+
+    @patch('quilt.tools.data_transfer.RANGE_PART_SIZE', 100)
+    @patch('quilt.tools.data_transfer.RANGE_DOWNLOAD_THRESHOLD', 50)
+    def test_resume_ranged_download(self):
+        file_data = os.urandom(2000)
+        file_hash = hashlib.new(HASH_TYPE, file_data).hexdigest()
+        contents, contents_hash = self.make_contents(file=file_hash)
+        body = gzip_compress(file_data)
+
+        # Parts 0 and 2 were downloaded by an earlier install.
+        teststore = PackageStore(self._store_dir)
+        teststore.create_dirs()
+        gz_path = teststore.temporary_object_path(file_hash + '.gz')
+        with open(gz_path, 'wb') as fd:
+            fd.write(body[:100] + b'\0' * 100 + body[200:300])
+        with open(gz_path + '.parts', 'w') as fd:
+            json.dump(dict(part_size=100, parts=[0, 2], compressed_size=len(body)), fd)
+
+        self._mock_tag('foo/bar', 'latest', contents_hash)
+        self._mock_package('foo/bar', contents_hash, '', contents, [file_hash])
+        _, requested = self._mock_s3_ranges(file_hash, file_data)
+
+        command.install('foo/bar')
+
+        with open(teststore.object_path(file_hash), 'rb') as fd:
+            assert fd.read() == file_data
+        starts = set(start for start, _ in requested)
+        assert 100 in starts
+        assert 0 not in starts and 200 not in starts
+        assert not os.path.exists(gz_path)
+        assert not os.path.exists(gz_path + '.parts')
+
     def test_download_retry(self):
         table_data, table_hash = self.make_table_data()
         contents, contents_hash = self.make_contents(table=table_hash)
@@ -478,9 +1221,12 @@ packages:
         ), status=status)
 
     def _mock_package(self, package, pkg_hash, subpath, contents, hashes,
-                      status=200, message=None, team=None):
+                      status=200, message=None, team=None, meta_only=False, include=(), exclude=()):
+        params = dict(subpath=subpath, include=include, exclude=exclude)
+        if meta_only:
+            params.update(meta_only='true')
         pkg_url = '%s/api/package/%s/%s?%s' % (
-            command.get_registry_url(team), package, pkg_hash, urllib.parse.urlencode(dict(subpath=subpath))
+            command.get_registry_url(team), package, pkg_hash, urllib.parse.urlencode(params, doseq=True)
         )
         self.requests_mock.add(responses.GET, pkg_url, body=json.dumps(
             dict(message=message) if message else
@@ -491,10 +1237,21 @@ packages:
             )
         , default=encode_node), match_querystring=True, status=status)
 
-    def _mock_s3(self, pkg_hash, contents):
+    def _mock_get_objects(self, hashes, team=None):
+        def _callback(request):
+            requested = [h for h in json.loads(request.body) if h in hashes]
+            return (200, {}, json.dumps(dict(
+                sizes={h: 100 for h in requested},
+                urls={h: 'https://example.com/%s' % h for h in requested}
+            )))
+
+        url = '%s/api/get_objects' % command.get_registry_url(team)
+        self.requests_mock.add_callback(responses.POST, url, callback=_callback)
+
+    def _mock_s3(self, pkg_hash, contents, compress=True):
         s3_url = 'https://example.com/%s' % pkg_hash
         headers = {
             'Content-Range': 'bytes 0-%d/%d' % (len(contents) - 1, len(contents))
         }
-        body = gzip_compress(contents)
+        body = gzip_compress(contents) if compress else contents
         self.requests_mock.add(responses.GET, s3_url, body, headers=headers)
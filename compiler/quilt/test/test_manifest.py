@@ -0,0 +1,100 @@
+"""
+Tests for the binary manifest format.
+"""
+
+import json
+
+from ..tools import manifest
+from ..tools.core import (FileNode, GroupNode, RootNode, TableNode,
+                          encode_node, find_object_hashes, hash_contents)
+from ..tools.store import PackageStore
+from .utils import QuiltTestCase
+
+
+def _make_tree():
+    return RootNode(dict(
+        README=FileNode(['%064x' % 1], dict(q_ext='md', q_path='README.md', q_target='file')),
+        data=GroupNode(dict(
+            foo=TableNode(['%064x' % 2, '%064x' % 3], 'PARQUET',
+                          dict(q_ext='csv', q_path='data/foo.csv', q_target='pandas', q_size=123)),
+            bar=FileNode(['%064x' % 4], dict(q_ext='txt', q_path='data/bar.txt', q_target='file')),
+            empty=GroupNode(dict()),
+        ), dict(note=u'\u00fcnicode')),
+        other=GroupNode(dict(
+            baz=FileNode(['%064x' % 5], dict(q_ext='', q_path='baz', q_target='file')),
+        )),
+    ))
+
+
+class ManifestTest(QuiltTestCase):
+    def test_round_trip(self):
+        tree = _make_tree()
+        data = manifest.dumps(tree)
+        assert manifest.is_binary(data)
+        assert manifest.dumps(tree) == data
+
+        contents = manifest.loads(data)
+        assert isinstance(contents, RootNode)
+        assert contents == tree
+        assert hash_contents(contents) == hash_contents(tree)
+        assert contents.children['data'].metadata == dict(note=u'\u00fcnicode')
+        assert contents.children['data'].children['foo'].metadata['q_size'] == 123
+
+        # Loaded trees can be modified and saved again.
+        contents.children['new'] = FileNode(['%064x' % 6])
+        del contents.children['other']
+        tree.children['new'] = FileNode(['%064x' % 6])
+        del tree.children['other']
+        assert manifest.loads(manifest.dumps(contents)) == tree
+
+    def test_lazy_groups(self):
+        contents = manifest.loads(manifest.dumps(_make_tree()))
+        assert contents.children['data'].children['bar'].hashes == ['%064x' % 4]
+
+        # Only the groups on the path have been decoded.
+        assert contents._is_loaded()
+        assert contents.children['data']._is_loaded()
+        assert not contents.children['data'].children['empty']._is_loaded()
+        assert not contents.children['other']._is_loaded()
+
+    def test_deep_tree(self):
+        # Deeper than the recursion limit.
+        tree = RootNode(dict())
+        group = tree
+        for _ in range(5000):
+            group.children['sub'] = GroupNode(dict())
+            group = group.children['sub']
+        group.children['file'] = FileNode(['%064x' % 1])
+
+        group = manifest.loads(manifest.dumps(tree))
+        for _ in range(5000):
+            group = group.children['sub']
+        assert group.children['file'].hashes == ['%064x' % 1]
+
+    def test_object_hashes(self):
+        tree = _make_tree()
+        data = manifest.dumps(tree)
+        expected = sorted(find_object_hashes(tree))
+        assert sorted(manifest._Reader(data).iter_object_hashes()) == expected
+
+    def test_json(self):
+        tree = _make_tree()
+        data = json.dumps(tree, default=encode_node, indent=2, sort_keys=True).encode('utf-8')
+        assert not manifest.is_binary(data)
+        assert manifest.loads(data) == tree
+
+    def test_bad_hash(self):
+        for bad_hash in ['123', '%064X' % 0xabc, 'x' * 64]:
+            with self.assertRaises(manifest.ManifestException):
+                manifest.dumps(RootNode(dict(foo=FileNode([bad_hash]))))
+
+    def test_package_getitem(self):
+        store = PackageStore(self._store_dir)
+        package = store.install_package(None, 'test', 'manifest', _make_tree())
+        package.save_contents()
+
+        package = store.get_package(None, 'test', 'manifest')
+        assert package['data/foo'].hashes == ['%064x' % 2, '%064x' % 3]
+        assert not package.get_contents().children['other']._is_loaded()
+        assert 'data/empty' in package
+        assert 'data/missing' not in package
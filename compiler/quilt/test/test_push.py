@@ -2,15 +2,20 @@
 Tests for the push command.
 """
 
+import gzip
 import json
 import os
+import re
 
+import pytest
 import responses
+from six import BytesIO
 
-from quilt.tools import command, store
+from quilt.tools import command, data_transfer, store
 from quilt.tools.core import find_object_hashes
+from quilt.tools.util import have_zstd, zstd_decompress
 
-from .utils import QuiltTestCase
+from .utils import QuiltTestCase, patch
 
 
 class PushTest(QuiltTestCase):
@@ -59,10 +64,476 @@ class PushTest(QuiltTestCase):
         # Push it again; this time, we're verifying that there are no s3 uploads.
         command.push('foo/bar')
 
-    def _mock_put_package(self, package, pkg_hash, upload_urls):
+    def _build_and_mock_upload(self, build_path=None, zstd_uploaded=None):
+        if build_path is None:
+            mydir = os.path.dirname(__file__)
+            build_path = os.path.join(mydir, './build_simple.yml')
+        command.build('foo/bar', build_path)
+
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+        pkg_hash = pkg_obj.get_hash()
+        all_hashes = set(find_object_hashes(pkg_obj.get_contents()))
+        upload_urls = {
+            blob_hash: dict(
+                head="https://example.com/head/{owner}/{hash}".format(owner='foo', hash=blob_hash),
+                put="https://example.com/put/{owner}/{hash}".format(owner='foo', hash=blob_hash)
+            ) for blob_hash in all_hashes
+        }
+        if zstd_uploaded is not None:
+            # The registry asks for zstd'ed copies, too.
+            for blob_hash, urls in upload_urls.items():
+                urls['zstd_put'] = "https://example.com/put/{owner}/{hash}.zst".format(owner='foo', hash=blob_hash)
+
+        uploaded = {}
+
+        def _put_callback(request):
+            body = request.body
+            if not isinstance(body, bytes):
+                body = body.read() if hasattr(body, 'read') else b''.join(body)
+            if request.headers.get('Content-Encoding') == 'gzip':
+                with gzip.GzipFile(fileobj=BytesIO(body)) as gzip_file:
+                    uploaded[request.url] = gzip_file.read()
+            else:
+                uploaded[request.url] = body
+            return (200, {}, '')
+
+        for blob_hash in all_hashes:
+            urls = upload_urls[blob_hash]
+            self.requests_mock.add(responses.HEAD, urls['head'], status=404)
+            self.requests_mock.add_callback(responses.PUT, urls['put'], callback=_put_callback)
+
+        def _zstd_put_callback(request):
+            body = request.body
+            if not isinstance(body, bytes):
+                body = body.read() if hasattr(body, 'read') else b''.join(body)
+            assert 'Content-Encoding' not in request.headers
+            zstd_uploaded[request.url] = zstd_decompress(body)
+            return (200, {}, '')
+
+        if zstd_uploaded is not None:
+            for urls in upload_urls.values():
+                self.requests_mock.add_callback(responses.PUT, urls['zstd_put'], callback=_zstd_put_callback)
+
+        self._mock_put_package('foo/bar', pkg_hash, upload_urls)
+        self._mock_put_tag('foo/bar', 'latest')
+        return pkg_obj, upload_urls, uploaded
+
+    def _check_uploaded(self, pkg_obj, upload_urls, uploaded):
+        assert len(uploaded) == len(upload_urls)
+        for blob_hash, urls in upload_urls.items():
+            with open(pkg_obj.get_store().object_path(blob_hash), 'rb') as fd:
+                assert uploaded[urls['put']] == fd.read()
+
+    @patch('quilt.tools.data_transfer.MULTIPART_PART_SIZE', 100)
+    @patch('quilt.tools.data_transfer.COMPRESSION_BLOCK_SIZE', 50)
+    def test_push_stream(self):
+        mydir = os.path.dirname(__file__)
+        command.build('foo/bar', os.path.join(mydir, './build_simple.yml'))
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+
+        # Every object is uploaded in parts, each with its own length; none in a chunked request.
+        uploaded_parts, start_requests = self._mock_multipart_upload(pkg_obj)
+        command.push('foo/bar', stream=True)
+
+        assert len(start_requests) == len(set(find_object_hashes(pkg_obj.get_contents())))
+        for call in self.requests_mock.calls:
+            if call.request.method == 'PUT':
+                assert 'Transfer-Encoding' not in call.request.headers
+        self._check_parts(pkg_obj, uploaded_parts)
+
+    def test_push_cache_compressed(self):
+        pkg_obj, upload_urls, uploaded = self._build_and_mock_upload()
+        command.push('foo/bar', cache_compressed=True)
+        self._check_uploaded(pkg_obj, upload_urls, uploaded)
+
+        pkg_store = pkg_obj.get_store()
+        for blob_hash in upload_urls:
+            assert os.path.exists(pkg_store.compressed_object_path(blob_hash))
+
+        # Pushing again uses the compressed copies.
+        self.requests_mock.reset()
+        pkg_obj, upload_urls, uploaded = self._build_and_mock_upload()
+        with patch('quilt.tools.data_transfer.gzip_chunks') as gzip_chunks:
+            command.push('foo/bar', cache_compressed=True)
+        assert not gzip_chunks.called
+        self._check_uploaded(pkg_obj, upload_urls, uploaded)
+
+    def _make_mixed_dir(self):
+        """
+        Creates a directory with a file that compresses well, and one that doesn't.
+        """
+        data_dir = os.path.join(self._test_dir, 'mixed')
+        os.mkdir(data_dir)
+        with open(os.path.join(data_dir, 'text.txt'), 'wb') as fd:
+            fd.write(b'hello world\n' * 1000)
+        with open(os.path.join(data_dir, 'random.bin'), 'wb') as fd:
+            fd.write(os.urandom(10000))
+        return data_dir
+
+    def test_push_uncompressed(self):
+        pkg_obj, upload_urls, uploaded = self._build_and_mock_upload(self._make_mixed_dir())
+        command.push('foo/bar')
+        self._check_uploaded(pkg_obj, upload_urls, uploaded)
+
+        encodings = {
+            call.request.url: call.request.headers.get('Content-Encoding')
+            for call in self.requests_mock.calls if call.request.method == 'PUT'
+        }
+        pkg_store = pkg_obj.get_store()
+        for blob_hash, urls in upload_urls.items():
+            with open(pkg_store.object_path(blob_hash), 'rb') as fd:
+                compressible = fd.read(5) == b'hello'
+            assert encodings[urls['put']] == ('gzip' if compressible else None)
+
+    def test_should_compress(self):
+        data_dir = self._make_mixed_dir()
+        assert data_transfer._should_compress(os.path.join(data_dir, 'text.txt'))
+        assert not data_transfer._should_compress(os.path.join(data_dir, 'random.bin'))
+
+        # Anything that looks gzip'ed or zstd'ed gets compressed, so downloads can tell the difference.
+        gz_path = os.path.join(data_dir, 'random.bin.gz')
+        with open(gz_path, 'wb') as fd:
+            fd.write(b'\x1f\x8b' + os.urandom(10000))
+        assert data_transfer._should_compress(gz_path)
+        zst_path = os.path.join(data_dir, 'random.bin.zst')
+        with open(zst_path, 'wb') as fd:
+            fd.write(b'\x28\xb5\x2f\xfd' + os.urandom(10000))
+        assert data_transfer._should_compress(zst_path)
+
+    @patch('quilt.tools.data_transfer.PARALLEL_COMPRESSION_THRESHOLD', 0)
+    @patch('quilt.tools.data_transfer.COMPRESSION_BLOCK_SIZE', 100)
+    def test_push_parallel_compression(self):
+        pkg_obj, upload_urls, uploaded = self._build_and_mock_upload()
+        command.push('foo/bar')
+        self._check_uploaded(pkg_obj, upload_urls, uploaded)
+
+    @patch('quilt.tools.data_transfer.PARALLEL_COMPRESSION_THRESHOLD', 0)
+    @patch('quilt.tools.data_transfer.COMPRESSION_BLOCK_SIZE', 100)
+    def test_gzip_chunks_parallel(self):
+        path = os.path.join(self._test_dir, 'data.txt')
+        with open(path, 'wb') as fd:
+            fd.write(b'hello world\n' * 100)
+
+        with open(path, 'rb') as fd:
+            chunks = list(data_transfer.gzip_chunks(fd))
+        # One gzip member per block, in order.
+        assert len(chunks) == 12
+        assert all(chunk.startswith(b'\x1f\x8b') for chunk in chunks)
+        with gzip.GzipFile(fileobj=BytesIO(b''.join(chunks))) as gzip_file:
+            assert gzip_file.read() == b'hello world\n' * 100
+
+        # Empty files still produce a valid gzip file.
+        empty_path = os.path.join(self._test_dir, 'empty.txt')
+        open(empty_path, 'wb').close()
+        with open(empty_path, 'rb') as fd:
+            data = b''.join(data_transfer.gzip_chunks(fd))
+        with gzip.GzipFile(fileobj=BytesIO(data)) as gzip_file:
+            assert gzip_file.read() == b''
+
+    @pytest.mark.skipif(not have_zstd(), reason="zstandard is not installed")
+    def test_push_zstd(self):
+        mydir = os.path.dirname(__file__)
+        command.build('foo/bar', os.path.join(mydir, './build_simple.yml'))
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+        upload_urls = {
+            blob_hash: dict(head="https://example.com/head/%s" % blob_hash, exists=True)
+            for blob_hash in find_object_hashes(pkg_obj.get_contents())
+        }
+        self._mock_put_package('foo/bar', pkg_obj.get_hash(), upload_urls, accept_encoding='zstd, gzip')
+        self._mock_put_tag('foo/bar', 'latest')
+
+        command.push('foo/bar')
+
+        # The dry run is gzip'ed, since the registry's encodings aren't known yet; the real push uses zstd.
+        pkg_requests = [call.request for call in self.requests_mock.calls if '/api/package/' in call.request.url]
+        assert [request.headers['Content-Encoding'] for request in pkg_requests] == ['gzip', 'zstd']
+        data = json.loads(zstd_decompress(pkg_requests[1].body).decode('utf-8'))
+        assert not data['dry_run']
+
+    @pytest.mark.skipif(not have_zstd(), reason="zstandard is not installed")
+    def test_push_zstd_copies(self):
+        zstd_uploaded = {}
+        pkg_obj, upload_urls, uploaded = self._build_and_mock_upload(self._make_mixed_dir(), zstd_uploaded)
+        command.push('foo/bar')
+        self._check_uploaded(pkg_obj, upload_urls, uploaded)
+
+        # Only the objects that compress well get a zstd'ed copy.
+        pkg_store = pkg_obj.get_store()
+        compressible = set()
+        for blob_hash, urls in upload_urls.items():
+            with open(pkg_store.object_path(blob_hash), 'rb') as fd:
+                data = fd.read()
+            if data.startswith(b'hello'):
+                compressible.add(blob_hash)
+                assert zstd_uploaded[urls['zstd_put']] == data
+            else:
+                assert urls['zstd_put'] not in zstd_uploaded
+                self.requests_mock.remove(responses.PUT, urls['zstd_put'])
+        assert compressible and len(compressible) < len(upload_urls)
+
+        # The registry is told which ones.
+        pkg_requests = [call.request for call in self.requests_mock.calls if '/api/package/' in call.request.url]
+        data = json.loads(gzip.GzipFile(fileobj=BytesIO(pkg_requests[-1].body)).read().decode('utf-8'))
+        assert data['encodings'] == {blob_hash: 'zstd' for blob_hash in compressible}
+
+    def test_push_skip_existing(self):
+        mydir = os.path.dirname(__file__)
+        command.build('foo/bar', os.path.join(mydir, './build_simple_nest.yml'))
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+        pkg_hash = pkg_obj.get_hash()
+        all_hashes = sorted(find_object_hashes(pkg_obj.get_contents()))
+        assert len(all_hashes) == 2
+
+        # The registry already has the first fragment, so there's no HEAD or PUT for it.
+        existing_hash, new_hash = all_hashes
+        upload_urls = {
+            existing_hash: dict(exists=True),
+            new_hash: dict(
+                head="https://example.com/head/{owner}/{hash}".format(owner='foo', hash=new_hash),
+                put="https://example.com/put/{owner}/{hash}".format(owner='foo', hash=new_hash)
+            )
+        }
+        self.requests_mock.add(responses.HEAD, upload_urls[new_hash]['head'], status=404)
+        self.requests_mock.add(responses.PUT, upload_urls[new_hash]['put'])
+        self._mock_put_package('foo/bar', pkg_hash, upload_urls)
+        self._mock_put_tag('foo/bar', 'latest')
+
+        command.push('foo/bar', verify_existing=True)
+
+        pkg_requests = [call.request for call in self.requests_mock.calls if '/api/package/' in call.request.url]
+        dry_run = json.loads(gzip.GzipFile(fileobj=BytesIO(pkg_requests[0].body)).read().decode('utf-8'))
+        assert dry_run['dry_run'] and dry_run['skip_existing'] and dry_run['verify_existing']
+        assert set(dry_run['sizes']) == set(all_hashes)
+        urls = [call.request.url for call in self.requests_mock.calls]
+        assert not any(existing_hash in url for url in urls)
+
+    def test_push_old_registry(self):
+        # Registries that predate `skip_existing` reject it, like any unknown field.
+        mydir = os.path.dirname(__file__)
+        command.build('foo/bar', os.path.join(mydir, './build_simple.yml'))
+        pkg_hash = store.PackageStore.find_package(None, 'foo', 'bar').get_hash()
+        pkg_url = '%s/api/package/foo/bar/%s' % (command.get_registry_url(None), pkg_hash)
+        self.requests_mock.add(responses.PUT, pkg_url, status=400, body=json.dumps(dict(
+            message="Additional properties are not allowed ('skip_existing', 'verify_existing' were unexpected)"
+        )))
+        pkg_obj, upload_urls, uploaded = self._build_and_mock_upload()
+
+        command.push('foo/bar')
+        self._check_uploaded(pkg_obj, upload_urls, uploaded)
+
+        pkg_requests = [call.request for call in self.requests_mock.calls if '/api/package/' in call.request.url]
+        dry_runs = [json.loads(gzip.GzipFile(fileobj=BytesIO(request.body)).read().decode('utf-8'))
+                    for request in pkg_requests[:2]]
+        assert dry_runs[0]['skip_existing']
+        assert 'skip_existing' not in dry_runs[1] and 'verify_existing' not in dry_runs[1]
+
+    def test_push_resume(self):
+        mydir = os.path.dirname(__file__)
+        command.build('foo/bar', os.path.join(mydir, './build_simple_nest.yml'))
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+        pkg_hash = pkg_obj.get_hash()
+        done_hash, failed_hash = sorted(find_object_hashes(pkg_obj.get_contents()))
+        upload_urls = {
+            blob_hash: dict(
+                head="https://example.com/head/{owner}/{hash}".format(owner='foo', hash=blob_hash),
+                put="https://example.com/put/{owner}/{hash}".format(owner='foo', hash=blob_hash)
+            ) for blob_hash in [done_hash, failed_hash]
+        }
+
+        # The second fragment fails to upload.
+        for blob_hash in upload_urls:
+            self.requests_mock.add(responses.HEAD, upload_urls[blob_hash]['head'], status=404)
+        self.requests_mock.add(responses.PUT, upload_urls[done_hash]['put'])
+        self.requests_mock.add(responses.PUT, upload_urls[failed_hash]['put'], status=403)
+        self._mock_put_package('foo/bar', pkg_hash, upload_urls)
+
+        with self.assertRaises(command.CommandException):
+            command.push('foo/bar')
+
+        journal_path = pkg_obj.get_store().journal_path('push', None, 'foo', 'bar')
+        assert os.path.exists(journal_path)
+
+        # Resuming uploads the second fragment, with the saved URLs: no dry run, and no HEAD for the first one.
+        self.requests_mock.reset()
+        self.requests_mock.add(responses.HEAD, upload_urls[failed_hash]['head'], status=404)
+        self.requests_mock.add(responses.PUT, upload_urls[failed_hash]['put'])
+        self._mock_put_package('foo/bar', pkg_hash, upload_urls, dry_run=False)
+        self._mock_put_tag('foo/bar', 'latest')
+
+        command.push('foo/bar', resume=True)
+
+        urls = [call.request.url for call in self.requests_mock.calls]
+        assert not any(done_hash in url for url in urls)
+        assert len([url for url in urls if '/api/package/' in url]) == 1
+        assert not os.path.exists(journal_path)
+
+    def test_push_resume_expired_urls(self):
+        mydir = os.path.dirname(__file__)
+        command.build('foo/bar', os.path.join(mydir, './build_simple_nest.yml'))
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+        pkg_hash = pkg_obj.get_hash()
+        done_hash, pending_hash = sorted(find_object_hashes(pkg_obj.get_contents()))
+
+        journal = data_transfer.TransferJournal(pkg_obj.get_store().journal_path('push', None, 'foo', 'bar'))
+        journal.start(dict(package='foo/bar', hash=pkg_hash))
+        journal.add_urls({done_hash: dict(), pending_hash: dict()}, {})
+        journal.object_done(done_hash)
+
+        # The URLs are requested again, but only the pending fragment gets uploaded.
+        upload_urls = {
+            blob_hash: dict(
+                head="https://example.com/head/{owner}/{hash}".format(owner='foo', hash=blob_hash),
+                put="https://example.com/put/{owner}/{hash}".format(owner='foo', hash=blob_hash)
+            ) for blob_hash in [done_hash, pending_hash]
+        }
+        self.requests_mock.add(responses.HEAD, upload_urls[pending_hash]['head'], status=404)
+        self.requests_mock.add(responses.PUT, upload_urls[pending_hash]['put'])
+        self._mock_put_package('foo/bar', pkg_hash, upload_urls)
+        self._mock_put_tag('foo/bar', 'latest')
+
+        with patch('quilt.tools.data_transfer.JOURNAL_URL_LIFETIME', -1):
+            command.push('foo/bar', resume=True)
+
+        urls = [call.request.url for call in self.requests_mock.calls]
+        assert not any(done_hash in url for url in urls)
+
+    def _mock_multipart_upload(self, pkg_obj, failed_parts=()):
+        """
+        Mocks the S3 HEAD requests, the registry's multipart upload endpoints, and
+        the part uploads; returns the list of uploaded parts and the upload requests.
+        """
+        pkg_hash = pkg_obj.get_hash()
+        all_hashes = set(find_object_hashes(pkg_obj.get_contents()))
+        upload_urls = {
+            blob_hash: dict(
+                head="https://example.com/head/{owner}/{hash}".format(owner='foo', hash=blob_hash),
+                put="https://example.com/put/{owner}/{hash}".format(owner='foo', hash=blob_hash)
+            ) for blob_hash in all_hashes
+        }
+        for blob_hash in all_hashes:
+            self.requests_mock.add(responses.HEAD, upload_urls[blob_hash]['head'], status=404)
+        self._mock_put_package('foo/bar', pkg_hash, upload_urls)
+        self._mock_put_tag('foo/bar', 'latest')
+
+        blob_url = '%s/api/blob/foo/' % command.get_registry_url(None)
+        uploaded_parts = []
+        start_requests = []
+
+        def _start_callback(request):
+            blob_hash = request.url.split('/')[-2]
+            data = json.loads(request.body)
+            start_requests.append(data)
+            urls = [
+                'https://example.com/part/%s/%d' % (blob_hash, part_number)
+                for part_number in range(1, data['parts'] + 1)
+            ]
+            return (200, {}, json.dumps(dict(upload_id=data.get('upload_id', 'id-' + blob_hash), urls=urls)))
+
+        def _part_callback(request):
+            blob_hash, part_number = request.url.split('/')[-2:]
+            if int(part_number) in failed_parts:
+                return (403, {}, '')
+            uploaded_parts.append((blob_hash, int(part_number), request.body))
+            return (200, {'ETag': '"%s-%s"' % (blob_hash, part_number)}, '')
+
+        def _complete_callback(request):
+            path = request.url.split('/')
+            blob_hash, upload_id = path[-4], path[-2]
+            assert upload_id == 'id-' + blob_hash
+            parts = json.loads(request.body)['parts']
+            assert [part['etag'] for part in parts] == [
+                '"%s-%d"' % (blob_hash, part_number) for part_number in range(1, len(parts) + 1)
+            ]
+            return (200, {}, json.dumps(dict()))
+
+        self.requests_mock.add_callback(responses.POST, re.compile(re.escape(blob_url) + r'\w+/multipart$'),
+                                        callback=_start_callback)
+        self.requests_mock.add_callback(responses.PUT, re.compile(r'https://example.com/part/'),
+                                        callback=_part_callback)
+        self.requests_mock.add_callback(responses.POST, re.compile(re.escape(blob_url) + r'\w+/multipart/.+/complete$'),
+                                        callback=_complete_callback)
+        return uploaded_parts, start_requests
+
+    def _check_parts(self, pkg_obj, uploaded_parts):
+        pkg_store = pkg_obj.get_store()
+        for blob_hash in set(find_object_hashes(pkg_obj.get_contents())):
+            parts = sorted((part_number, data) for obj_hash, part_number, data in uploaded_parts
+                           if obj_hash == blob_hash)
+            data = b''.join(data for _, data in parts)
+            if data.startswith(b'\x1f\x8b'):
+                with gzip.GzipFile(fileobj=BytesIO(data)) as gzip_file:
+                    data = gzip_file.read()
+            with open(pkg_store.object_path(blob_hash), 'rb') as fd:
+                assert data == fd.read()
+            assert not os.path.exists(pkg_store.temporary_object_path(blob_hash + '.upload'))
+            assert not os.path.exists(pkg_store.temporary_object_path(blob_hash + '.upload.gz'))
+
+    @patch('quilt.tools.data_transfer.MULTIPART_UPLOAD_THRESHOLD', 0)
+    @patch('quilt.tools.data_transfer.MULTIPART_PART_SIZE', 100)
+    @patch('quilt.tools.data_transfer.COMPRESSION_BLOCK_SIZE', 50)
+    def test_push_multipart(self):
+        mydir = os.path.dirname(__file__)
+        command.build('foo/bar', os.path.join(mydir, './build_simple.yml'))
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+
+        uploaded_parts, start_requests = self._mock_multipart_upload(pkg_obj)
+        command.push('foo/bar')
+
+        # The registry is asked for enough URLs for the largest possible compressed size.
+        assert len(uploaded_parts) <= sum(request['parts'] for request in start_requests)
+        assert len(uploaded_parts) > len(start_requests)
+        # Each part is made of whole gzip members.
+        for _, _, data in uploaded_parts:
+            assert data.startswith(b'\x1f\x8b')
+        self._check_parts(pkg_obj, uploaded_parts)
+
+    @patch('quilt.tools.data_transfer.MULTIPART_UPLOAD_THRESHOLD', 0)
+    @patch('quilt.tools.data_transfer.MULTIPART_PART_SIZE', 100)
+    @patch('quilt.tools.data_transfer.COMPRESSION_BLOCK_SIZE', 50)
+    def test_push_multipart_uncompressed(self):
+        command.build('foo/bar', self._make_mixed_dir())
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+
+        uploaded_parts, start_requests = self._mock_multipart_upload(pkg_obj)
+        command.push('foo/bar')
+
+        # Only the random data is uploaded as it is, and the registry is told so.
+        assert sorted(request.get('compressed', True) for request in start_requests) == [False, True]
+        self._check_parts(pkg_obj, uploaded_parts)
+
+    @patch('quilt.tools.data_transfer.MULTIPART_UPLOAD_THRESHOLD', 0)
+    @patch('quilt.tools.data_transfer.MULTIPART_PART_SIZE', 100)
+    @patch('quilt.tools.data_transfer.COMPRESSION_BLOCK_SIZE', 50)
+    def test_push_multipart_resume(self):
+        mydir = os.path.dirname(__file__)
+        command.build('foo/bar', os.path.join(mydir, './build_simple.yml'))
+        pkg_obj = store.PackageStore.find_package(None, 'foo', 'bar')
+
+        # The second part of each object fails, even after retries.
+        uploaded_parts, _ = self._mock_multipart_upload(pkg_obj, failed_parts=[2])
+        with self.assertRaises(command.CommandException):
+            command.push('foo/bar')
+        first_parts = list(uploaded_parts)
+        assert all(part_number != 2 for _, part_number, _ in first_parts)
+
+        # Pushing again continues the same uploads from the missing part; the parts after it
+        # are compressed again, since their boundaries depend on where compression started.
+        self.requests_mock.reset()
+        uploaded_parts, start_requests = self._mock_multipart_upload(pkg_obj)
+        command.push('foo/bar')
+
+        assert all(request['upload_id'] for request in start_requests)
+        assert all(part_number >= 2 for _, part_number, _ in uploaded_parts)
+        first_parts = [part for part in first_parts if part[1] == 1]
+        self._check_parts(pkg_obj, first_parts + uploaded_parts)
+
+    def _mock_put_package(self, package, pkg_hash, upload_urls, dry_run=True, accept_encoding=None):
         pkg_url = '%s/api/package/%s/%s' % (command.get_registry_url(None), package, pkg_hash)
         # Dry run, then the real thing.
-        self.requests_mock.add(responses.PUT, pkg_url, json.dumps(dict(upload_urls=upload_urls)))
+        if dry_run:
+            headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+            self.requests_mock.add(responses.PUT, pkg_url, json.dumps(dict(upload_urls=upload_urls)),
+                                   adding_headers=headers)
         self.requests_mock.add(responses.PUT, pkg_url, json.dumps(dict(package_url='https://example.com/')))
 
     def _mock_put_tag(self, package, tag):
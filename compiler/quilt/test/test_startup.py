@@ -0,0 +1,53 @@
+"""
+Tests that `import quilt` and the CLI don't load heavy dependencies up front.
+"""
+
+import os
+import subprocess
+import sys
+
+import pkg_resources
+
+from .. import _CONSOLE_SCRIPTS
+from ..tools.const import PACKAGE_DIR_NAME
+from .utils import BasicQuiltTestCase
+
+HEAVY_MODULES = ['numpy', 'pandas', 'pkg_resources', 'pyarrow', 'requests', 'tqdm', 'yaml',
+                 'quilt.tools.build', 'quilt.tools.data_transfer']
+
+CHILD_CODE = """
+import sys
+import quilt
+from quilt.tools import main
+main.argument_parser()
+print(' '.join(name for name in sys.argv[1:] if name in sys.modules))
+"""
+
+BENCH_STARTUP = os.path.join(os.path.dirname(__file__), '..', '..', 'benchmarks', 'bench_startup.py')
+# Milliseconds; generous, so that it only catches a heavy dependency imported at module level again.
+STARTUP_BUDGET = 1500
+
+
+class StartupTest(BasicQuiltTestCase):
+    def test_lazy_imports(self):
+        output = subprocess.check_output([sys.executable, '-c', CHILD_CODE] + HEAVY_MODULES)
+        assert output.decode().split() == []
+
+    def test_ls(self):
+        # Listing packages only needs the store.
+        env = dict(os.environ, QUILT_PRIMARY_PACKAGE_DIR=os.path.join(self._test_dir, PACKAGE_DIR_NAME))
+        code = "from quilt.tools import command; command.ls()\n" + CHILD_CODE
+        output = subprocess.check_output([sys.executable, '-c', code] + HEAVY_MODULES, env=env)
+        assert output.decode().splitlines()[-1].split() == []
+
+    def test_console_scripts(self):
+        # `_CONSOLE_SCRIPTS` has to be kept in sync with setup.py.
+        entry_map = pkg_resources.get_distribution('quilt').get_entry_map('console_scripts')
+        assert sorted(_CONSOLE_SCRIPTS) == sorted(entry_map)
+
+    def test_startup_budget(self):
+        if not os.path.exists(BENCH_STARTUP):
+            self.skipTest("Not running from a source checkout")
+        returncode = subprocess.call([sys.executable, BENCH_STARTUP, '--runs', '3',
+                                      '--budget', str(STARTUP_BUDGET)])
+        assert returncode == 0
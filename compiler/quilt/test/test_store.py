@@ -4,9 +4,13 @@ Tests for the package store.
 
 import os
 import shutil
+import time
 
+from ..tools import catalog
+from ..tools.const import DEFAULT_TEAM
+from ..tools.core import RootNode
 from ..tools.store import PackageStore, StoreException
-from .utils import QuiltTestCase
+from .utils import QuiltTestCase, patch
 
 class StoreTest(QuiltTestCase):
     def test_old_format(self):
@@ -28,6 +32,110 @@ class StoreTest(QuiltTestCase):
         pkg = PackageStore.find_package(None, 'test', 'simple')
         assert pkg is not None
 
-        # We now have a new version.
+        # We now have a new version, which older clients can still read.
         with open(os.path.join(self._store_dir, '.format')) as fd:
+            assert fd.read() == PackageStore.LEGACY_VERSION
+
+    def test_format_upgrade(self):
+        shared_dir = os.path.join(self._test_dir, 'shared', 'quilt_packages')
+        for store_dir in [self._store_dir, shared_dir]:
+            os.makedirs(store_dir)
+            with open(os.path.join(store_dir, '.format'), 'w') as fd:
+                fd.write('1.3')
+
+        # Opening a store doesn't change its version.
+        for store_dir in [self._store_dir, shared_dir]:
+            store = PackageStore(store_dir)
+            assert store.get_catalog() == {}
+            with open(os.path.join(store_dir, '.format')) as fd:
+                assert fd.read() == '1.3'
+
+        # Writing a binary manifest to the primary store does; but not to other stores.
+        for store_dir in [self._store_dir, shared_dir]:
+            store = PackageStore(store_dir)
+            store.install_package(None, 'test', 'upgrade', RootNode(dict())).save_contents()
+        with open(os.path.join(self._store_dir, '.format')) as fd:
+            assert fd.read() == PackageStore.VERSION
+        with open(os.path.join(shared_dir, '.format')) as fd:
             assert fd.read() == '1.3'
+
+    def test_catalog(self):
+        store = PackageStore(self._store_dir)
+        package = store.install_package(None, 'test', 'catalog', RootNode(dict()))
+        package.save_contents()
+        pkghash = package.get_hash()
+
+        # Saving a package updates the catalog.
+        assert store.get_catalog() == {
+            catalog.package_key(None, 'test', 'catalog'): dict(tags=dict(latest=pkghash), instances=[pkghash])
+        }
+        assert store.find_instance(None, 'test', 'catalog') == pkghash
+        assert store.find_instance(None, 'test', 'catalog', hash_prefix=pkghash[:6]) == pkghash
+        assert store.ls_packages() == [('test/catalog', 'latest', pkghash)]
+
+        # A missing or corrupt catalog gets rebuilt from the package directories.
+        catalog_path = os.path.join(self._store_dir, catalog.CATALOG_FILE)
+        expected = store.get_catalog()
+        os.remove(catalog_path)
+        assert store.get_catalog() == expected
+        with open(catalog_path, 'w') as fd:
+            fd.write('{')
+        assert store.get_catalog() == expected
+        assert os.path.exists(catalog_path)
+
+        # Removing a package updates the catalog.
+        store.remove_package(None, 'test', 'catalog')
+        assert store.get_catalog() == {}
+        assert store.ls_packages() == []
+        assert PackageStore.find_package(None, 'test', 'catalog') is None
+
+    def test_catalog_external_change(self):
+        store = PackageStore(self._store_dir)
+        store.install_package(None, 'test', 'catalog', RootNode(dict())).save_contents()
+        assert catalog.package_key(None, 'test', 'catalog') in store.get_catalog()
+
+        # Another process replaces the catalog: the cached copy is discarded.
+        packages = dict(store.get_catalog())
+        packages[catalog.package_key(None, 'test', 'other')] = dict(tags={}, instances=[])
+        pkgs_path = os.path.join(self._store_dir, PackageStore.PKG_DIR)
+        catalog._write(self._store_dir, packages, catalog._pkgs_mtime(pkgs_path))
+        assert catalog.package_key(None, 'test', 'other') in store.get_catalog()
+
+    def test_catalog_pkgs_change(self):
+        store = PackageStore(self._store_dir)
+        store.install_package(None, 'test', 'catalog', RootNode(dict())).save_contents()
+        assert store.get_catalog() != {}
+
+        # Packages removed without going through the store (e.g., by an older client).
+        time.sleep(0.01)
+        shutil.rmtree(os.path.join(self._store_dir, PackageStore.PKG_DIR, DEFAULT_TEAM, 'test'))
+        assert store.get_catalog() == {}
+
+    def test_catalog_read_only(self):
+        store = PackageStore(self._store_dir)
+        store.install_package(None, 'test', 'catalog', RootNode(dict())).save_contents()
+        os.remove(os.path.join(self._store_dir, catalog.CATALOG_FILE))
+
+        # The catalog can't be saved, but it's cached until the package directories change.
+        with patch('quilt.tools.catalog._write', return_value=False), \
+                patch('quilt.tools.catalog._scan', side_effect=catalog._scan) as scan:
+            assert catalog.package_key(None, 'test', 'catalog') in store.get_catalog()
+            assert store.find_instance(None, 'test', 'catalog') is not None
+            assert scan.call_count == 1
+
+            time.sleep(0.01)
+            shutil.rmtree(os.path.join(self._store_dir, PackageStore.PKG_DIR, DEFAULT_TEAM, 'test'))
+            assert store.get_catalog() == {}
+            assert scan.call_count == 2
+
+    def test_catalog_lock(self):
+        store = PackageStore(self._store_dir)
+        store.create_dirs()
+        lock_path = os.path.join(self._store_dir, catalog.LOCK_FILE)
+
+        # A lock left behind by a crashed process gets broken.
+        open(lock_path, 'w').close()
+        os.utime(lock_path, (0, 0))
+        store.install_package(None, 'test', 'catalog', RootNode(dict())).save_contents()
+        assert catalog.package_key(None, 'test', 'catalog') in store.get_catalog()
+        assert not os.path.exists(lock_path)
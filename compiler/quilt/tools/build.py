@@ -1,16 +1,18 @@
 """
 parse build file, serialize package
 """
-from collections import defaultdict, Iterable
+from collections import defaultdict, namedtuple, Iterable
 import glob
 import json
 import os
 import re
+import time
 
+from enum import Enum
 import numpy as np
 import pandas as pd
 from pandas import DataFrame as df
-from six import iteritems, string_types
+from six import iteritems, itervalues, string_types
 
 import yaml
 from tqdm import tqdm
@@ -18,10 +20,11 @@ from tqdm import tqdm
 from .compat import pathlib
 from .const import (DEFAULT_BUILDFILE, PANDAS_PARSERS, DEFAULT_QUILT_YML, PACKAGE_DIR_NAME, RESERVED,
                     QuiltException, TargetType)
-from .core import GroupNode
+from .core import FileNode, GroupNode, TableNode
 from .hashing import digest_file, digest_string
 from .store import PackageStore, ParquetLib, StoreException
-from .util import FileWithReadProgress, is_nodename, to_nodename, to_identifier, parse_package
+from .util import (FileWithReadProgress, is_nodename, to_nodename, to_identifier, parse_package,
+                   format_bytes)
 
 from . import check_functions as qc            # pylint:disable=W0611
 
@@ -49,6 +52,110 @@ def _have_pyspark():
     return _have_pyspark.flag
 _have_pyspark.flag = None
 
+WATCH_INTERVAL = 1.0  # seconds between polls of the sources in `quilt build --watch`
+
+ID = 'id' # pylint:disable=C0103
+PARQUET = 'parquet' # pylint:disable=C0103
+
+
+class PlanAction(Enum):
+    """
+    How a leaf node compares with the package's current contents
+    """
+    UNCHANGED = 'unchanged'
+    CHANGED = 'changed'
+    NEW = 'new'
+    REMOVED = 'removed'
+
+
+PlanEntry = namedtuple("PlanEntry", "node_path, action, hashes, parse_size, write_size")
+
+
+class BuildPlan(object):
+    """
+    Result of comparing a build file against the build cache and the
+    current contents of the package being built.
+
+    Leaves whose objects are already in the store are reused by their hashes;
+    everything else gets parsed and written again.
+    """
+    def __init__(self, leaves, contents=None):
+        """
+        :param leaves: list of (node_path, hashes, node, parse_size, write_size) for every
+            leaf in the build file; hashes are None if the leaf needs to be rebuilt,
+            node is the core node of an included package
+        :param contents: current contents of the package, if it exists
+        """
+        self.entries = []
+        self._reusable = {}
+
+        planned = set()
+        for node_path, hashes, node, parse_size, write_size in leaves:
+            path = '/'.join(node_path)
+            planned.add(path)
+            existing = _find_node(contents, node_path)
+            if existing is None:
+                action = PlanAction.NEW
+            elif node is not None:
+                action = PlanAction.UNCHANGED if node == existing else PlanAction.CHANGED
+            elif hashes is not None and getattr(existing, 'hashes', None) == hashes:
+                action = PlanAction.UNCHANGED
+            else:
+                action = PlanAction.CHANGED
+
+            if hashes is not None:
+                self._reusable[path] = hashes
+            self.entries.append(PlanEntry(node_path, action, hashes, parse_size, write_size))
+
+        for node_path in _iter_leaf_paths(contents):
+            if not any('/'.join(node_path[:i]) in planned for i in range(1, len(node_path) + 1)):
+                self.entries.append(PlanEntry(node_path, PlanAction.REMOVED, None, 0, 0))
+
+    def reusable_hashes(self, node_path):
+        """
+        Returns the object hashes of a leaf that doesn't need to be rebuilt, or None.
+        """
+        return self._reusable.get('/'.join(node_path))
+
+    def count(self, action):
+        return sum(1 for entry in self.entries if entry.action is action)
+
+    @property
+    def parse_size(self):
+        return sum(entry.parse_size for entry in self.entries)
+
+    @property
+    def write_size(self):
+        return sum(entry.write_size for entry in self.entries)
+
+    def __str__(self):
+        lines = []
+        for entry in self.entries:
+            if entry.action is not PlanAction.UNCHANGED:
+                lines.append("  {action:<10} {path}".format(action=entry.action.value,
+                                                          path='/'.join(entry.node_path)))
+        lines.append(", ".join("%d %s" % (self.count(action), action.value) for action in PlanAction))
+        lines.append("Estimated %s to parse, %s to write." % (format_bytes(self.parse_size),
+                                                             format_bytes(self.write_size)))
+        return "\n".join(lines)
+
+
+def _find_node(contents, node_path):
+    node = contents
+    for name in node_path:
+        if not isinstance(node, GroupNode):
+            return None
+        node = node.children.get(name)
+    return node
+
+def _iter_leaf_paths(node, node_path=[]):
+    if isinstance(node, GroupNode):
+        for name, child in iteritems(node.children):
+            for path in _iter_leaf_paths(child, node_path + [name]):
+                yield path
+    elif isinstance(node, (TableNode, FileNode)):
+        yield node_path
+
 def _path_hash(path, transform, kwargs):
     """
     Generate a hash of source file path + transform + args
@@ -60,6 +167,45 @@ def _path_hash(path, transform, kwargs):
                                                    kwargs=",".join(sortedargs))
     return digest_string(srcinfo)
 
+def _read_cache_entry(store, path_hash):
+    cache_path = store.cache_path(path_hash)
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path, 'r') as entry:
+        return json.load(entry)
+
+def _write_cache_entry(store, path_hash, source_stat, source_hash, obj_hashes):
+    cache_entry = dict(
+        source_hash=source_hash,
+        source_size=source_stat.st_size,
+        source_mtime=source_stat.st_mtime,
+        obj_hashes=obj_hashes
+        )
+    with open(store.cache_path(path_hash), 'w') as entry:
+        json.dump(cache_entry, entry)
+
+def _source_hash(path, source_stat, cache_entry):
+    """
+    Hash a source file, unless its size and mtime match the ones in its cache entry
+    """
+    if (cache_entry is not None and
+            cache_entry.get('source_size') == source_stat.st_size and
+            cache_entry.get('source_mtime') == source_stat.st_mtime):
+        return cache_entry['source_hash']
+    return digest_file(path)
+
+def _cached_objects(store, cache_entry, source_hash):
+    """
+    Returns the cached object hashes for a source if they're all in the store, otherwise None
+    """
+    if cache_entry is None or cache_entry['source_hash'] != source_hash:
+        return None
+    obj_hashes = cache_entry['obj_hashes']
+    assert isinstance(obj_hashes, list)
+    if obj_hashes and all(os.path.exists(store.object_path(obj)) for obj in obj_hashes):
+        return obj_hashes
+    return None
+
 def _is_internal_node(node):
     is_leaf = not node or isinstance(node.get(RESERVED['file']), str) or node.get(RESERVED['package'])
     return not is_leaf
@@ -91,7 +237,7 @@ def _run_checks(dataframe, checks, checks_contents, node_path, rel_path, target,
             raise BuildException("Data check failed: %s on %s @ %s" % (
                 check, rel_path, target.value))
 
-def _gen_glob_data(dir, pattern, child_table):
+def _gen_glob_data(dir, pattern, child_table, verbose=True):
     """Generates node data by globbing a directory for a pattern"""
     dir = pathlib.Path(dir)
     matched = False
@@ -109,20 +255,103 @@ def _gen_glob_data(dir, pattern, child_table):
         node_table[RESERVED['file']] = str(filepath)
         node_name = to_nodename(filepath.stem, invalid=used_names)
         used_names.add(node_name)
-        print("Matched with {!r}: {!r} from {!r}".format(pattern, node_name, str(filepath)))
+        if verbose:
+            print("Matched with {!r}: {!r} from {!r}".format(pattern, node_name, str(filepath)))
 
         yield node_name, node_table
 
     if not matched:
-        print("Warning: {!r} matched no files.".format(pattern))
+        if verbose:
+            print("Warning: {!r} matched no files.".format(pattern))
         return
 
 def _consume(node, keys):
     for key in keys:
         node.pop(key)
 
+def _get_group_children(node, ancestor_args):
+    """
+    Returns the args to pass down to the children of an internal node, and the children.
+    """
+    # Make a consumable copy.  This is to cover a quirk introduced by accepting nodes named
+    # like RESERVED keys -- if a RESERVED key is actually matched, it should be removed from
+    # the node, or it gets treated like a subnode (or like a node with invalid content)
+    node = node.copy()
+
+    # NOTE: YAML parsing does not guarantee key order
+    # fetch local transform and kwargs values; we do it using ifs
+    # to prevent `key: None` from polluting the update
+    local_args = _get_local_args(node, [RESERVED['transform'], RESERVED['kwargs']])
+    group_args = ancestor_args.copy()
+    group_args.update(local_args)
+    _consume(node, local_args)
+
+    # if it's not a reserved word it's a group that we can descend
+    groups = {k: v for k, v in iteritems(node) if _is_valid_group(v)}
+    _consume(node, groups)
+
+    if node:
+        # Unused keys -- either keyword typos or node names with invalid values.
+        #   For now, until build.yml schemas, pointing out one should do.
+        key, value = node.popitem()
+        raise BuildException("Invalid syntax: expected node data for {!r}, got {!r}".format(key, value))
+    return group_args, groups
+
+def _iter_group_children(build_dir, groups, verbose=True):
+    for child_name, child_table in groups.items():
+        if glob.has_magic(child_name):
+            # child_name is a glob string, use it to generate multiple child nodes
+            for gchild_name, gchild_table in _gen_glob_data(build_dir, child_name, child_table,
+                                                            verbose=verbose):
+                yield gchild_name, gchild_table
+        else:
+            if not isinstance(child_name, str) or not is_nodename(child_name):
+                raise StoreException("Invalid node name: %r" % child_name)
+            yield child_name, child_table
+
+def _get_transform(node, ancestor_args, rel_path):
+    """
+    Returns the transform and target of a file node: defined locally, inherited
+    from an ancestor, or inferred from the file extension (in which case the
+    third value is True).
+    """
+    transform = node.get(RESERVED['transform']) or ancestor_args.get(RESERVED['transform'])
+    if transform:
+        transform = transform.lower()
+        if transform in PANDAS_PARSERS:
+            target = TargetType.PANDAS
+        elif transform == PARQUET:
+            target = TargetType.PANDAS
+        elif transform == ID:
+            target = TargetType.FILE
+        else:
+            raise BuildException("Unknown transform '%s' for %s" %
+                                 (transform, rel_path))
+        return transform, target, False
+
+    # Guess transform and target based on file extension if not provided
+    _, ext = splitext_no_dot(rel_path)
+
+    if ext in PANDAS_PARSERS:
+        transform = ext
+        target = TargetType.PANDAS
+    elif ext == PARQUET:
+        transform = ext
+        target = TargetType.PANDAS
+    else:
+        transform = ID
+        target = TargetType.FILE
+    return transform, target, True
+
+def _get_handler_args(node, ancestor_args):
+    # copy so we don't modify shared ancestor_args
+    handler_args = dict(ancestor_args.get(RESERVED['kwargs'], {}))
+    # local kwargs win the update
+    handler_args.update(node.get(RESERVED['kwargs'], {}))
+    return handler_args
+
 def _build_node(build_dir, package, node_path, node, checks_contents=None,
-                dry_run=False, env='default', ancestor_args={}):
+                dry_run=False, env='default', ancestor_args={}, plan=None):
     """
     Parameters
     ----------
@@ -133,44 +362,19 @@ def _build_node(build_dir, package, node_path, node, checks_contents=None,
       (e.g. transform: csv for 500 .txt files)
       and overriding of ancestor or peer values.
       Child transform or kwargs override ancestor k:v pairs.
+    plan : BuildPlan
+      if given, leaves that the plan can reuse are added by their
+      hashes instead of being rebuilt
     """
     if _is_internal_node(node):
         if not dry_run:
             package.save_group(node_path)
 
-        # Make a consumable copy.  This is to cover a quirk introduced by accepting nodes named
-        # like RESERVED keys -- if a RESERVED key is actually matched, it should be removed from
-        # the node, or it gets treated like a subnode (or like a node with invalid content)
-        node = node.copy()
-
-        # NOTE: YAML parsing does not guarantee key order
-        # fetch local transform and kwargs values; we do it using ifs
-        # to prevent `key: None` from polluting the update
-        local_args = _get_local_args(node, [RESERVED['transform'], RESERVED['kwargs']])
-        group_args = ancestor_args.copy()
-        group_args.update(local_args)
-        _consume(node, local_args)
-
-        # if it's not a reserved word it's a group that we can descend
-        groups = {k: v for k, v in iteritems(node) if _is_valid_group(v)}
-        _consume(node, groups)
-
-        if node:
-            # Unused keys -- either keyword typos or node names with invalid values.
-            #   For now, until build.yml schemas, pointing out one should do.
-            key, value = node.popitem()
-            raise BuildException("Invalid syntax: expected node data for {!r}, got {!r}".format(key, value))
-        for child_name, child_table in groups.items():
-            if glob.has_magic(child_name):
-                # child_name is a glob string, use it to generate multiple child nodes
-                for gchild_name, gchild_table in _gen_glob_data(build_dir, child_name, child_table):
-                    _build_node(build_dir, package, node_path + [gchild_name], gchild_table,
-                        checks_contents=checks_contents, dry_run=dry_run, env=env, ancestor_args=group_args)
-            else:
-                if not isinstance(child_name, str) or not is_nodename(child_name):
-                    raise StoreException("Invalid node name: %r" % child_name)
-                _build_node(build_dir, package, node_path + [child_name], child_table,
-                    checks_contents=checks_contents, dry_run=dry_run, env=env, ancestor_args=group_args)
+        group_args, groups = _get_group_children(node, ancestor_args)
+        for child_name, child_table in _iter_group_children(build_dir, groups):
+            _build_node(build_dir, package, node_path + [child_name], child_table,
+                        checks_contents=checks_contents, dry_run=dry_run, env=env,
+                        ancestor_args=group_args, plan=plan)
     else:  # leaf node
         # prevent overwriting existing node names
         if '/'.join(node_path) in package:
@@ -207,41 +411,21 @@ def _build_node(build_dir, package, node_path, node, checks_contents=None,
             path = os.path.join(build_dir, rel_path)
 
             # get either the locally defined transform and target or inherit from an ancestor
-            transform = node.get(RESERVED['transform']) or ancestor_args.get(RESERVED['transform'])
-
-            ID = 'id' # pylint:disable=C0103
-            PARQUET = 'parquet' # pylint:disable=C0103
-            if transform:
-                transform = transform.lower()
-                if transform in PANDAS_PARSERS:
-                    target = TargetType.PANDAS
-                elif transform == PARQUET:
-                    target = TargetType.PANDAS
-                elif transform == ID:
-                    target = TargetType.FILE
-                else:
-                    raise BuildException("Unknown transform '%s' for %s" %
-                                         (transform, rel_path))
-            else:
-                # Guess transform and target based on file extension if not provided
-                _, ext = splitext_no_dot(rel_path)
-
-                if ext in PANDAS_PARSERS:
-                    transform = ext
-                    target = TargetType.PANDAS
-                elif ext == PARQUET:
-                    transform = ext
-                    target = TargetType.PANDAS
-                else:
-                    transform = ID
-                    target = TargetType.FILE
+            transform, target, inferred = _get_transform(node, ancestor_args, rel_path)
+            if inferred:
                 print("Inferring 'transform: %s' for %s" % (transform, rel_path))
 
-
             # TODO: parse/check environments:
             # environments = node.get(RESERVED['environments'])
             checks = node.get(RESERVED['checks'])
-            if transform == ID:
+            reusable = plan.reusable_hashes(node_path) if plan is not None else None
+            if reusable is not None:
+                if not dry_run:
+                    if transform in (ID, PARQUET):
+                        package.save_cached_file(reusable, node_path, rel_path, target)
+                    else:
+                        package.save_cached_df(reusable, node_path, rel_path, transform, target)
+            elif transform == ID:
                 #TODO move this to a separate function
                 if checks:
                     with open(path, 'r') as fd:
@@ -249,7 +433,7 @@ def _build_node(build_dir, package, node_path, node, checks_contents=None,
                         _run_checks(data, checks, checks_contents, node_path, rel_path, target, env=env)
                 if not dry_run:
                     print("Registering %s..." % path)
-                    package.save_file(path, node_path, rel_path, target)
+                    _save_file_node(package, path, node_path, rel_path, transform, target)
             elif transform == PARQUET:
                 if checks:
                     from pyarrow.parquet import ParquetDataset
@@ -259,28 +443,20 @@ def _build_node(build_dir, package, node_path, node, checks_contents=None,
                     _run_checks(dataframe, checks, checks_contents, node_path, rel_path, target, env=env)
                 if not dry_run:
                     print("Registering %s..." % path)
-                    package.save_file(path, node_path, rel_path, target)
+                    _save_file_node(package, path, node_path, rel_path, transform, target)
             else:
-                # copy so we don't modify shared ancestor_args
-                handler_args = dict(ancestor_args.get(RESERVED['kwargs'], {}))
-                # local kwargs win the update
-                handler_args.update(node.get(RESERVED['kwargs'], {}))
+                handler_args = _get_handler_args(node, ancestor_args)
                 # Check Cache
                 store = PackageStore()
                 path_hash = _path_hash(path, transform, handler_args)
-                source_hash = digest_file(path)
-
-                cachedobjs = []
-                if os.path.exists(store.cache_path(path_hash)):
-                    with open(store.cache_path(path_hash), 'r') as entry:
-                        cache_entry = json.load(entry)
-                        if cache_entry['source_hash'] == source_hash:
-                            cachedobjs = cache_entry['obj_hashes']
-                            assert isinstance(cachedobjs, list)
+                source_stat = os.stat(path)
+                cache_entry = _read_cache_entry(store, path_hash)
+                source_hash = _source_hash(path, source_stat, cache_entry)
+                cachedobjs = _cached_objects(store, cache_entry, source_hash)
 
                 # TODO: check for changes in checks else use cache
                 # below is a heavy-handed fix but it's OK for check builds to be slow
-                if not checks and cachedobjs and all(os.path.exists(store.object_path(obj)) for obj in cachedobjs):
+                if not checks and cachedobjs:
                     # Use existing objects instead of rebuilding
                     package.save_cached_df(cachedobjs, node_path, rel_path, transform, target)
                 else:
@@ -302,15 +478,102 @@ def _build_node(build_dir, package, node_path, node, checks_contents=None,
                         obj_hashes = package.save_df(dataframe, node_path, rel_path, transform, target)
 
                         # Add to cache
-                        cache_entry = dict(
-                            source_hash=source_hash,
-                            obj_hashes=obj_hashes
-                            )
-                        with open(store.cache_path(path_hash), 'w') as entry:
-                            json.dump(cache_entry, entry)
+                        _write_cache_entry(store, path_hash, source_stat, source_hash, obj_hashes)
         else: # rel_path and package are both None
             raise BuildException("Leaf nodes must define either a %s or %s key" % (RESERVED['file'], RESERVED['package']))
 
+def _save_file_node(package, path, node_path, rel_path, transform, target):
+    """
+    Save a raw file and record it in the build cache, so later plans can skip hashing it.
+    """
+    store = PackageStore()
+    source_stat = os.stat(path)
+    filehash = package.save_file(path, node_path, rel_path, target)
+    _write_cache_entry(store, _path_hash(path, transform, {}), source_stat, filehash, [filehash])
+
+def _iter_leaves(build_dir, node_path, node, ancestor_args={}):
+    """
+    Walks a build file without building anything.
+    Yields (node_path, node, ancestor_args) for every leaf.
+    """
+    if _is_internal_node(node):
+        group_args, groups = _get_group_children(node, ancestor_args)
+        for child_name, child_table in _iter_group_children(build_dir, groups, verbose=False):
+            for leaf in _iter_leaves(build_dir, node_path + [child_name], child_table, group_args):
+                yield leaf
+    else:
+        yield node_path, node, ancestor_args
+
+def _plan_leaf(store, build_dir, node_path, node, ancestor_args):
+    """
+    Returns the (node_path, hashes, node, parse_size, write_size) of a leaf for a `BuildPlan`,
+    or None for empty groups, without parsing its source.
+    """
+    if not node:
+        # empty groups have nothing to build
+        return None
+    elif node.get(RESERVED['package']):
+        # package composition only copies part of an existing manifest
+        team, user, pkgname, subpath = parse_package(node[RESERVED['package']], allow_subpath=True)
+        existing_pkg = PackageStore.find_package(team, user, pkgname)
+        included = None
+        if existing_pkg is not None:
+            if subpath:
+                included = _find_node(existing_pkg.get_contents(), subpath)
+            else:
+                included = GroupNode(existing_pkg.get_contents().children)
+        return node_path, None, included, 0, 0
+    elif node.get(RESERVED['file']):
+        rel_path = node[RESERVED['file']]
+        path = os.path.join(build_dir, rel_path)
+        if not os.path.isfile(path):
+            # leave it to the build to report the missing file
+            return node_path, None, None, 0, 0
+
+        transform, _, _ = _get_transform(node, ancestor_args, rel_path)
+        checks = node.get(RESERVED['checks'])
+        source_stat = os.stat(path)
+        size = source_stat.st_size
+        if transform in (ID, PARQUET):
+            cache_entry = _read_cache_entry(store, _path_hash(path, transform, {}))
+            filehash = _source_hash(path, source_stat, cache_entry)
+            hashes = [filehash] if os.path.exists(store.object_path(filehash)) else None
+            parse_size = size if checks and transform == PARQUET else 0
+        else:
+            path_hash = _path_hash(path, transform, _get_handler_args(node, ancestor_args))
+            cache_entry = _read_cache_entry(store, path_hash)
+            hashes = _cached_objects(store, cache_entry, _source_hash(path, source_stat, cache_entry))
+            parse_size = size if hashes is None or checks else 0
+
+        if checks:
+            # checks need the data, so the leaf gets rebuilt
+            hashes = None
+        return node_path, hashes, None, parse_size, 0 if hashes is not None else size
+    else:
+        # invalid leaf; the build will raise
+        return node_path, None, None, 0, 0
+
+def plan_package_from_contents(team, username, package, build_dir, build_data):
+    """
+    Compares a build file against the build cache and the package's current contents
+    in the local store, without parsing any sources.
+
+    Returns a `BuildPlan`.
+    """
+    contents = build_data.get('contents', {})
+    if not isinstance(contents, dict):
+        raise BuildException("'contents' must be a dictionary")
+
+    store = PackageStore()
+    leaves = []
+    for node_path, node, ancestor_args in _iter_leaves(build_dir, [], contents):
+        leaf = _plan_leaf(store, build_dir, node_path, node, ancestor_args)
+        if leaf is not None:
+            leaves.append(leaf)
+
+    existing = store.get_package(team, username, package)
+    return BuildPlan(leaves, existing.get_contents() if existing is not None else None)
+
 
 def _remove_keywords(d):
     """
@@ -394,11 +657,9 @@ def _file_to_data_frame(ext, path, handler_args):
 
     return dataframe
 
-def build_package(team, username, package, yaml_path, checks_path=None, dry_run=False, env='default'):
+def _load_build_file(yaml_path, checks_path=None):
     """
-    Builds a package from a given Yaml file and installs it locally.
-
-    Returns the name of the package.
+    Returns the contents of a build file, its checks and the path of the checks file (if any).
     """
     def find(key, value):
         """
@@ -428,11 +689,24 @@ def build_package(team, username, package, yaml_path, checks_path=None, dry_run=
         checks_contents = load_yaml(checks_path)
     else:
         checks_contents = None
+    return build_data, checks_contents, checks_path
+
+def build_package(team, username, package, yaml_path, checks_path=None, dry_run=False, env='default',
+                  plan=False):
+    """
+    Builds a package from a given Yaml file and installs it locally.
+
+    If `plan` is True, prints a `BuildPlan` first and only rebuilds the leaves
+    that changed. With `dry_run`, only the plan is printed.
+
+    Returns the name of the package.
+    """
+    build_data, checks_contents, _ = _load_build_file(yaml_path, checks_path)
     build_package_from_contents(team, username, package, os.path.dirname(yaml_path), build_data,
-                                checks_contents=checks_contents, dry_run=dry_run, env=env)
+                                checks_contents=checks_contents, dry_run=dry_run, env=env, plan=plan)
 
 def build_package_from_contents(team, username, package, build_dir, build_data,
-                                checks_contents=None, dry_run=False, env='default'):
+                                checks_contents=None, dry_run=False, env='default', plan=False):
     contents = build_data.get('contents', {})
     if not isinstance(contents, dict):
         raise BuildException("'contents' must be a dictionary")
@@ -441,14 +715,166 @@ def build_package_from_contents(team, username, package, build_dir, build_data,
     checks_contents = {} if checks_contents is None else checks_contents
     checks_contents.update(build_data.get('checks', {}))
 
+    build_plan = None
+    if plan:
+        build_plan = plan_package_from_contents(team, username, package, build_dir, build_data)
+        print("Build plan for %s/%s:" % (username, package))
+        print(build_plan)
+        if dry_run:
+            return
+
     store = PackageStore()
     newpackage = store.create_package(team, username, package, dry_run=dry_run)
     _build_node(build_dir, newpackage, [], contents,
-                checks_contents=checks_contents, dry_run=dry_run, env=env)
+                checks_contents=checks_contents, dry_run=dry_run, env=env, plan=build_plan)
 
     if not dry_run:
         newpackage.save_contents()
 
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+class BuildWatcher(object):
+    """
+    Keeps a package built from a build file (or a directory) up to date.
+
+    The build file and the package contents stay in memory; when a source
+    changes, only the leaves built from it are rebuilt and the contents are
+    saved again. Changes to the build file itself, or files appearing in or
+    disappearing from the source directories, trigger a planned rebuild
+    (see `BuildPlan`), which still only parses what changed.
+    """
+    def __init__(self, team, username, package, path, env='default'):
+        self._team = team
+        self._username = username
+        self._package_name = package
+        self._path = path
+        self._env = env
+        self._build_dir = path if os.path.isdir(path) else os.path.dirname(path)
+        self._package = None
+        self._checks_contents = None
+        self._config_paths = []
+        self._leaves = {}
+        self._stats = {}
+        self.rebuild()
+
+    def _load(self):
+        if os.path.isdir(self._path):
+            return generate_contents(self._path), None, []
+        build_data, checks_contents, checks_path = _load_build_file(self._path)
+        config_paths = [self._path]
+        if checks_path is not None:
+            config_paths.append(checks_path)
+        return build_data, checks_contents, config_paths
+
+    def _find_leaves(self, build_data):
+        """
+        Returns {node_path: (source_path, node, ancestor_args)} for the leaves built from files.
+        """
+        leaves = {}
+        contents = build_data.get('contents', {})
+        for node_path, node, ancestor_args in _iter_leaves(self._build_dir, [], contents):
+            rel_path = node.get(RESERVED['file']) if node else None
+            if isinstance(rel_path, string_types) and not node.get(RESERVED['package']):
+                source = os.path.join(self._build_dir, rel_path)
+                leaves[tuple(node_path)] = (source, node, ancestor_args)
+        return leaves
+
+    def _snapshot(self):
+        paths = set(self._config_paths)
+        paths.add(self._build_dir)
+        for source, _, _ in itervalues(self._leaves):
+            paths.add(source)
+            # catches files added to or removed from source directories (and globs)
+            paths.add(os.path.dirname(source))
+        return {path: _stat_key(path) for path in paths}
+
+    def get_package(self):
+        return self._package
+
+    def rebuild(self):
+        """
+        Rebuilds the package from scratch, reusing the objects of unchanged leaves.
+        """
+        build_data, checks_contents, self._config_paths = self._load()
+        # build_package_from_contents adds any inline checks to this dict
+        self._checks_contents = {} if checks_contents is None else checks_contents
+        build_package_from_contents(self._team, self._username, self._package_name, self._build_dir,
+                                    build_data, checks_contents=self._checks_contents, env=self._env,
+                                    plan=True)
+        self._package = PackageStore().get_package(self._team, self._username, self._package_name)
+        self._leaves = self._find_leaves(build_data)
+        self._stats = self._snapshot()
+
+    def _rebuild_leaf(self, node_path):
+        _, node, ancestor_args = self._leaves[node_path]
+        parent = _find_node(self._package.get_contents(), node_path[:-1])
+        old_node = parent.children.pop(node_path[-1], None)
+        try:
+            _build_node(self._build_dir, self._package, list(node_path), node,
+                        checks_contents=self._checks_contents, env=self._env,
+                        ancestor_args=ancestor_args)
+        except Exception:
+            if old_node is not None:
+                parent.children[node_path[-1]] = old_node
+            raise
+
+    def poll(self):
+        """
+        Checks the sources once and rebuilds whatever changed.
+
+        Returns True if the package was rebuilt.
+        """
+        changed = set()
+        for path, key in iteritems(self._stats):
+            current = _stat_key(path)
+            if current != key:
+                changed.add(path)
+                # a failed rebuild waits for the next change rather than retrying
+                self._stats[path] = current
+        if not changed:
+            return False
+
+        if changed.intersection(self._config_paths):
+            self.rebuild()
+            return True
+
+        if any(os.path.isdir(path) or _stat_key(path) is None for path in changed):
+            build_data, _, _ = self._load()
+            leaves = self._find_leaves(build_data)
+            sources = {node_path: leaf[0] for node_path, leaf in iteritems(self._leaves)}
+            if sources != {node_path: leaf[0] for node_path, leaf in iteritems(leaves)}:
+                self.rebuild()
+                return True
+
+        node_paths = [node_path for node_path, (source, _, _) in iteritems(self._leaves)
+                      if source in changed]
+        if not node_paths:
+            return False
+        for node_path in sorted(node_paths):
+            self._rebuild_leaf(node_path)
+        self._package.save_contents()
+        print("Rebuilt %s; package hash is %s" % (
+            ", ".join('/'.join(node_path) for node_path in sorted(node_paths)),
+            self._package.get_hash()))
+        return True
+
+    def watch(self, interval=WATCH_INTERVAL):
+        """
+        Polls the sources every `interval` seconds until interrupted.
+        """
+        print("Watching %s for changes..." % self._path)
+        while True:
+            time.sleep(interval)
+            try:
+                self.poll()
+            except QuiltException as ex:
+                print("Failed to rebuild the package: %s" % ex)
+
 def splitext_no_dot(filename):
     """
     Wrap os.path.splitext to return the name and the extension
@@ -0,0 +1,253 @@
+"""
+Per-store index of installed packages.
+
+Listing or resolving packages used to walk the team/user/package directories
+and read every tag file. Instead, each store keeps `catalog.json`:
+
+    {"version": 1,
+     "pkgs_mtime": <mtime of the package directories>,
+     "packages": {"<team>/<user>/<package>": {"tags": {<tag>: <hash>},
+                                              "instances": [<hash>, ...]}}}
+
+It is updated by the store's write paths, under a lock file, and cached per process
+until the file changes. It's rebuilt from the directory tree if it's missing or
+unreadable, or if the team and user directories changed since it was written
+(e.g., a package was added or removed by an older client). In read-only stores,
+the rebuilt catalog can't be saved, so it's only cached, until those directories
+change.
+
+Only adding or removing packages is noticed that way, not new tags or instances
+of an existing package written without `update` (e.g., by an older client, or by
+syncing the store's files): checking each package's directories would cost as
+much as the lookups the catalog saves. Removing `catalog.json` rebuilds it.
+"""
+from contextlib import contextmanager
+import errno
+import json
+import os
+import tempfile
+import time
+
+from six import iteritems
+
+from .const import DEFAULT_TEAM
+from .package import Package
+from .util import sub_dirs, sub_files
+
+CATALOG_FILE = 'catalog.json'
+CATALOG_VERSION = 1
+
+LOCK_FILE = 'catalog.lock'
+# Locks older than this were left behind by a crashed process, and get removed.
+LOCK_STALE_TIME = 30
+
+# Store path -> (catalog file stat key or None, pkgs mtime, packages)
+_cache = {}
+
+
+def package_key(team, user, package):
+    return '/'.join([team or DEFAULT_TEAM, user, package])
+
+
+def split_key(key):
+    """
+    Returns (team, user, package); team is None for the default team.
+    """
+    team, user, package = key.split('/')
+    return (None if team == DEFAULT_TEAM else team), user, package
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    # The file is always replaced, never modified in place.
+    return (stat.st_ino, getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size)
+
+
+def _mtime(path):
+    stat = os.stat(path)
+    return getattr(stat, 'st_mtime_ns', stat.st_mtime)
+
+
+def _pkgs_mtime(pkgs_path):
+    """
+    Returns the latest mtime of the package directory and its team and user directories,
+    which change when packages are added or removed.
+    """
+    try:
+        mtimes = [_mtime(pkgs_path)]
+        for team in sub_dirs(pkgs_path):
+            team_path = os.path.join(pkgs_path, team)
+            mtimes.append(_mtime(team_path))
+            mtimes.extend(_mtime(os.path.join(team_path, user)) for user in sub_dirs(team_path))
+    except OSError:
+        return None
+    return max(mtimes)
+
+
+@contextmanager
+def _lock(store_path):
+    """
+    Holds the store's catalog lock file. Without a writable store, there's nothing to lock.
+    """
+    path = os.path.join(store_path, LOCK_FILE)
+    fd = None
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                break
+        try:
+            if time.time() - os.path.getmtime(path) > LOCK_STALE_TIME:
+                os.remove(path)
+                continue
+        except OSError:
+            # Just released.
+            continue
+        time.sleep(0.01)
+
+    try:
+        yield
+    finally:
+        if fd is not None:
+            os.close(fd)
+            os.remove(path)
+
+
+def scan_package(pkgpath):
+    """
+    Reads the tags and instances of a package directory; returns None if it doesn't exist.
+    """
+    if not os.path.isdir(pkgpath):
+        return None
+    tags = {}
+    tags_path = os.path.join(pkgpath, Package.TAGS_DIR)
+    if os.path.isdir(tags_path):
+        for tag in sub_files(tags_path):
+            with open(os.path.join(tags_path, tag), 'r') as tagfile:
+                tags[tag] = tagfile.read()
+    contents_path = os.path.join(pkgpath, Package.CONTENTS_DIR)
+    instances = sorted(sub_files(contents_path)) if os.path.isdir(contents_path) else []
+    return dict(tags=tags, instances=instances)
+
+
+def _scan(pkgs_path):
+    packages = {}
+    if not os.path.isdir(pkgs_path):
+        return packages
+    for team in sub_dirs(pkgs_path):
+        for user in sub_dirs(os.path.join(pkgs_path, team)):
+            for pkg in sub_dirs(os.path.join(pkgs_path, team, user)):
+                entry = scan_package(os.path.join(pkgs_path, team, user, pkg))
+                packages['/'.join([team, user, pkg])] = entry
+    return packages
+
+
+def _read(path, pkgs_mtime):
+    """
+    Returns the packages in the catalog file; None if it's unreadable or out of date.
+    """
+    try:
+        with open(path, 'r') as fd:
+            data = json.load(fd)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('version') != CATALOG_VERSION:
+        return None
+    if pkgs_mtime is None or data.get('pkgs_mtime') != pkgs_mtime:
+        return None
+    return data.get('packages')
+
+
+def _write(store_path, packages, pkgs_mtime):
+    """
+    Atomically replaces the catalog file. Returns False if the store isn't writable.
+    """
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix='.catalog', dir=store_path)
+    except (IOError, OSError):
+        return False
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(dict(version=CATALOG_VERSION, pkgs_mtime=pkgs_mtime, packages=packages),
+                      tmp_file, sort_keys=True)
+        path = os.path.join(store_path, CATALOG_FILE)
+        if hasattr(os, 'replace'):
+            os.replace(tmp_path, path)
+        else:
+            # Python 2: rename doesn't overwrite on Windows.
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
+
+
+def load(store_path, pkgs_path):
+    """
+    Returns the catalog of a store: a dict of package keys to {"tags": ..., "instances": ...}.
+    The result is shared; don't modify it.
+    """
+    path = os.path.join(store_path, CATALOG_FILE)
+    stat_key = _stat_key(path)
+    pkgs_mtime = _pkgs_mtime(pkgs_path)
+    cached = _cache.get(store_path)
+    if cached is not None and cached[:2] == (stat_key, pkgs_mtime):
+        return cached[2]
+
+    packages = _read(path, pkgs_mtime) if stat_key is not None else None
+    if packages is None:
+        # Missing, unreadable or out of date: rebuild it from the directory tree.
+        with _lock(store_path):
+            pkgs_mtime = _pkgs_mtime(pkgs_path)
+            packages = _scan(pkgs_path)
+            # In a read-only store, it stays cached until the package directories change.
+            _write(store_path, packages, pkgs_mtime)
+        stat_key = _stat_key(path)
+
+    _cache[store_path] = (stat_key, pkgs_mtime, packages)
+    return packages
+
+
+def update(store_path, pkgs_path, key):
+    """
+    Re-reads a package's directory and updates its entry in the catalog.
+    """
+    path = os.path.join(store_path, CATALOG_FILE)
+    with _lock(store_path):
+        # Before reading anything, so that later changes make the catalog out of date.
+        pkgs_mtime = _pkgs_mtime(pkgs_path)
+        # Start from the file rather than the cache, to keep changes made by other processes;
+        # the lock keeps them from writing in between.
+        packages = _read(path, pkgs_mtime)
+        if packages is None:
+            packages = _scan(pkgs_path)
+        else:
+            packages = dict(packages)
+
+        entry = scan_package(os.path.join(pkgs_path, *key.split('/')))
+        if entry is None:
+            packages.pop(key, None)
+        else:
+            packages[key] = entry
+
+        if _write(store_path, packages, pkgs_mtime):
+            _cache[store_path] = (_stat_key(path), pkgs_mtime, packages)
+        else:
+            _cache.pop(store_path, None)
+
+
+def iter_packages(packages):
+    """
+    Yields (team, user, package, entry) tuples, sorted by key.
+    """
+    for key, entry in sorted(iteritems(packages)):
+        team, user, package = split_key(key)
+        yield team, user, package, entry
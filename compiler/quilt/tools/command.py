@@ -5,7 +5,7 @@ Command line parsing and command dispatch
 
 from __future__ import print_function
 from builtins import input      # pylint:disable=W0622
-from collections import Counter
+from collections import Counter, namedtuple
 from datetime import datetime
 from functools import partial
 import hashlib
@@ -20,26 +20,23 @@ import subprocess
 import sys
 import tempfile
 import time
-import yaml
 
 from packaging.version import Version
-import pandas as pd
-import pkg_resources
-import requests
-from six import itervalues, string_types
+from six import iteritems, itervalues, string_types
 from six.moves.urllib.parse import urlparse, urlunparse
-from tqdm import tqdm
 
-from .build import (build_package, build_package_from_contents, generate_build_file,
-                    generate_contents, BuildException, load_yaml)
+# Heavy dependencies (pandas, requests, yaml, tqdm, and the `build` and `data_transfer` modules
+# that use them) are imported by the commands that need them, to keep `import quilt` and
+# simple commands like `quilt ls` fast.
 from .compat import pathlib
 from .const import DEFAULT_BUILDFILE, DTIMEF, QuiltException, TargetType
-from .core import (hash_contents, find_object_hashes, TableNode, FileNode, GroupNode,
-                   decode_node, encode_node, LATEST_TAG)
-from .data_transfer import download_fragments, upload_fragments
+from .core import (hash_contents, find_object_hashes, find_matching_object_hashes, diff_trees,
+                   TableNode, FileNode, GroupNode, decode_node, encode_node, LATEST_TAG)
+from .package import PackageException
 from .store import PackageStore, StoreException
-from .util import (BASE_DIR, gzip_compress, is_nodename, parse_package as parse_package_util,
-                   parse_package_extended as parse_package_extended_util)
+from .util import (BASE_DIR, ZSTD_MAGIC, format_bytes, get_version, gzip_compress, have_zstd, is_nodename,
+                   parse_package as parse_package_util, parse_package_extended as parse_package_extended_util,
+                   zstd_compress, zstd_decompress)
 from ..imports import _from_core_node
 
 from .. import nodes
@@ -50,7 +47,8 @@ GIT_URL_RE = re.compile(r'(?P<url>http[s]?://[\w./~_-]+\.git)(?:@(?P<branch>[\w_
 
 LOG_TIMEOUT = 3 # 3 seconds
 
-VERSION = pkg_resources.require('quilt')[0].version
+NodeDiff = namedtuple("NodeDiff", "path, change, old_hashes, new_hashes, size_delta")
+InstallPlan = namedtuple("InstallPlan", "pkgobj, journal, obj_urls, obj_sizes, download, partial")
 
 
 class CommandException(QuiltException):
@@ -170,6 +168,8 @@ def config():
     _registry_url = None
 
 def _update_auth(team, refresh_token, timeout=None):
+    import requests
+
     response = requests.post("%s/api/token" % get_registry_url(team),
         timeout=timeout,
         data=dict(
@@ -193,6 +193,12 @@ def _update_auth(team, refresh_token, timeout=None):
 
 def _handle_response(team, resp, **kwargs):
     _ = kwargs                  # unused    pylint:disable=W0613
+    import requests
+
+    # requests doesn't know zstd (unless a newer urllib3 already decoded it).
+    if resp.headers.get('Content-Encoding') == 'zstd' and resp.content[:len(ZSTD_MAGIC)] == ZSTD_MAGIC:
+        resp._content = zstd_decompress(resp.content)  # pylint:disable=W0212
+
     if resp.status_code == requests.codes.unauthorized:
         raise CommandException(
             "Authentication failed. Run `quilt login%s` again." %
@@ -232,6 +238,8 @@ def _create_session(team, auth):
     """
     Creates a session object to be used for `push`, `install`, etc.
     """
+    import requests
+
     session = requests.Session()
     session.hooks.update(dict(
         response=partial(_handle_response, team)
@@ -240,10 +248,13 @@ def _create_session(team, auth):
         "Content-Type": "application/json",
         "Accept": "application/json",
         "User-Agent": "quilt-cli/%s (%s %s) %s/%s" % (
-            VERSION, platform.system(), platform.release(),
+            get_version(), platform.system(), platform.release(),
             platform.python_implementation(), platform.python_version()
         )
     })
+    if have_zstd():
+        # Large responses, like package manifests, are much smaller with zstd.
+        session.headers["Accept-Encoding"] = "gzip, deflate, zstd"
     if auth is not None:
         session.headers["Authorization"] = "Bearer %s" % auth['access_token']
 
@@ -428,6 +439,8 @@ def generate(directory, outfilename=DEFAULT_BUILDFILE):
     Generate a build-file for quilt build from a directory of
     source files.
     """
+    from .build import generate_build_file, BuildException
+
     try:
         buildfilepath = generate_build_file(directory, outfilename=outfilename)
     except BuildException as builderror:
@@ -453,6 +466,7 @@ def _clone_git_repo(url, branch, dest):
 
 def _log(team, **kwargs):
     # TODO(dima): Save logs to a file, then send them when we get a chance.
+    import requests
 
     cfg = _load_config()
     if cfg.get('disable_analytics'):
@@ -480,12 +494,14 @@ def _log(team, **kwargs):
         if session:
             session.hooks['response'] = orig_response_hooks
 
-def build(package, path=None, dry_run=False, env='default', force=False):
+def build(package, path=None, dry_run=False, env='default', force=False, plan=False, watch=False):
     """
     Compile a Quilt data package, either from a build file or an existing package node.
 
     :param package: short package specifier, i.e. 'team:user/pkg'
     :param path: file path, git url, or existing package node
+    :param plan: print which nodes changed since the last build and only rebuild those
+    :param watch: keep rebuilding the nodes whose source files change, until interrupted
     """
     # TODO: rename 'path' param to 'target'?  It can be a PackageNode as well.
     team, _, _ = parse_package(package)
@@ -501,13 +517,19 @@ def build(package, path=None, dry_run=False, env='default', force=False):
             return
     package_hash = hashlib.md5(package.encode('utf-8')).hexdigest()
     try:
-        _build_internal(package, path, dry_run, env)
+        _build_internal(package, path, dry_run, env, plan=plan, watch=watch)
     except Exception as ex:
         _log(team, type='build', package=package_hash, dry_run=dry_run, env=env, error=str(ex))
         raise
     _log(team, type='build', package=package_hash, dry_run=dry_run, env=env)
 
-def _build_internal(package, path, dry_run, env):
+def _build_internal(package, path, dry_run, env, plan=False, watch=False):
+    if watch:
+        if not isinstance(path, string_types) or GIT_URL_RE.match(path) or dry_run:
+            raise CommandException("--watch requires a local build file or directory")
+        _build_and_watch(package, path, env)
+        return
+
     # we may have a path, git URL, PackageNode, or None
     if isinstance(path, string_types):
         # is this a git url?
@@ -518,7 +540,7 @@ def _build_internal(package, path, dry_run, env):
             branch = is_git_url.group('branch')
             try:
                 _clone_git_repo(url, branch, tmpdir)
-                build_from_path(package, tmpdir, dry_run=dry_run, env=env)
+                build_from_path(package, tmpdir, dry_run=dry_run, env=env, plan=plan)
             except Exception as exc:
                 msg = "attempting git clone raised exception: {exc}"
                 raise CommandException(msg.format(exc=exc))
@@ -526,7 +548,7 @@ def _build_internal(package, path, dry_run, env):
                 if os.path.exists(tmpdir):
                     rmtree(tmpdir)
         else:
-            build_from_path(package, path, dry_run=dry_run, env=env)
+            build_from_path(package, path, dry_run=dry_run, env=env, plan=plan)
     elif isinstance(path, nodes.PackageNode):
         assert not dry_run  # TODO?
         build_from_node(package, path)
@@ -536,6 +558,25 @@ def _build_internal(package, path, dry_run, env):
     else:
         raise ValueError("Expected a PackageNode, path or git URL, but got %r" % path)
 
+def _build_and_watch(package, path, env='default'):
+    """
+    Build a package from a build file or directory, then rebuild the nodes
+    whose sources change until interrupted.
+    """
+    team, owner, pkg = parse_package(package)
+
+    if not os.path.exists(path):
+        raise CommandException("%s does not exist." % path)
+
+    from .build import BuildException, BuildWatcher
+
+    try:
+        watcher = BuildWatcher(team, owner, pkg, path, env=env)
+        print("Built %s%s/%s successfully." % (team + ':' if team else '', owner, pkg))
+        watcher.watch()
+    except BuildException as ex:
+        raise CommandException("Failed to build the package: %s" % ex)
+
 def _build_empty(package):
     """
     Create an empty package for convenient editing of de novo packages
@@ -563,7 +604,20 @@ def build_from_node(package, node):
         elif isinstance(node, nodes.DataNode):
             core_node = node._node
             metadata = core_node.metadata or {}
-            if isinstance(core_node, TableNode):
+            if node._is_unmodified():
+                # Reuse the existing objects instead of serializing the data again.
+                try:
+                    node._package.fetch_missing_fragments([core_node])
+                except PackageException as ex:
+                    raise CommandException(str(ex))
+                _copy_missing_objects(node._package.get_store(), store, core_node.hashes)
+                if isinstance(core_node, TableNode):
+                    package_obj.save_cached_df(core_node.hashes, path, metadata.get('q_path'),
+                                               metadata.get('q_ext'), TargetType.PANDAS)
+                else:
+                    package_obj.save_cached_file(core_node.hashes, path, metadata.get('q_path'),
+                                                 TargetType.FILE)
+            elif isinstance(core_node, TableNode):
                 dataframe = node._data()
                 package_obj.save_df(dataframe, path, metadata.get('q_path'), metadata.get('q_ext'),
                                     TargetType.PANDAS)
@@ -578,11 +632,26 @@ def build_from_node(package, node):
     _process_node(node)
     package_obj.save_contents()
 
-def build_from_path(package, path, dry_run=False, env='default', outfilename=DEFAULT_BUILDFILE):
+def _copy_missing_objects(src_store, dest_store, hashes):
+    """
+    Copy objects from another store (e.g., one in QUILT_PACKAGE_DIRS), if they're not already there.
+    """
+    for obj_hash in hashes:
+        if os.path.exists(dest_store.object_path(obj_hash)):
+            continue
+        src_path = src_store.object_path(obj_hash)
+        if not os.path.exists(src_path):
+            raise CommandException("Fragment {hash} is missing.".format(hash=obj_hash))
+        dest_store.save_file(src_path)
+
+def build_from_path(package, path, dry_run=False, env='default', outfilename=DEFAULT_BUILDFILE,
+                    plan=False):
     """
     Compile a Quilt data package from a build file.
     Path can be a directory, in which case the build file will be generated automatically.
     """
+    from .build import build_package, build_package_from_contents, generate_contents, BuildException
+
     team, owner, pkg = parse_package(package)
 
     if not os.path.exists(path):
@@ -597,9 +666,10 @@ def build_from_path(package, path, dry_run=False, env='default', outfilename=DEF
                 )
 
             contents = generate_contents(path, outfilename)
-            build_package_from_contents(team, owner, pkg, path, contents, dry_run=dry_run, env=env)
+            build_package_from_contents(team, owner, pkg, path, contents, dry_run=dry_run, env=env,
+                                        plan=plan)
         else:
-            build_package(team, owner, pkg, path, dry_run=dry_run, env=env)
+            build_package(team, owner, pkg, path, dry_run=dry_run, env=env, plan=plan)
 
         if not dry_run:
             print("Built %s%s/%s successfully." % (team + ':' if team else '', owner, pkg))
@@ -629,9 +699,22 @@ def log(package):
             str(entry.get('tags', [])), str(entry.get('versions', []))))
     _print_table(table)
 
-def push(package, is_public=False, is_team=False, reupload=False):
+def push(package, is_public=False, is_team=False, reupload=False, stream=False, cache_compressed=False,
+         verify_existing=False, max_bandwidth=None, resume=False):
     """
     Push a Quilt data package to the server
+
+    Fragments the registry already has aren't uploaded again, unless `reupload` is set;
+    with `verify_existing`, the registry checks its storage for them rather than
+    trusting its records.
+    With `stream`, all fragments are uploaded in parts that are compressed as they're
+    uploaded, rather than into temporary files first (if the registry supports it).
+    With `cache_compressed`, compressed fragments are kept in the local store, so they
+    don't need to be compressed again the next time they're pushed.
+    Large fragments are uploaded in parts; an interrupted push only uploads the missing ones.
+    `max_bandwidth` limits the upload rate, in MB/s (default: $QUILT_MAX_BANDWIDTH, or unlimited).
+    With `resume`, an interrupted push of the same package instance skips the fragments it
+    already uploaded, and only requests new upload URLs if the saved ones have expired.
     """
     team, owner, pkg = parse_package(package)
     _check_team_id(team)
@@ -642,18 +725,36 @@ def push(package, is_public=False, is_team=False, reupload=False):
         raise CommandException("Package {package} not found.".format(package=package))
 
     pkghash = pkgobj.get_hash()
+    store = pkgobj.get_store()
 
-    def _push_package(dry_run=False, sizes=dict()):
-        data = json.dumps(dict(
+    # A lazily-installed package needs all of its fragments.
+    try:
+        pkgobj.fetch_missing_fragments([pkgobj.get_contents()])
+    except PackageException as ex:
+        raise CommandException(str(ex))
+
+    obj_sizes = {
+        obj_hash: os.path.getsize(store.object_path(obj_hash))
+        for obj_hash in find_object_hashes(pkgobj.get_contents())
+    }
+
+    def _push_package(dry_run=False, sizes=dict(), encoding='gzip', skip_existing=False, obj_encodings=None):
+        data = dict(
             dry_run=dry_run,
             is_public=is_public,
             is_team=is_team,
             contents=pkgobj.get_contents(),
             description="",  # TODO
             sizes=sizes
-        ), default=encode_node)
+        )
+        if skip_existing:
+            data.update(skip_existing=True, verify_existing=verify_existing)
+        if obj_encodings:
+            # Only registries that asked for zstd'ed copies know `encodings`.
+            data.update(encodings=obj_encodings)
 
-        compressed_data = gzip_compress(data.encode('utf-8'))
+        compress = zstd_compress if encoding == 'zstd' else gzip_compress
+        compressed_data = compress(json.dumps(data, default=encode_node).encode('utf-8'))
 
         return session.put(
             "{url}/api/package/{owner}/{pkg}/{hash}".format(
@@ -664,28 +765,58 @@ def push(package, is_public=False, is_team=False, reupload=False):
             ),
             data=compressed_data,
             headers={
-                'Content-Encoding': 'gzip'
+                'Content-Encoding': encoding
             }
         )
 
-    print("Fetching upload URLs from the registry...")
-    resp = _push_package(dry_run=True)
-    obj_urls = resp.json()['upload_urls']
+    from .data_transfer import TransferJournal, upload_fragments
+    journal = TransferJournal(store.journal_path('push', team, owner, pkg))
 
-    assert set(obj_urls) == set(find_object_hashes(pkgobj.get_contents()))
+    resuming = resume and journal.header is not None and journal.header['hash'] == pkghash
+    if resuming:
+        print("Resuming the push: {done} of {total} fragments already uploaded.".format(
+            done=len(journal.done), total=len(obj_sizes)))
+    elif resume:
+        print("No interrupted push of {package} to resume.".format(package=package))
 
-    store = pkgobj.get_store()
-
-    obj_sizes = {
-        obj_hash: os.path.getsize(store.object_path(obj_hash)) for obj_hash in obj_urls
-    }
-
-    success = upload_fragments(store, obj_urls, obj_sizes, reupload=reupload)
+    request_encoding = 'gzip'
+    if not resuming or journal.urls_expired():
+        print("Fetching upload URLs from the registry...")
+        try:
+            resp = _push_package(dry_run=True, sizes=obj_sizes, skip_existing=not reupload)
+        except HTTPResponseException as ex:
+            # Older registries don't know `skip_existing`, and reject unknown fields.
+            if reupload or ex.response.status_code != 400 or 'skip_existing' not in str(ex):
+                raise
+            resp = _push_package(dry_run=True, sizes=obj_sizes)
+        obj_urls = resp.json()['upload_urls']
+
+        # Registries that can decode zstd requests say so in their responses (RFC 7694).
+        if have_zstd() and 'zstd' in resp.headers.get('Accept-Encoding', ''):
+            request_encoding = 'zstd'
+
+        assert set(obj_urls) == set(obj_sizes)
+
+        if not resuming:
+            journal.start(dict(package=package, hash=pkghash))
+        journal.add_urls(obj_urls, obj_sizes)
+
+    # Skip the fragments the registry already has, and the ones uploaded before the interruption.
+    new_urls = {obj_hash: urls for obj_hash, urls in iteritems(journal.urls)
+                if not urls.get('exists') and obj_hash not in journal.done}
+    if len(new_urls) < len(obj_sizes):
+        print("%d fragments already uploaded; skipping." % (len(obj_sizes) - len(new_urls)))
+
+    blob_url = "{url}/api/blob/{owner}".format(url=get_registry_url(team), owner=owner)
+    success = upload_fragments(store, new_urls, {obj_hash: obj_sizes[obj_hash] for obj_hash in new_urls},
+                               reupload=reupload, stream=stream, cache_compressed=cache_compressed,
+                               session=session, blob_url=blob_url, max_bandwidth=max_bandwidth,
+                               journal=journal)
     if not success:
-        raise CommandException("Failed to upload fragments")
+        raise CommandException("Failed to upload fragments; push it again with --resume to continue.")
 
     print("Uploading package metadata...")
-    resp = _push_package(sizes=obj_sizes)
+    resp = _push_package(sizes=obj_sizes, encoding=request_encoding, obj_encodings=journal.encodings)
     package_url = resp.json()['package_url']
 
     print("Updating the 'latest' tag...")
@@ -701,6 +832,8 @@ def push(package, is_public=False, is_team=False, reupload=False):
         ))
     )
 
+    journal.remove()
+
     print("Push complete. %s is live:\n%s" % (package, package_url))
 
 def version_list(package):
@@ -814,10 +947,16 @@ def tag_remove(package, tag):
         )
     )
 
-def install_via_requirements(requirements_str, force=False):
+def install_via_requirements(requirements_str, force=False, max_bandwidth=None, lazy=False, resume=False):
     """
     Download multiple Quilt data packages via quilt.xml requirements file.
+
+    The packages' metadata is downloaded first; then all of their fragments are downloaded
+    together, each one only once, even if several packages contain it.
     """
+    import yaml
+    from .build import load_yaml
+
     if requirements_str[0] == '@':
         path = requirements_str[1:]
         if os.path.isfile(path):
@@ -828,20 +967,71 @@ def install_via_requirements(requirements_str, force=False):
             raise CommandException("Requirements file not found: {filename}".format(filename=path))
     else:
         yaml_data = yaml.load(requirements_str)
+
+    # Resolve all of the packages first, so their fragments get downloaded together.
+    plans = []
     for pkginfo in yaml_data['packages']:
         info = parse_package_extended(pkginfo)
-        install(info.full_name, info.hash, info.version, info.tag, force=force)
+        plan = _plan_install(info.full_name, info.hash, info.version, info.tag, force=force, lazy=lazy,
+                             resume=resume)
+        if plan is not None:
+            plans.append(plan)
+
+    if not plans:
+        return
 
-def install(package, hash=None, version=None, tag=None, force=False, meta_only=False):
+    total = sum(len(plan.obj_urls) for plan in plans if plan.download)
+    unique = len(set(obj_hash for plan in plans if plan.download for obj_hash in plan.obj_urls))
+    if unique < total:
+        print("%d of %d fragments are shared between packages." % (total - unique, total))
+
+    _download_planned_fragments(plans, max_bandwidth)
+    for plan in plans:
+        _finish_install(plan)
+
+def _resolve_hash(session, package, hash=None, version=None, tag=None):
+    """
+    Looks up the hash of a package instance on the server by its hash prefix, version, or tag.
+    """
+    team, owner, pkg, _ = parse_package(package, allow_subpath=True)
+    if version is not None:
+        response = session.get(
+            "{url}/api/version/{owner}/{pkg}/{version}".format(
+                url=get_registry_url(team),
+                owner=owner,
+                pkg=pkg,
+                version=version
+            )
+        )
+        return response.json()['hash']
+    elif tag is not None:
+        response = session.get(
+            "{url}/api/tag/{owner}/{pkg}/{tag}".format(
+                url=get_registry_url(team),
+                owner=owner,
+                pkg=pkg,
+                tag=tag
+            )
+        )
+        return response.json()['hash']
+    else:
+        return _match_hash(package, hash)
+
+def install(package, hash=None, version=None, tag=None, force=False, meta_only=False, max_bandwidth=None,
+            lazy=False, include=None, exclude=None, resume=False):
     """
     Download a Quilt data package from the server and install locally.
 
     At most one of `hash`, `version`, or `tag` can be given. If none are
     given, `tag` defaults to "latest".
+    `max_bandwidth` limits the download rate, in MB/s (default: $QUILT_MAX_BANDWIDTH, or unlimited).
+    With `lazy`, only the metadata is downloaded; fragments are fetched when the data is first used.
+    `include` and `exclude` are lists of node path patterns, like "raw/2017*" or "*/images/**":
+    only the nodes matching an `include` pattern (if any) and no `exclude` pattern are downloaded.
+    The rest of a partially-installed package is fetched when it's first used, like with `lazy`.
+    With `resume`, an interrupted install of the package continues where it stopped, without
+    downloading the metadata again; expired download URLs are requested again.
     """
-    if hash is version is tag is None:
-        tag = LATEST_TAG
-
     # @filename ==> read from file
     # newline = multiple lines ==> multiple requirements
     package = package.strip()
@@ -849,7 +1039,26 @@ def install(package, hash=None, version=None, tag=None, force=False, meta_only=F
         raise CommandException("package name is empty.")
 
     if package[0] == '@' or '\n' in package:
-        return install_via_requirements(package, force=force)
+        return install_via_requirements(package, force=force, max_bandwidth=max_bandwidth, lazy=lazy,
+                                        resume=resume)
+
+    plan = _plan_install(package, hash, version, tag, force=force, meta_only=meta_only, lazy=lazy,
+                         include=include, exclude=exclude, resume=resume)
+    if plan is None:
+        return
+
+    _download_planned_fragments([plan], max_bandwidth)
+    _finish_install(plan)
+
+def _plan_install(package, hash=None, version=None, tag=None, force=False, meta_only=False, lazy=False,
+                  include=None, exclude=None, resume=False):
+    """
+    First step of `install`: gets the package metadata (or reads it from the journal, to resume),
+    and returns an `InstallPlan` with the fragments to download; or None if the user doesn't
+    want to overwrite the installed package.
+    """
+    if hash is version is tag is None:
+        tag = LATEST_TAG
 
     assert [hash, version, tag].count(None) == 2
 
@@ -857,92 +1066,219 @@ def install(package, hash=None, version=None, tag=None, force=False, meta_only=F
     _check_team_id(team)
     session = _get_session(team)
     store = PackageStore()
-    existing_pkg = store.get_package(team, owner, pkg)
 
-    print("Downloading package metadata...")
+    from .data_transfer import TransferJournal
+    journal = TransferJournal(store.journal_path('install', team, owner, pkg))
+
+    # What was asked for, other than the hash (which can be a prefix of the journal's).
+    # Resuming an install of something else would install the wrong instance.
+    request = dict(package=package, version=version, tag=tag, meta_only=meta_only, lazy=lazy,
+                   include=include or [], exclude=exclude or [])
+    if resume and journal.header is not None:
+        if (journal.header.get('request') != request or
+                (hash is not None and not journal.header['hash'].startswith(hash.lower()))):
+            print("The interrupted install of {package} doesn't match this one; starting over.".format(
+                package=journal.header['package']))
+            resume = False
+
+    if resume and journal.header is not None:
+        pkghash = journal.header['hash']
+        contents = journal.header['contents']
+        partial = journal.header['partial']
+        pending = journal.pending()
+        print("Resuming the install of {package}: {done} of {total} fragments already downloaded.".format(
+            package=journal.header['package'], done=len(journal.done), total=len(journal.urls)))
+
+        if pending and journal.urls_expired():
+            print("Refreshing download URLs...")
+            journal.add_urls(*_get_object_urls(team, pending))
+        obj_urls = {obj_hash: journal.urls[obj_hash] for obj_hash in pending}
+        obj_sizes = {obj_hash: journal.sizes[obj_hash] for obj_hash in pending}
+        download = True
+    else:
+        if resume:
+            print("No interrupted install of {package} to resume.".format(package=package))
 
-    try:
-        if version is not None:
-            response = session.get(
-                "{url}/api/version/{owner}/{pkg}/{version}".format(
-                    url=get_registry_url(team),
-                    owner=owner,
-                    pkg=pkg,
-                    version=version
-                )
-            )
-            pkghash = response.json()['hash']
-        elif tag is not None:
-            response = session.get(
-                "{url}/api/tag/{owner}/{pkg}/{tag}".format(
-                    url=get_registry_url(team),
-                    owner=owner,
-                    pkg=pkg,
-                    tag=tag
-                )
-            )
-            pkghash = response.json()['hash']
-        else:
-            pkghash = _match_hash(package, hash)
-    except HTTPResponseException as e:
-        logged_in_team = _find_logged_in_team()
-        if (team is None and logged_in_team is not None
-                and e.response.status_code == requests.codes.not_found):
-            raise CommandException("Package {owner}/{pkg} does not exist. "
-                                   "Maybe you meant {team}:{owner}/{pkg}?".format(
-                                   owner=owner, pkg=pkg, team=logged_in_team))
-        else:
-            raise
+        existing_pkg = store.get_package(team, owner, pkg)
 
-    assert pkghash is not None
+        print("Downloading package metadata...")
 
-    response = session.get(
-        "{url}/api/package/{owner}/{pkg}/{hash}".format(
-            url=get_registry_url(team),
-            owner=owner,
-            pkg=pkg,
-            hash=pkghash
-        ),
-        params=dict(
-            subpath='/'.join(subpath),
-            meta_only='true' if meta_only else ''
+        try:
+            pkghash = _resolve_hash(session, package, hash, version, tag)
+        except HTTPResponseException as e:
+            import requests
+            logged_in_team = _find_logged_in_team()
+            if (team is None and logged_in_team is not None
+                    and e.response.status_code == requests.codes.not_found):
+                raise CommandException("Package {owner}/{pkg} does not exist. "
+                                       "Maybe you meant {team}:{owner}/{pkg}?".format(
+                                       owner=owner, pkg=pkg, team=logged_in_team))
+            else:
+                raise
+
+        assert pkghash is not None
+
+        response = session.get(
+            "{url}/api/package/{owner}/{pkg}/{hash}".format(
+                url=get_registry_url(team),
+                owner=owner,
+                pkg=pkg,
+                hash=pkghash
+            ),
+            params=dict(
+                subpath='/'.join(subpath),
+                meta_only='true' if meta_only or lazy else '',
+                include=include or [],
+                exclude=exclude or []
+            )
         )
-    )
-    assert response.ok # other responses handled by _handle_response
+        assert response.ok # other responses handled by _handle_response
+
+        if existing_pkg is not None and not force:
+            print("{package} already installed.".format(package=package))
+            overwrite = input("Overwrite? (y/n) ")
+            if overwrite.lower() != 'y':
+                return None
+
+        dataset = response.json(object_hook=decode_node)
+        contents = dataset['contents']
+
+        # Verify contents hash
+        if pkghash != hash_contents(contents):
+            raise CommandException("Mismatched hash. Try again.")
+
+        partial = bool(lazy or subpath or include or exclude)
+        download = not meta_only and not lazy
+        obj_urls = {}
+        obj_sizes = {}
+        if download:
+            obj_urls = dataset['urls']
+            obj_sizes = dataset['sizes']
+
+            # Older registries ignore the patterns.
+            if include or exclude:
+                wanted = set(find_matching_object_hashes(contents, include or [], exclude or []))
+                for obj_hash in list(obj_urls):
+                    if obj_hash not in wanted:
+                        del obj_urls[obj_hash]
+                        del obj_sizes[obj_hash]
+
+        journal.start(dict(package=package, hash=pkghash, contents=contents, partial=partial,
+                           request=request))
+        journal.add_urls(obj_urls, obj_sizes)
 
-    if existing_pkg is not None and not force:
-        print("{package} already installed.".format(package=package))
-        overwrite = input("Overwrite? (y/n) ")
-        if overwrite.lower() != 'y':
-            return
+    pkgobj = store.install_package(team, owner, pkg, contents)
 
-    dataset = response.json(object_hook=decode_node)
-    contents = dataset['contents']
+    if partial:
+        pkgobj.set_remote(team)
 
-    # Verify contents hash
-    if pkghash != hash_contents(contents):
-        raise CommandException("Mismatched hash. Try again.")
+    return InstallPlan(pkgobj, journal, obj_urls, obj_sizes, download, partial)
 
-    pkgobj = store.install_package(team, owner, pkg, contents)
+class _PlanJournals(object):
+    """
+    Records each downloaded fragment in the journals of all the install plans that need it.
+    """
+    def __init__(self, plans):
+        self._journals = {}
+        for plan in plans:
+            for obj_hash in plan.obj_urls:
+                self._journals.setdefault(obj_hash, []).append(plan.journal)
 
-    if not meta_only:
-        obj_urls = dataset['urls']
-        obj_sizes = dataset['sizes']
+    def object_done(self, obj_hash):
+        for journal in self._journals.get(obj_hash, []):
+            journal.object_done(obj_hash)
 
-        # Skip the objects we already have
-        for obj_hash in list(obj_urls):
-            if os.path.exists(store.object_path(obj_hash)):
-                del obj_urls[obj_hash]
-                del obj_sizes[obj_hash]
+def _download_planned_fragments(plans, max_bandwidth=None):
+    """
+    Downloads the fragments of several install plans at once; fragments shared by
+    the packages are only downloaded once. They're recorded in the plans' journals,
+    so any of the installs can be resumed.
+    """
+    obj_urls = {}
+    obj_sizes = {}
+    for plan in plans:
+        if plan.download:
+            obj_urls.update(plan.obj_urls)
+            obj_sizes.update(plan.obj_sizes)
 
-        if obj_urls:
-            success = download_fragments(store, obj_urls, obj_sizes)
-            if not success:
-                raise CommandException("Failed to download fragments")
-        else:
-            print("All fragments are already downloaded!")
+    if not any(plan.download for plan in plans):
+        return
 
-    pkgobj.save_contents()
+    store = plans[0].pkgobj.get_store()
+
+    # Skip the objects we already have
+    for obj_hash in list(obj_urls):
+        if os.path.exists(store.object_path(obj_hash)):
+            del obj_urls[obj_hash]
+            del obj_sizes[obj_hash]
+
+    for obj_hash in _link_objects(store, {obj_hash: obj_sizes.get(obj_hash) for obj_hash in obj_urls}):
+        del obj_urls[obj_hash]
+        del obj_sizes[obj_hash]
+
+    if obj_urls:
+        from .data_transfer import download_fragments
+        success = download_fragments(store, obj_urls, obj_sizes, max_bandwidth=max_bandwidth,
+                                     journal=_PlanJournals(plans))
+        if not success:
+            raise CommandException("Failed to download fragments; "
+                                   "install it again with --resume to continue.")
+    else:
+        print("All fragments are already downloaded!")
+
+def _link_objects(store, obj_sizes):
+    """
+    Links the objects found in the other package directories into `store`, so they don't need
+    to be downloaded. `obj_sizes` maps their hashes to their sizes, or None. Returns the hashes
+    of the linked objects.
+    """
+    linked = set(obj_hash for obj_hash, size in iteritems(obj_sizes) if store.link_object(obj_hash, size))
+    if linked:
+        print("Linked %d fragments from other package directories." % len(linked))
+    return linked
+
+def _finish_install(plan):
+    """
+    Last step of `install`: saves the package, once its fragments are downloaded.
+    """
+    plan.pkgobj.save_contents()
+    if not plan.partial:
+        # All of its fragments are there now; until then, a lazy install of it keeps working.
+        plan.pkgobj.clear_remote()
+    plan.journal.remove()
+
+def _get_object_urls(team, obj_hashes):
+    """
+    Gets download URLs and sizes of objects from the registry, regardless of their packages.
+    """
+    session = _get_session(team)
+    response = session.post(
+        "{url}/api/get_objects".format(url=get_registry_url(team)),
+        data=json.dumps(sorted(obj_hashes))
+    )
+    dataset = response.json()
+    obj_urls = dataset['urls']
+    obj_sizes = dataset['sizes']
+
+    unavailable = set(obj_hashes) - set(obj_urls)
+    if unavailable:
+        raise CommandException("Fragments are no longer available: %s" % ', '.join(sorted(unavailable)))
+
+    return obj_urls, obj_sizes
+
+def _fetch_fragments(team, store, obj_hashes, max_bandwidth=None):
+    """
+    Downloads fragments of a lazily-installed package into `store`.
+    """
+    missing = set(obj_hashes) - _link_objects(store, dict.fromkeys(obj_hashes))
+    if not missing:
+        return
+
+    obj_urls, obj_sizes = _get_object_urls(team, missing)
+
+    from .data_transfer import download_fragments
+    if not download_fragments(store, obj_urls, obj_sizes, max_bandwidth=max_bandwidth):
+        raise CommandException("Failed to download fragments")
 
 def access_list(package):
     """
@@ -1068,6 +1404,7 @@ def inspect(package):
             print(prefix + name_prefix + name)
             _print_children(children, child_prefix, path + name)
         elif isinstance(node, TableNode):
+            import pandas as pd
             df = store.load_dataframe(node.hashes)
             assert isinstance(df, pd.DataFrame)
             info = "shape %s, type \"%s\"" % (df.shape, df.dtypes)
@@ -1080,6 +1417,121 @@ def inspect(package):
     print(pkgobj.get_path())
     _print_children(children=pkgobj.get_contents().children.items(), prefix='', path='')
 
+def _load_instance(package):
+    """
+    Returns the contents (or a subpath) of a package instance given as
+    [team:]owner/package_name/path[:h:<hash> or :t:<tag> or :v:<version>].
+    Installed instances are read from the local stores; otherwise, their
+    manifest is downloaded from the registry.
+    """
+    info = parse_package_extended(package)
+    team, owner, pkg, subpath = parse_package(info.full_name, allow_subpath=True)
+
+    contents = None
+    if info.version is None:
+        for store_dir in PackageStore.find_store_dirs():
+            store = PackageStore(store_dir)
+            try:
+                if info.hash is not None:
+                    pkghash = store.find_instance(team, owner, pkg, hash_prefix=info.hash)
+                else:
+                    pkghash = store.find_instance(team, owner, pkg, tag=info.tag or LATEST_TAG)
+            except StoreException as ex:
+                raise CommandException(str(ex))
+            if pkghash is not None:
+                contents = store.get_package(team, owner, pkg, pkghash=pkghash).get_contents()
+                break
+
+    if contents is None:
+        session = _get_session(team)
+        tag = LATEST_TAG if info.hash is info.version is info.tag is None else info.tag
+        pkghash = _resolve_hash(session, info.full_name, info.hash, info.version, tag)
+        response = session.get(
+            "{url}/api/package/{owner}/{pkg}/{hash}".format(
+                url=get_registry_url(team),
+                owner=owner,
+                pkg=pkg,
+                hash=pkghash
+            ),
+            params=dict(
+                meta_only='true'
+            )
+        )
+        contents = response.json(object_hook=decode_node)['contents']
+        if hash_contents(contents) != pkghash:
+            raise CommandException("Mismatched hash. Try again.")
+
+    node = contents
+    for name in subpath:
+        if not isinstance(node, GroupNode) or name not in node.children:
+            raise CommandException("Node {path!r} not found in {package}.".format(
+                path='/'.join(subpath), package=package))
+        node = node.children[name]
+    return node
+
+def _local_object_size(stores, hashes):
+    size = 0
+    for obj_hash in hashes:
+        for store in stores:
+            path = store.object_path(obj_hash)
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+                break
+        else:
+            return None
+    return size
+
+def diff(package_a, package_b):
+    """
+    Compares two instances of a package (or of different packages), e.g.
+    diff('owner/package_name:h:<hash>', 'owner/package_name').
+
+    Returns a list of NodeDiff tuples, one for each file or table node that
+    was added, removed or modified, in path order. `size_delta` is the change
+    in size of the node's objects, or None if some objects aren't installed
+    locally. Identical subtrees are skipped without being compared.
+    """
+    old = _load_instance(package_a)
+    new = _load_instance(package_b)
+    stores = [PackageStore(store_dir) for store_dir in PackageStore.find_store_dirs()]
+
+    results = []
+    for path, old_node, new_node in diff_trees(old, new):
+        if old_node is None:
+            change = 'added'
+        elif new_node is None:
+            change = 'removed'
+        else:
+            change = 'modified'
+        old_hashes = old_node.hashes if old_node is not None else None
+        new_hashes = new_node.hashes if new_node is not None else None
+        old_size = _local_object_size(stores, old_hashes) if old_hashes is not None else 0
+        new_size = _local_object_size(stores, new_hashes) if new_hashes is not None else 0
+        size_delta = None if old_size is None or new_size is None else new_size - old_size
+        results.append(NodeDiff('/'.join(path), change, old_hashes, new_hashes, size_delta))
+    return results
+
+def _format_size_delta(size_delta):
+    if size_delta is None:
+        return "?"
+    return ("-" if size_delta < 0 else "+") + format_bytes(abs(size_delta))
+
+def _cli_diff(package_a, package_b):
+    changes = diff(package_a, package_b)
+    if not changes:
+        print("No differences.")
+        return
+
+    symbols = dict(added='+', removed='-', modified='M')
+    _print_table([(symbols[item.change], item.path, _format_size_delta(item.size_delta))
+                  for item in changes])
+
+    counts = Counter(item.change for item in changes)
+    deltas = [item.size_delta for item in changes]
+    total = None if None in deltas else sum(deltas)
+    print("%d added, %d removed, %d modified; size change: %s" % (
+        counts['added'], counts['removed'], counts['modified'], _format_size_delta(total)))
+
 def rm(package, force=False):
     """
     Remove a package (all instances) from the local store.
@@ -1428,6 +1880,12 @@ def export(package, output_path='.', force=False):
     else:
         subpath = pathlib.PureWindowsPath()
 
+    # Download the missing fragments of a lazily-installed package in one batch, not node by node.
+    try:
+        node._package.fetch_missing_fragments([node._node])
+    except PackageException as ex:
+        raise CommandException(str(ex))
+
     resolved_output = resolve_dirpath(output_path)  # resolve/create output path
     exports = iter_filename_map(node, subpath)      # Create src / dest map iterator
     exports = finalize(resolved_output, exports)    # Fix absolutes, check dest nonexistent, prefix dest dir
@@ -1442,6 +1900,7 @@ def export(package, output_path='.', force=False):
         return
 
     # All prep done, let's export..
+    from tqdm import tqdm
     try:
         fmt = "Exporting file {n_fmt} of {total_fmt} [{elapsed}]"
         sys.stdout.flush()   # flush prior text before making progress bar
@@ -5,8 +5,12 @@
 # Do not add any client or server specific code here.      #
 ############################################################
 
+from array import array
+import binascii
 from enum import Enum
 import hashlib
+import json
+import re
 import struct
 
 from six import iteritems, itervalues, string_types
@@ -74,16 +78,67 @@ class Node(object):
             else:
                 stack.extend(itervalues(obj.get_children()))
 
+class ChildMap(dict):
+    """
+    Children of a GroupNode: a dict that also holds the group's hashing
+    state (see `hash_contents`), and forgets it when modified.
+    """
+    __slots__ = ('_memo',)
+
+    def __init__(self, *args, **kwargs):
+        super(ChildMap, self).__init__(*args, **kwargs)
+        self._memo = None
+
+    def _modified(self):
+        self._memo = None
+
+    def __setitem__(self, key, value):
+        self._modified()
+        super(ChildMap, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._modified()
+        super(ChildMap, self).__delitem__(key)
+
+    def clear(self):
+        self._modified()
+        super(ChildMap, self).clear()
+
+    def pop(self, *args):
+        self._modified()
+        return super(ChildMap, self).pop(*args)
+
+    def popitem(self):
+        self._modified()
+        return super(ChildMap, self).popitem()
+
+    def setdefault(self, key, default=None):
+        self._modified()
+        return super(ChildMap, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._modified()
+        super(ChildMap, self).update(*args, **kwargs)
+
 class GroupNode(Node):
-    __slots__ = ('children',)
+    __slots__ = ('_children',)
 
     json_type = 'GROUP'
 
     def __init__(self, children, metadata=None):
         super(GroupNode, self).__init__(metadata)
-        assert isinstance(children, dict)
         self.children = children
 
+    @property
+    def children(self):
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        assert isinstance(children, dict)
+        # Keep an existing ChildMap (and its hashing state) rather than copying it.
+        self._children = children if isinstance(children, ChildMap) else ChildMap(children)
+
     def get_children(self):
         return self.children
 
@@ -149,6 +204,120 @@ def decode_node(value):
     node_cls = NODE_TYPE_TO_CLASS[type_str]
     return node_cls(**value)
 
+def _encode_int(value):
+    return struct.pack(">L", value)
+
+def _encode_str(string):
+    assert isinstance(string, string_types)
+    return _encode_int(len(string)) + string.encode()
+
+def _encode_leaf(node):
+    assert isinstance(node, (TableNode, FileNode)), "Unexpected object: %r" % node
+    hashes = node.hashes
+    parts = [_encode_str(node.json_type), _encode_int(len(hashes))]
+    parts.extend(_encode_str(hval) for hval in hashes)
+    return b''.join(parts)
+
+def _encode_compact(node):
+    parts = []
+    node._manifest._hash_node(node._index,
+                              lambda value: parts.append(_encode_int(value)),
+                              lambda string: parts.append(_encode_str(string)))
+    return b''.join(parts)
+
+class _GroupMemo(object):
+    """
+    Hashing state of a group, valid as long as the group and its child groups are unchanged.
+
+    `rope` is the group's part of the `hash_contents` input: byte strings for the
+    group itself and its file and table children, and the memos of its child groups.
+    `digest` is a Merkle hash of the subtree, computed from the child groups' digests.
+
+    Neither includes the group's own type, which the parent (or `hash_contents`) adds:
+    the memo is cached on the `ChildMap`, which can be shared by groups of different types,
+    e.g. when a package's root children are reused in a `GroupNode`.
+    `contents_hash` is (type, `hash_contents` result) for the last type it was computed for.
+    """
+    __slots__ = ('rope', 'groups', 'digest', 'contents_hash')
+
+    def __init__(self, group, memos):
+        children = group.children
+        self.rope = []
+        self.groups = []
+        self.contents_hash = None
+        merkle = hashlib.sha256()
+        run = [_encode_int(len(children))]
+        for name, child in sorted(iteritems(children)):
+            run.append(_encode_str(name))
+            if isinstance(child, GroupNode):
+                run.append(_encode_str(child.json_type))
+                if isinstance(child, _CompactNode):
+                    # Compact trees are read-only, so there is nothing to track.
+                    child_memo = _get_memo(child._manifest.to_node(child._index))
+                else:
+                    child_memo = memos[id(child)]
+                    self.groups.append((child, child_memo))
+                data = b''.join(run)
+                merkle.update(data)
+                merkle.update(child_memo.digest)
+                self.rope.extend([data, child_memo])
+                run = []
+            elif isinstance(child, _CompactNode):
+                run.append(_encode_compact(child))
+            else:
+                run.append(_encode_leaf(child))
+        data = b''.join(run)
+        merkle.update(data)
+        self.rope.append(data)
+        self.digest = merkle.digest()
+
+def _get_memo(root):
+    """
+    Returns the hashing state of `root`, only recomputing it for the groups
+    that changed (and their ancestors) since it was last computed.
+
+    Only groups track changes: file and table nodes are treated as immutable,
+    so replace them rather than modifying their hashes.
+    """
+    memos = {}
+    # Iterative post-order over groups only.
+    stack = [(root, False)]
+    while stack:
+        group, visited = stack.pop()
+        if id(group) in memos:
+            continue
+        memo = getattr(group.children, '_memo', None)
+        if not visited:
+            stack.append((group, True))
+            if memo is not None:
+                child_groups = [child for child, _ in memo.groups]
+            else:
+                child_groups = [child for child in itervalues(group.children)
+                                if isinstance(child, GroupNode) and not isinstance(child, _CompactNode)]
+            stack.extend((child, False) for child in child_groups)
+            continue
+        if memo is None or any(memos[id(child)] is not child_memo for child, child_memo in memo.groups):
+            memo = _GroupMemo(group, memos)
+            if isinstance(group.children, ChildMap):
+                group.children._memo = memo
+        memos[id(group)] = memo
+    return memos[id(root)]
+
+def subtree_hash(node):
+    """
+    Returns a hash of the subtree (names, node types and object hashes) rooted at `node`.
+
+    Unlike `hash_contents`, it is a Merkle hash: it's cached for each group,
+    so comparing two mostly identical trees only looks at the parts that differ.
+    """
+    if not isinstance(node, GroupNode):
+        data = _encode_compact(node) if isinstance(node, _CompactNode) else _encode_leaf(node)
+        return hashlib.sha256(data).hexdigest()
+    if isinstance(node, _CompactNode):
+        node = node._manifest.to_node(node._index)
+    digest = hashlib.sha256(_encode_str(node.json_type) + _get_memo(node).digest).digest()
+    return binascii.hexlify(digest).decode('ascii')
+
 def hash_contents(contents):
     """
     Creates a hash of key names and hashes in a package dictionary.
@@ -157,35 +326,58 @@ def hash_contents(contents):
     """
     assert isinstance(contents, GroupNode)
 
-    result = hashlib.sha256()
+    if isinstance(contents, _CompactNode):
+        return hashlib.sha256(_encode_compact(contents)).hexdigest()
 
-    def _hash_int(value):
-        result.update(struct.pack(">L", value))
-
-    def _hash_str(string):
-        assert isinstance(string, string_types)
-        _hash_int(len(string))
-        result.update(string.encode())
-
-    def _hash_object(obj):
-        _hash_str(obj.json_type)
-        if isinstance(obj, (TableNode, FileNode)):
-            hashes = obj.hashes
-            _hash_int(len(hashes))
-            for hval in hashes:
-                _hash_str(hval)
-        elif isinstance(obj, GroupNode):
-            children = obj.children
-            _hash_int(len(children))
-            for key, child in sorted(iteritems(children)):
-                _hash_str(key)
-                _hash_object(child)
-        else:
-            assert False, "Unexpected object: %r" % obj
+    memo = _get_memo(contents)
+    if memo.contents_hash is None or memo.contents_hash[0] != contents.json_type:
+        result = hashlib.sha256()
+        result.update(_encode_str(contents.json_type))
+        stack = [iter(memo.rope)]
+        while stack:
+            for part in stack[-1]:
+                if isinstance(part, _GroupMemo):
+                    stack.append(iter(part.rope))
+                    break
+                result.update(part)
+            else:
+                stack.pop()
+        memo.contents_hash = (contents.json_type, result.hexdigest())
+    return memo.contents_hash[1]
 
-    _hash_object(contents)
+def diff_trees(old, new):
+    """
+    Iterator over the differences between two trees. Yields (path, old_node, new_node)
+    tuples for file and table nodes that were added (old_node is None), removed
+    (new_node is None), or whose type or object hashes changed. Paths are tuples
+    of names, in sorted order. Metadata is not compared.
 
-    return result.hexdigest()
+    Groups with the same `subtree_hash` are skipped without being traversed.
+    """
+    stack = [((), old, new)]
+    while stack:
+        path, old_node, new_node = stack.pop()
+        old_group = isinstance(old_node, GroupNode)
+        new_group = isinstance(new_node, GroupNode)
+        if old_group and new_group:
+            if subtree_hash(old_node) == subtree_hash(new_node):
+                continue
+            old_children = old_node.children
+            new_children = new_node.children
+            names = sorted(set(old_children) | set(new_children), reverse=True)
+            stack.extend((path + (name,), old_children.get(name), new_children.get(name)) for name in names)
+        elif old_group or new_group:
+            # A group on one side only: all of its contents were added or removed.
+            if old_node is not None and not old_group:
+                yield path, old_node, None
+            if new_node is not None and not new_group:
+                yield path, None, new_node
+            group = old_node if old_group else new_node
+            for name, child in sorted(iteritems(group.children), reverse=True):
+                stack.append((path + (name,), child, None) if old_group else (path + (name,), None, child))
+        elif (old_node is None or new_node is None or
+              old_node.json_type != new_node.json_type or old_node.hashes != new_node.hashes):
+            yield path, old_node, new_node
 
 def find_object_hashes(root, sort=False):
     """
@@ -194,7 +386,328 @@ def find_object_hashes(root, sort=False):
     :param root: starting node
     :param sort: within each group, sort child nodes by name
     """
+    if isinstance(root, _CompactNode):
+        for objhash in root._manifest._iter_hashes(root._index, sort):
+            yield objhash
+        return
+
     for obj in root.preorder(sort=sort):
         if isinstance(obj, (TableNode, FileNode)):
             for objhash in obj.hashes:
                 yield objhash
+
+def _path_pattern_regex(pattern):
+    """
+    Compiles a node path pattern: `*` and `?` match within a node name, `**` matches across names.
+    """
+    parts = []
+    for token in re.split(r'(\*\*|\*|\?)', pattern.strip('/')):
+        if token == '**':
+            parts.append('.*')
+        elif token == '*':
+            parts.append('[^/]*')
+        elif token == '?':
+            parts.append('[^/]')
+        else:
+            parts.append(re.escape(token))
+    return re.compile(''.join(parts) + r'\Z')
+
+def find_matching_object_hashes(root, include=(), exclude=()):
+    """
+    Iterator that returns hashes of the file and table nodes whose paths match
+    at least one of the `include` patterns (or all nodes, if there are none)
+    and none of the `exclude` patterns. Paths are relative to `root` and use "/";
+    a pattern that matches a group matches everything in it.
+    """
+    include_res = [_path_pattern_regex(pattern) for pattern in include]
+    exclude_res = [_path_pattern_regex(pattern) for pattern in exclude]
+
+    stack = [('', root, not include_res)]
+    while stack:
+        path, node, included = stack.pop()
+        if path:
+            if any(regex.match(path) for regex in exclude_res):
+                continue
+            included = included or any(regex.match(path) for regex in include_res)
+        if isinstance(node, GroupNode):
+            for name, child in iteritems(node.children):
+                stack.append((path + '/' + name if path else name, child, included))
+        elif included:
+            for objhash in node.hashes:
+                yield objhash
+
+
+class CompactManifest(object):
+    """
+    Read-only, array-backed copy of a package tree.
+
+    A regular tree costs several Python objects per node. Here, nodes are
+    stored in post-order in a handful of flat arrays: metadata keys are interned
+    into shared key tuples, object hashes are packed as 32-byte digests into one
+    bytearray, and each group's children are a sorted run of names and node
+    indices. `root` returns a lightweight view that implements the `Node` API,
+    so `preorder`, `find_object_hashes`, `hash_contents` and `encode_node`
+    work unchanged; use `to_node` to get back a regular, mutable tree.
+    """
+    NODE_TYPES = (GroupNode, RootNode, TableNode, FileNode)
+    DIGEST_SIZE = 32
+
+    def __init__(self):
+        self._types = bytearray()
+        self._first = array('I')                # Index of the first node of each subtree.
+        self._schemas = [()]                    # Interned tuples of metadata keys.
+        self._node_schema = array('I')
+        self._meta_values = []
+        self._meta_offsets = array('I', [0])
+        self._hashes = bytearray()
+        self._hash_offsets = array('I', [0])    # In digests, not bytes.
+        self._child_names = []
+        self._child_nodes = array('I')
+        self._child_offsets = array('I', [0])
+
+        self._schema_ids = {(): 0}
+        self._strings = {}
+
+    @classmethod
+    def from_node(cls, node):
+        """
+        Creates a compact copy of a regular tree.
+        """
+        manifest = cls()
+        # Iterative post-order: each group is added after all of its children.
+        stack = [(node, None)]
+        results = []
+        while stack:
+            obj, child_names = stack.pop()
+            if child_names is not None:
+                count = len(child_names)
+                indices = results[len(results) - count:]
+                del results[len(results) - count:]
+                results.append(manifest._add(obj, dict(zip(child_names, indices))))
+            elif isinstance(obj, GroupNode):
+                names = sorted(obj.children)
+                stack.append((obj, names))
+                stack.extend((obj.children[name], None) for name in reversed(names))
+            else:
+                results.append(manifest._add(obj, None))
+        manifest._finish()
+        return manifest
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Decodes a JSON manifest straight into the compact form, without
+        building the intermediate node objects.
+        """
+        manifest = cls()
+
+        def _object_hook(value):
+            type_str = value.pop('type', None)
+            if type_str is None:
+                return value
+            node_cls = NODE_TYPE_TO_CLASS[type_str]
+            return _CompactRef(manifest._add_json(node_cls, value))
+
+        root = json.loads(data, object_hook=_object_hook)
+        assert isinstance(root, _CompactRef) and root.index == len(manifest) - 1
+        manifest._finish()
+        return manifest
+
+    @classmethod
+    def load(cls, fp):
+        return cls.loads(fp.read())
+
+    def __len__(self):
+        return len(self._types)
+
+    @property
+    def root(self):
+        return self._view(len(self) - 1)
+
+    def to_node(self, index=None):
+        """
+        Converts the manifest (or the subtree at `index`) back into regular nodes.
+        """
+        if index is None:
+            index = len(self) - 1
+        nodes = {}
+        for idx in range(self._first[index], index + 1):
+            node_cls = self.NODE_TYPES[self._types[idx]]
+            metadata = self._metadata(idx)
+            if issubclass(node_cls, GroupNode):
+                start, end = self._child_offsets[idx], self._child_offsets[idx + 1]
+                children = {
+                    self._child_names[pos]: nodes.pop(self._child_nodes[pos])
+                    for pos in range(start, end)
+                }
+                nodes[idx] = node_cls(children, metadata)
+            elif node_cls is TableNode:
+                nodes[idx] = TableNode(self._node_hashes(idx), PackageFormat.PARQUET.value, metadata)
+            else:
+                nodes[idx] = FileNode(self._node_hashes(idx), metadata)
+        return nodes[index]
+
+    def _intern(self, string):
+        return self._strings.setdefault(string, string)
+
+    def _add(self, node, children):
+        hashes = node.hashes if isinstance(node, (TableNode, FileNode)) else None
+        return self._append(NODE_TYPE_TO_CLASS[node.json_type], node.metadata, hashes, children)
+
+    def _add_json(self, node_cls, value):
+        children = value.get('children')
+        if children is not None:
+            children = {name: child.index for name, child in iteritems(children)}
+        return self._append(node_cls, value.get('metadata'), value.get('hashes'), children)
+
+    def _append(self, node_cls, metadata, hashes, children):
+        index = len(self._types)
+        self._types.append(self.NODE_TYPES.index(node_cls))
+
+        if metadata:
+            keys = tuple(self._intern(key) for key in metadata)
+            schema_id = self._schema_ids.get(keys)
+            if schema_id is None:
+                schema_id = self._schema_ids[keys] = len(self._schemas)
+                self._schemas.append(keys)
+            self._node_schema.append(schema_id)
+            for value in itervalues(metadata):
+                self._meta_values.append(self._intern(value) if isinstance(value, string_types) else value)
+        else:
+            self._node_schema.append(0)
+        self._meta_offsets.append(len(self._meta_values))
+
+        for objhash in hashes or ():
+            if len(objhash) != self.DIGEST_SIZE * 2 or objhash != objhash.lower():
+                raise ValueError("Invalid object hash: %r" % objhash)
+            self._hashes += binascii.unhexlify(objhash)
+        self._hash_offsets.append(len(self._hashes) // self.DIGEST_SIZE)
+
+        first = index
+        for name, child in sorted(iteritems(children or {})):
+            self._child_names.append(self._intern(name))
+            self._child_nodes.append(child)
+            first = min(first, self._first[child])
+        self._child_offsets.append(len(self._child_nodes))
+        self._first.append(first)
+        return index
+
+    def _finish(self):
+        # Only needed while building.
+        self._schema_ids = None
+        self._strings = None
+
+    def _view(self, index):
+        return _COMPACT_VIEWS[self._types[index]](self, index)
+
+    def _metadata(self, index):
+        values = self._meta_values[self._meta_offsets[index]:self._meta_offsets[index + 1]]
+        return dict(zip(self._schemas[self._node_schema[index]], values))
+
+    def _node_hashes(self, index):
+        return list(self._iter_hex(self._hash_offsets[index], self._hash_offsets[index + 1]))
+
+    def _iter_hex(self, start, end):
+        size = self.DIGEST_SIZE
+        for pos in range(start, end):
+            yield binascii.hexlify(self._hashes[pos * size:(pos + 1) * size]).decode('ascii')
+
+    def _child_range(self, index):
+        return range(self._child_offsets[index], self._child_offsets[index + 1])
+
+    def _iter_hashes(self, index, sort=False):
+        if sort:
+            for idx in self._iter_preorder(index):
+                for objhash in self._iter_hex(self._hash_offsets[idx], self._hash_offsets[idx + 1]):
+                    yield objhash
+        else:
+            # Subtrees are contiguous, so their hashes are, too.
+            for objhash in self._iter_hex(self._hash_offsets[self._first[index]], self._hash_offsets[index + 1]):
+                yield objhash
+
+    def _iter_preorder(self, index):
+        stack = [index]
+        while stack:
+            idx = stack.pop()
+            yield idx
+            stack.extend(self._child_nodes[pos] for pos in reversed(self._child_range(idx)))
+
+    def _hash_node(self, index, hash_int, hash_str):
+        # Iterative pre-order, like `_iter_preorder`; each child is preceded by its name.
+        stack = [(index, None)]
+        while stack:
+            idx, name = stack.pop()
+            if name is not None:
+                hash_str(name)
+            node_cls = self.NODE_TYPES[self._types[idx]]
+            hash_str(node_cls.json_type)
+            if issubclass(node_cls, GroupNode):
+                children = self._child_range(idx)
+                hash_int(len(children))
+                stack.extend((self._child_nodes[pos], self._child_names[pos]) for pos in reversed(children))
+            else:
+                hashes = self._node_hashes(idx)
+                hash_int(len(hashes))
+                for hval in hashes:
+                    hash_str(hval)
+
+class _CompactRef(object):
+    """
+    Placeholder for an already-decoded node while parsing JSON.
+    """
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+class _CompactNode(object):
+    """
+    Read-only `Node` API on top of a `CompactManifest`. Attributes are
+    computed on access; modifying them does not change the manifest.
+    """
+    __slots__ = ()
+
+    def __init__(self, manifest, index):
+        self._manifest = manifest
+        self._index = index
+
+    @property
+    def metadata(self):
+        return self._manifest._metadata(self._index)
+
+    @property
+    def children(self):
+        manifest = self._manifest
+        return {
+            manifest._child_names[pos]: manifest._view(manifest._child_nodes[pos])
+            for pos in manifest._child_range(self._index)
+        }
+
+    @property
+    def hashes(self):
+        return self._manifest._node_hashes(self._index)
+
+    def get_children(self):
+        return self.children
+
+    def preorder(self, sort=False):
+        """
+        Same as `Node.preorder`; children are always returned sorted by name.
+        """
+        manifest = self._manifest
+        for index in manifest._iter_preorder(self._index):
+            yield manifest._view(index)
+
+class _CompactGroupNode(_CompactNode, GroupNode):
+    __slots__ = ('_manifest', '_index')
+
+class _CompactRootNode(_CompactNode, RootNode):
+    __slots__ = ('_manifest', '_index')
+
+class _CompactTableNode(_CompactNode, TableNode):
+    __slots__ = ('_manifest', '_index')
+
+class _CompactFileNode(_CompactNode, FileNode):
+    __slots__ = ('_manifest', '_index')
+
+_COMPACT_VIEWS = (_CompactGroupNode, _CompactRootNode, _CompactTableNode, _CompactFileNode)
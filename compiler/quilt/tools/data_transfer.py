@@ -3,12 +3,17 @@ High-level helper functions for uploading and downloading fragments.
 """
 
 from __future__ import print_function
-import gzip
+from collections import deque
+import hashlib
+import json
 import os
 import re
-from shutil import copyfileobj, move
+from shutil import move
 import tempfile
-from threading import Thread, Lock
+from threading import Condition, local, Lock, Thread
+import time
+import uuid
+import zlib
 
 import requests
 from requests.adapters import HTTPAdapter
@@ -16,23 +21,72 @@ from requests.packages.urllib3.util.retry import Retry
 from six import iteritems, itervalues
 from tqdm import tqdm
 
-from .hashing import digest_file
-from .util import FileWithReadProgress, get_free_space
+from .const import HASH_TYPE, QuiltException
+from .core import decode_node, encode_node
+from .util import FileWithReadProgress, ZSTD_MAGIC, format_bytes, get_free_space, have_zstd
 
 
 PARALLEL_UPLOADS = 20
 PARALLEL_DOWNLOADS = 20
 
+# Unless the number of threads is given, the number of concurrent transfers starts at
+# PARALLEL_UPLOADS/PARALLEL_DOWNLOADS, goes up by one every ADJUST_INTERVAL seconds
+# while the throughput keeps improving, and is halved after timeouts or throttling.
+MIN_PARALLEL_TRANSFERS = 2
+MAX_PARALLEL_TRANSFERS = 100
+ADJUST_INTERVAL = 2.0
+THROTTLING_STATUS_CODES = frozenset([429, 503])
+
+# Default for the `max_bandwidth` of transfers, in MB/s.
+MAX_BANDWIDTH_ENV = 'QUILT_MAX_BANDWIDTH'
+
+# How often the progress bar is updated, in seconds.
+PROGRESS_INTERVAL = 0.2
+
 S3_CONNECT_TIMEOUT = 30
 S3_READ_TIMEOUT = 30
 S3_TIMEOUT_RETRIES = 3
 
 CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
 
-CHUNK_SIZE = 4096
+CHUNK_SIZE = 256 * 1024
+
+# Objects larger than this (uncompressed) are downloaded in parts, in parallel.
+RANGE_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+RANGE_PART_SIZE = 16 * 1024 * 1024
+
+# Objects larger than this (uncompressed) are uploaded in parts, in parallel, if the registry supports it.
+MULTIPART_UPLOAD_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_PART_SIZE = 8 * 1024 * 1024  # S3 requires at least 5MB, except for the last part.
+MULTIPART_MAX_PARTS = 10000
+MULTIPART_RETRIES = 3
+
+# Pre-signed URLs older than this are requested again when resuming a transfer.
+# (The registry's default expiration is 24 hours.)
+JOURNAL_URL_LIFETIME = 60 * 60
 
 ZLIB_LEVEL = 2
 
+GZIP_WBITS = 16 + zlib.MAX_WBITS  # Tells zlib to use a gzip header and trailer.
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Registries that store zstd'ed fragments (see `S3Blob.encoding`) offer a `zstd_put` URL
+# for each new object on push, for a copy next to the gzip'ed one, which older clients read;
+# installs get the zstd'ed copies if the session accepts zstd. Downloads tell the formats
+# apart by their magic bytes (see `FragmentWriter`).
+
+# Objects whose samples don't compress to less than this ratio of their size are
+# uploaded as they are (e.g., images, or data that's already compressed).
+COMPRESSION_MAX_RATIO = 0.9
+COMPRESSION_SAMPLES = 4
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+
+# Objects larger than this are compressed in blocks, by a pool of threads with one per core
+# (zlib releases the GIL). Each block becomes a gzip member of its own; any gzip decoder
+# reads the concatenated members as one stream.
+PARALLEL_COMPRESSION_THRESHOLD = 64 * 1024 * 1024
+COMPRESSION_BLOCK_SIZE = 8 * 1024 * 1024
+
 
 # pyOpenSSL and S3 don't play well together. pyOpenSSL is completely optional, but gets enabled by requests.
 # So... We disable it. That's what boto does.
@@ -45,30 +99,598 @@ except ImportError:
     pass
 
 
-def create_s3_session():
+def create_s3_session(pool_size=PARALLEL_DOWNLOADS):
     """
-    Creates a session with automatic retries on 5xx errors.
+    Creates a session with automatic retries on 5xx errors, which keeps up to `pool_size`
+    connections alive, so it can be shared by that many threads.
     """
     sess = requests.Session()
     retries = Retry(total=3,
                     backoff_factor=.5,
                     status_forcelist=[500, 502, 503, 504])
-    sess.mount('https://', HTTPAdapter(max_retries=retries))
+    sess.mount('https://', HTTPAdapter(max_retries=retries, pool_maxsize=pool_size))
+    sess.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
     return sess
 
-def download_fragments(store, obj_urls, obj_sizes):
+class ProgressCounter(object):
+    """
+    Counts the progress of worker threads, each in its own counter, so they don't
+    contend on a lock for every chunk; `flush` adds it up and updates the progress bar.
+    """
+    def __init__(self, progress):
+        self._progress = progress
+        self._local = local()
+        self._counters = []
+        self._reported = 0
+
+    def register(self):
+        """
+        Creates the counter of the current thread.
+        """
+        self._local.counter = [0]
+        self._counters.append(self._local.counter)
+
+    def update(self, count):
+        self._local.counter[0] += count
+
+    def flush(self):
+        """
+        Updates the progress bar; returns the total so far.
+        """
+        total = sum(counter[0] for counter in list(self._counters))
+        self._progress.update(total - self._reported)
+        self._reported = total
+        return total
+
+class ConcurrencyLimit(object):
+    """
+    Limits the number of concurrent transfers; use it as a context manager around each one.
+
+    If `adaptive`, the limit is adjusted AIMD-style: it grows by one for as long as
+    the throughput improves, and is halved when the storage times out or throttles
+    requests (see `response_hook`).
+    """
+    def __init__(self, limit, adaptive):
+        self.limit = limit
+        self.adaptive = adaptive
+        self.max_limit = max(limit, MAX_PARALLEL_TRANSFERS) if adaptive else limit
+        self.peak = 0  # The most transfers that were actually running at once.
+        self._active = 0
+        self._condition = Condition()
+        self._congested = False
+        self._last_adjustment = None
+        self._throughput = 0
+
+    def __enter__(self):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+            self.peak = max(self.peak, self._active)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def congestion(self):
+        """
+        Reports a timeout or a throttled request.
+        """
+        self._congested = True
+
+    def response_hook(self, response, **kwargs):
+        """
+        Session hook that reports throttled requests, including the ones that were retried.
+        """
+        _ = kwargs
+        history = getattr(getattr(response.raw, 'retries', None), 'history', None) or ()
+        statuses = [response.status_code] + [entry.status for entry in history]
+        if any(status in THROTTLING_STATUS_CODES for status in statuses):
+            self.congestion()
+
+    def adjust(self, total_bytes):
+        """
+        Called periodically with the number of bytes transferred so far.
+        """
+        if not self.adaptive:
+            return
+        now = time.time()
+        if self._last_adjustment is None:
+            self._last_adjustment = (now, total_bytes)
+            return
+        last_time, last_bytes = self._last_adjustment
+        if now - last_time < ADJUST_INTERVAL:
+            return
+        self._last_adjustment = (now, total_bytes)
+        throughput = (total_bytes - last_bytes) / (now - last_time)
+
+        with self._condition:
+            if self._congested:
+                self._congested = False
+                self.limit = max(MIN_PARALLEL_TRANSFERS, self.limit // 2)
+            elif throughput > self._throughput:
+                self.limit = min(self.max_limit, self.limit + 1)
+                self._condition.notify()
+        self._throughput = throughput
+
+class BandwidthLimiter(object):
+    """
+    Limits the total transfer rate of all the workers to `rate` bytes per second
+    (unlimited if it's None); workers call `consume` with each chunk they transfer.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = Lock()
+        self._next_time = 0
+
+    def consume(self, count):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            # The time by which the data would have been transferred at the maximum rate.
+            self._next_time = max(self._next_time, now) + count / float(self.rate)
+            delay = self._next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttle(self, chunks):
+        """
+        Passes through a generator of chunks at the maximum rate.
+        """
+        for chunk in chunks:
+            self.consume(len(chunk))
+            yield chunk
+
+def _max_bandwidth_rate(max_bandwidth):
+    """
+    Returns the bandwidth limit in bytes per second, given it in MB/s, or from the environment.
+    """
+    if max_bandwidth is None:
+        value = os.environ.get(MAX_BANDWIDTH_ENV)
+        max_bandwidth = float(value) if value else None
+    return max_bandwidth * 1024 * 1024 if max_bandwidth else None
+
+def _run_workers(target, name, counter, concurrency):
+    """
+    Runs `target` in enough threads for the maximum concurrency, updates the progress bar
+    every PROGRESS_INTERVAL seconds and adjusts the concurrency until they're all done;
+    then prints a summary.
+    """
+    def _run():
+        counter.register()
+        target()
+
+    start = time.time()
+    threads = [
+        Thread(target=_run, name="%s-%d" % (name, i))
+        for i in range(concurrency.max_limit)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(PROGRESS_INTERVAL)
+            concurrency.adjust(counter.flush())
+    total = counter.flush()
+
+    elapsed = time.time() - start
+    tqdm.write("Transferred %s in %.1fs (%s/s, up to %d at a time)." % (
+        format_bytes(total), elapsed, format_bytes(total / elapsed if elapsed else 0), concurrency.peak
+    ))
+
+class _Uncompressed(object):
+    """
+    Stands in for a decompressor for fragments that were uploaded without gzip.
+    """
+    unused_data = b''
+    eof = True
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+class _ZstdDecompressor(object):
+    """
+    Wraps a zstd decompressor in the interface of `zlib.decompressobj`.
+    """
+    def __init__(self):
+        import zstandard
+        self._error = zstandard.ZstdError
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    @property
+    def unused_data(self):
+        return getattr(self._decompressor, 'unused_data', b'')  # Newer versions of zstandard only
+
+    @property
+    def eof(self):
+        return getattr(self._decompressor, 'eof', True)
+
+    def decompress(self, data):
+        try:
+            return self._decompressor.decompress(data)
+        except self._error as ex:
+            raise zlib.error(str(ex))
+
+    def flush(self):
+        return b''
+
+
+class FragmentWriter(object):
+    """
+    Decompresses a gzip'ed or zstd'ed fragment as it's being downloaded, and hashes
+    and writes the result in the same pass.
+
+    Fragments that don't compress well are stored as they are; those are told apart
+    by the first bytes of the data, since anything that starts like a gzip or zstd file
+    gets compressed on upload (see `_should_compress`). Older clients did upload data
+    that starts like a zstd file as it is, though; if it doesn't decompress to the
+    expected hash, but matches it as it is, it's written out unchanged.
+
+    The compressed data is appended to `partial_path`, too, so an interrupted download
+    can be resumed with a Range request: if the file already exists, the decompressor
+    and hash states are re-derived by replaying it.
+    """
+    def __init__(self, partial_path, output_path):
+        self._decompressor = None  # Until the first bytes are in.
+        self._new_decompressor = None
+        self._head = b''
+        self._hash = hashlib.new(HASH_TYPE)
+        self._raw_hash = None  # Of zstd'ed data, in case it's a raw fragment after all.
+        self._zstd_error = False
+        self._partial_path = partial_path
+        self._partial = open(partial_path, 'ab')
+        self._output = open(output_path, 'wb')
+        if self._partial.tell():
+            try:
+                with open(partial_path, 'rb') as partial_file:
+                    for chunk in iter(lambda: partial_file.read(CHUNK_SIZE), b''):
+                        self._decompress(chunk)
+            except zlib.error:
+                self.close()
+                raise
+
+    @property
+    def compressed_size(self):
+        return self._partial.tell()
+
+    def _decompress(self, data):
+        if self._decompressor is None:
+            self._head += data
+            if len(self._head) < len(ZSTD_MAGIC):
+                return
+            data, self._head = self._head, b''
+            if data.startswith(GZIP_MAGIC):
+                self._new_decompressor = lambda: zlib.decompressobj(GZIP_WBITS)
+            elif data.startswith(ZSTD_MAGIC) and have_zstd():
+                self._new_decompressor = _ZstdDecompressor
+                self._raw_hash = hashlib.new(HASH_TYPE)
+            else:
+                self._new_decompressor = _Uncompressed
+            self._decompressor = self._new_decompressor()
+
+        if self._raw_hash is not None:
+            self._raw_hash.update(data)
+            if self._zstd_error:
+                return
+
+        # Fragments can consist of several gzip members (or zstd frames).
+        while data:
+            try:
+                output = self._decompressor.decompress(data)
+            except zlib.error:
+                if self._raw_hash is None:
+                    raise
+                self._zstd_error = True  # Probably a raw fragment; see `finish`.
+                return
+            self._hash.update(output)
+            self._output.write(output)
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = self._new_decompressor()
+
+    def _write_raw(self):
+        """
+        Replaces the output with the data as it was downloaded.
+        """
+        self._partial.flush()
+        self._output.seek(0)
+        self._output.truncate()
+        with open(self._partial_path, 'rb') as partial_file:
+            for chunk in iter(lambda: partial_file.read(CHUNK_SIZE), b''):
+                self._output.write(chunk)
+
+    def write(self, chunk):
+        self._partial.write(chunk)
+        self._decompress(chunk)
+
+    def finish(self, expected_hash=None):
+        """
+        Returns the hash of the decompressed data; or, for data that starts like a zstd file
+        but doesn't decompress to `expected_hash`, the hash of the data itself if it matches.
+        Raises zlib.error if the data is corrupt, EOFError if it's truncated.
+        """
+        if self._decompressor is None:
+            # Too short to be compressed.
+            data, self._head = self._head, b''
+            self._new_decompressor = _Uncompressed
+            self._decompressor = _Uncompressed()
+            self._decompress(data)
+        output = self._decompressor.flush()
+        self._hash.update(output)
+        self._output.write(output)
+        if self._raw_hash is not None:
+            raw_hash = self._raw_hash.hexdigest()
+            if raw_hash == expected_hash and (self._zstd_error or self._hash.hexdigest() != expected_hash):
+                self._write_raw()
+                self.close()
+                return raw_hash
+            if self._zstd_error:
+                raise zlib.error("Invalid zstd data")
+        if not getattr(self._decompressor, 'eof', True):  # Python 3 only
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        self.close()
+        return self._hash.hexdigest()
+
+    def close(self):
+        self._output.close()
+        self._partial.close()
+
+
+class RangedDownload(object):
+    """
+    A large fragment downloaded as byte ranges ("parts") by several workers at once,
+    each written into the temporary `.gz` file at its own offset.
+
+    The compressed size isn't known in advance, so the parts cover an upper bound
+    of it; parts past the end of the data come back empty. Finished parts are
+    recorded in a `.parts` file, so an interrupted download only fetches the
+    missing ones.
+    """
+    def __init__(self, store, obj_hash, original_size):
+        self.obj_hash = obj_hash
+        self.gz_path = store.temporary_object_path(obj_hash + '.gz')
+        self.parts_path = self.gz_path + '.parts'
+        self.lock = Lock()
+        self.failed = False
+        self.compressed_size = None
+
+        max_size = _max_gzip_size(original_size)
+        self.num_parts = (max_size + RANGE_PART_SIZE - 1) // RANGE_PART_SIZE
+
+        self.done = set()
+        if os.path.exists(self.parts_path):
+            try:
+                with open(self.parts_path, 'r') as fd:
+                    state = json.load(fd)
+                if state['part_size'] == RANGE_PART_SIZE:
+                    self.done = set(state['parts'])
+                    self.compressed_size = state['compressed_size']
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        elif os.path.exists(self.gz_path):
+            # A partial download of the whole object: keep the parts it already contains.
+            self.done = set(range(os.path.getsize(self.gz_path) // RANGE_PART_SIZE))
+
+        self.pending = [part for part in range(self.num_parts) if part not in self.done]
+        if not self.pending:
+            # Interrupted after all the parts were done; fetch the last one again to finish up.
+            self.pending = [self.num_parts - 1]
+        self.remaining = len(self.pending)
+
+    def part_range(self, part):
+        """
+        Returns the first and last byte of a part.
+        """
+        return part * RANGE_PART_SIZE, (part + 1) * RANGE_PART_SIZE - 1
+
+    def extend(self, compressed_size):
+        """
+        Adds parts if the data turns out to be larger than expected (e.g., the object's
+        size was wrong); returns the new parts.
+        """
+        with self.lock:
+            num_parts = (compressed_size + RANGE_PART_SIZE - 1) // RANGE_PART_SIZE
+            new_parts = list(range(self.num_parts, num_parts))
+            self.num_parts = max(self.num_parts, num_parts)
+            self.remaining += len(new_parts)
+            return new_parts
+
+    def open(self):
+        """
+        Returns the `.gz` file, opened for positional writes.
+        """
+        with self.lock:
+            if not os.path.exists(self.gz_path):
+                open(self.gz_path, 'wb').close()
+        return open(self.gz_path, 'r+b')
+
+    def part_finished(self, part, success, compressed_size=None):
+        """
+        Records the result of a part; returns True if it was the last one.
+        """
+        with self.lock:
+            if success:
+                self.done.add(part)
+                if compressed_size is not None:
+                    self.compressed_size = compressed_size
+                with open(self.parts_path, 'w') as fd:
+                    json.dump(dict(part_size=RANGE_PART_SIZE, parts=sorted(self.done),
+                                   compressed_size=self.compressed_size), fd)
+            else:
+                self.failed = True
+            self.remaining -= 1
+            return self.remaining == 0
+
+    def finish(self, temp_path):
+        """
+        Decompresses the downloaded data into `temp_path`, and returns its hash.
+        """
+        if self.compressed_size is None:
+            raise EOFError("Unknown compressed size")
+        with open(self.gz_path, 'r+b') as fd:
+            fd.truncate(self.compressed_size)
+        writer = FragmentWriter(self.gz_path, temp_path)
+        try:
+            return writer.finish(self.obj_hash)
+        finally:
+            writer.close()
+
+    def remove(self):
+        for path in [self.gz_path, self.parts_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class TransferJournal(object):
+    """
+    Log of an install or push, so it can be resumed where it stopped.
+
+    It's a file in the store with one JSON record per line: the header (the package
+    instance, and whatever else the command needs to resume), then the URLs and sizes
+    of the objects each time they're fetched, then the hash of each object as it's
+    transferred. Partially transferred objects are resumed from their own state:
+    the partial `.gz` file of a download, or the `.upload` file of a multipart upload.
+    A truncated last record, e.g. from a crash, is ignored.
+
+    Uploads also record the objects they uploaded a zstd'ed copy of, in `encodings`.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.header = None
+        self.urls = {}
+        self.sizes = {}
+        self.urls_time = 0
+        self.done = set()
+        self.encodings = {}
+
+        try:
+            with open(self.path, 'r') as fd:
+                for line in fd:
+                    try:
+                        record = json.loads(line, object_hook=decode_node)
+                    except ValueError:
+                        break
+                    self._apply(record)
+        except (IOError, OSError):
+            pass
+
+    def _apply(self, record):
+        if 'header' in record:
+            self.header = record['header']
+        elif 'urls' in record:
+            self.urls.update(record['urls'])
+            self.sizes.update(record['sizes'])
+            self.urls_time = record['time']
+        elif 'done' in record:
+            self.done.add(record['done'])
+            if 'encoding' in record:
+                self.encodings[record['done']] = record['encoding']
+
+    def _append(self, record, mode='a'):
+        with self.lock:
+            self._apply(record)
+            with open(self.path, mode) as fd:
+                fd.write(json.dumps(record, default=encode_node) + '\n')
+
+    def start(self, header):
+        """
+        Starts a new journal, replacing the existing one.
+        """
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.header = None
+        self.urls = {}
+        self.sizes = {}
+        self.urls_time = 0
+        self.done = set()
+        self.encodings = {}
+        self._append(dict(header=header), mode='w')
+
+    def add_urls(self, urls, sizes):
+        """
+        Records newly-fetched URLs and sizes of objects.
+        """
+        self._append(dict(urls=urls, sizes=sizes, time=time.time()))
+
+    def urls_expired(self):
+        return time.time() - self.urls_time > JOURNAL_URL_LIFETIME
+
+    def object_done(self, obj_hash, encoding=None):
+        record = dict(done=obj_hash)
+        if encoding is not None:
+            record.update(encoding=encoding)
+        self._append(record)
+
+    def pending(self):
+        """
+        Returns the hashes of the objects that haven't been transferred yet.
+        """
+        return set(self.urls) - self.done
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _required_space(obj_sizes, threads):
+    """
+    Returns the disk space needed to download the objects: the objects themselves, plus the
+    compressed data kept for resuming, for as many objects as can be downloading at once.
+    """
+    sizes = sorted((size or 0 for size in itervalues(obj_sizes)), reverse=True)
+    return sum(sizes) + sum(sizes[:threads])
+
+def download_fragments(store, obj_urls, obj_sizes, threads=None, max_bandwidth=None, journal=None):
+    """
+    Downloads gzip'ed objects into the store, using workers that share a connection pool.
+
+    With `threads`, that many objects are downloaded at a time; otherwise, it starts at
+    PARALLEL_DOWNLOADS and adapts to the throughput (see `ConcurrencyLimit`).
+    `max_bandwidth` limits the total download rate, in MB/s; it defaults to
+    the QUILT_MAX_BANDWIDTH environment variable.
+
+    Objects larger than RANGE_DOWNLOAD_THRESHOLD are split into byte ranges, so that
+    several workers download them in parallel; smaller ones are each downloaded by
+    a single worker.
+
+    Each downloaded object is recorded in the `journal` (e.g., a `TransferJournal`), if given.
+    """
     assert len(obj_urls) == len(obj_sizes)
 
-    obj_queue = sorted(iteritems(obj_urls), reverse=True)
-    total = len(obj_queue)
+    concurrency = ConcurrencyLimit(threads or PARALLEL_DOWNLOADS, adaptive=threads is None)
+    bandwidth = BandwidthLimiter(_max_bandwidth_rate(max_bandwidth))
+
+    # Tasks are (object hash, URL, part) tuples, where part is None for whole objects.
+    tasks = []
+    ranged_downloads = {}
+    for obj_hash, url in sorted(iteritems(obj_urls)):
+        original_size = obj_sizes[obj_hash]
+        if original_size and original_size > RANGE_DOWNLOAD_THRESHOLD:
+            ranged = ranged_downloads[obj_hash] = RangedDownload(store, obj_hash, original_size)
+            tasks.extend((obj_hash, url, part) for part in ranged.pending)
+        else:
+            tasks.append((obj_hash, url, None))
+    obj_queue = tasks[::-1]
+
+    total = len(obj_urls)
     # Some objects might be missing a size; ignore those for now.
     total_bytes = sum(size or 0 for size in itervalues(obj_sizes))
 
-    # Check if we have enough disk space. There's no way to check reliably because we also need
-    # space for the temporary gzip'ed files, but that's better than nothing.
+    # Check if we have enough disk space. Compressed sizes are unknown at this point,
+    # so this assumes the worst case for the temporary gzip'ed files.
     free_space = get_free_space(store.object_path('.'))
-    if total_bytes > free_space:
-        print("Error: Insufficient space for install. Required: %d, available: %d" % (total_bytes, free_space))
+    required_space = _required_space(obj_sizes, concurrency.max_limit)
+    if required_space > free_space:
+        print("Error: Insufficient space for install. Required: %d, available: %d" % (required_space, free_space))
         return False
 
     downloaded = []
@@ -77,209 +699,778 @@ def download_fragments(store, obj_urls, obj_sizes):
     print("Downloading %d fragments (%d bytes before compression)..." % (total, total_bytes))
 
     with tqdm(total=total_bytes, unit='B', unit_scale=True) as progress:
+        counter = ProgressCounter(progress)
+
+        def _save_object(obj_hash, temp_path, file_hash):
+            # Check the hash of the result.
+            if file_hash != obj_hash:
+                os.remove(temp_path)
+                with lock:
+                    tqdm.write("Fragment hashes do not match: expected %s, got %s." %
+                               (obj_hash, file_hash))
+                return
+
+            local_filename = store.object_path(obj_hash)
+            move(temp_path, local_filename)
+
+            # Success.
+            with lock:
+                downloaded.append(obj_hash)
+            if journal is not None:
+                journal.object_done(obj_hash)
+
+        def _download_object(s3_session, obj_hash, url, original_size):
+            success = False
+
+            temp_path_gz = store.temporary_object_path(obj_hash + '.gz')
+            temp_path = store.temporary_object_path(obj_hash)
+            try:
+                writer = FragmentWriter(temp_path_gz, temp_path)
+            except zlib.error:
+                # The partial download is corrupted; start over.
+                os.remove(temp_path_gz)
+                writer = FragmentWriter(temp_path_gz, temp_path)
+
+            try:
+                for attempt in range(S3_TIMEOUT_RETRIES):
+                    try:
+                        starting_length = writer.compressed_size
+                        response = s3_session.get(
+                            url,
+                            headers={
+                                'Range': 'bytes=%d-' % starting_length
+                            },
+                            stream=True,
+                            timeout=(S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT)
+                        )
+
+                        # RANGE_NOT_SATISFIABLE means, we already have the whole file.
+                        if response.status_code == requests.codes.RANGE_NOT_SATISFIABLE:
+                            counter.update(original_size)
+                        else:
+                            if not response.ok:
+                                message = "Download failed for %s:\nURL: %s\nStatus code: %s\nResponse: %r\n" % (
+                                    obj_hash, response.request.url, response.status_code, response.text
+                                )
+                                with lock:
+                                    tqdm.write(message)
+                                break
+
+                            # Fragments have the 'Content-Encoding: gzip' header set to make requests ungzip
+                            # them automatically - but that turned out to be a bad idea because it makes
+                            # resuming downloads impossible.
+                            # HACK: For now, just delete the header. Eventually, update the data in S3.
+                            response.raw.headers.pop('Content-Encoding', None)
+
+                            # Make sure we're getting the expected range.
+                            content_range = response.headers.get('Content-Range', '')
+                            match = CONTENT_RANGE_RE.match(content_range)
+                            if not match or not int(match.group(1)) == starting_length:
+                                with lock:
+                                    tqdm.write("Unexpected Content-Range: %s" % content_range)
+                                break
+
+                            compressed_size = int(match.group(3))
+
+                            # We may have started with a partially-downloaded file, so update the progress bar.
+                            compressed_read = starting_length
+                            original_read = compressed_read * original_size // compressed_size
+                            counter.update(original_read)
+                            original_last_update = original_read
+
+                            # Do the actual download: decompress, hash and write as the data comes in.
+                            for chunk in response.iter_content(CHUNK_SIZE):
+                                writer.write(chunk)
+                                bandwidth.consume(len(chunk))
+                                compressed_read += len(chunk)
+                                original_read = compressed_read * original_size // compressed_size
+                                counter.update(original_read - original_last_update)
+                                original_last_update = original_read
+
+                        file_hash = writer.finish(obj_hash)
+                        success = True
+                        break  # Done!
+                    except requests.exceptions.ConnectionError as ex:
+                        concurrency.congestion()
+                        if attempt < S3_TIMEOUT_RETRIES - 1:
+                            with lock:
+                                tqdm.write("Download for %s timed out; retrying..." % obj_hash)
+                        else:
+                            with lock:
+                                tqdm.write("Download failed for %s: %s" % (obj_hash, ex))
+                            break
+            except (zlib.error, EOFError) as ex:
+                # Delete the partial download - it's corrupted, so resuming it won't help.
+                os.remove(temp_path_gz)
+                with lock:
+                    tqdm.write("Download failed for %s: %s" % (obj_hash, ex))
+            finally:
+                writer.close()
+
+            if not success:
+                # We've already printed an error, so not much to do - just move on to the next object.
+                os.remove(temp_path)
+                return
+
+            os.remove(temp_path_gz)
+            _save_object(obj_hash, temp_path, file_hash)
+
+        def _download_part(s3_session, obj_hash, url, part, original_size):
+            ranged = ranged_downloads[obj_hash]
+            start, end = ranged.part_range(part)
+            success = False
+            compressed_size = None
+            # Bytes of this part written so far, to resume it after a timeout.
+            written = 0
+            original_last_update = 0
+
+            with ranged.open() as output_file:
+                for attempt in range(S3_TIMEOUT_RETRIES):
+                    try:
+                        response = s3_session.get(
+                            url,
+                            headers={
+                                'Range': 'bytes=%d-%d' % (start + written, end)
+                            },
+                            stream=True,
+                            timeout=(S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT)
+                        )
+
+                        # RANGE_NOT_SATISFIABLE means, the part is past the end of the data.
+                        if response.status_code == requests.codes.RANGE_NOT_SATISFIABLE:
+                            success = True
+                            break
+
+                        if not response.ok:
+                            message = "Download failed for %s:\nURL: %s\nStatus code: %s\nResponse: %r\n" % (
+                                obj_hash, response.request.url, response.status_code, response.text
+                            )
+                            with lock:
+                                tqdm.write(message)
+                            break
+
+                        # See above.
+                        response.raw.headers.pop('Content-Encoding', None)
+
+                        content_range = response.headers.get('Content-Range', '')
+                        match = CONTENT_RANGE_RE.match(content_range)
+                        if not match or not int(match.group(1)) == start + written:
+                            with lock:
+                                tqdm.write("Unexpected Content-Range: %s" % content_range)
+                            break
+
+                        compressed_size = int(match.group(3))
+
+                        output_file.seek(start + written)
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            output_file.write(chunk)
+                            bandwidth.consume(len(chunk))
+                            written += len(chunk)
+                            original_read = written * original_size // compressed_size
+                            counter.update(original_read - original_last_update)
+                            original_last_update = original_read
+
+                        success = True
+                        break  # Done!
+                    except requests.exceptions.ConnectionError as ex:
+                        concurrency.congestion()
+                        if attempt < S3_TIMEOUT_RETRIES - 1:
+                            with lock:
+                                tqdm.write("Download for %s (part %d) timed out; retrying..." % (obj_hash, part))
+                        else:
+                            with lock:
+                                tqdm.write("Download failed for %s (part %d): %s" % (obj_hash, part, ex))
+
+            if compressed_size is not None:
+                new_parts = ranged.extend(compressed_size)
+                with lock:
+                    obj_queue.extend((obj_hash, url, new_part) for new_part in reversed(new_parts))
+
+            if not ranged.part_finished(part, success, compressed_size):
+                return
+            if ranged.failed:
+                # We've already printed an error; keep the finished parts for the next attempt.
+                return
+
+            # This was the last part: decompress and verify the whole object.
+            temp_path = store.temporary_object_path(obj_hash)
+            try:
+                file_hash = ranged.finish(temp_path)
+            except (zlib.error, EOFError) as ex:
+                os.remove(temp_path)
+                with lock:
+                    tqdm.write("Download failed for %s: %s" % (obj_hash, ex))
+                return
+            finally:
+                # Corrupted or not, the compressed data isn't needed anymore.
+                ranged.remove()
+
+            _save_object(obj_hash, temp_path, file_hash)
+
         def _worker_thread():
-            with create_s3_session() as s3_session:
-                while True:
+            while True:
+                with concurrency:
                     with lock:
                         if not obj_queue:
                             break
-                        obj_hash, url = obj_queue.pop()
+                        obj_hash, url, part = obj_queue.pop()
                         original_size = obj_sizes[obj_hash] or 0  # If the size is unknown, just treat it as 0.
 
-                    success = False
-
-                    temp_path_gz = store.temporary_object_path(obj_hash + '.gz')
-                    with open(temp_path_gz, 'ab') as output_file:
-                        for attempt in range(S3_TIMEOUT_RETRIES):
-                            try:
-                                starting_length = output_file.tell()
-                                response = s3_session.get(
-                                    url,
-                                    headers={
-                                        'Range': 'bytes=%d-' % starting_length
-                                    },
-                                    stream=True,
-                                    timeout=(S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT)
-                                )
+                    if part is None:
+                        _download_object(s3_session, obj_hash, url, original_size)
+                    else:
+                        _download_part(s3_session, obj_hash, url, part, original_size)
 
-                                # RANGE_NOT_SATISFIABLE means, we already have the whole file.
-                                if response.status_code == requests.codes.RANGE_NOT_SATISFIABLE:
-                                    with lock:
-                                        progress.update(original_size)
-                                else:
-                                    if not response.ok:
-                                        message = "Download failed for %s:\nURL: %s\nStatus code: %s\nResponse: %r\n" % (
-                                            obj_hash, response.request.url, response.status_code, response.text
-                                        )
-                                        with lock:
-                                            tqdm.write(message)
-                                        break
-
-                                    # Fragments have the 'Content-Encoding: gzip' header set to make requests ungzip
-                                    # them automatically - but that turned out to be a bad idea because it makes
-                                    # resuming downloads impossible.
-                                    # HACK: For now, just delete the header. Eventually, update the data in S3.
-                                    response.raw.headers.pop('Content-Encoding', None)
-
-                                    # Make sure we're getting the expected range.
-                                    content_range = response.headers.get('Content-Range', '')
-                                    match = CONTENT_RANGE_RE.match(content_range)
-                                    if not match or not int(match.group(1)) == starting_length:
-                                        with lock:
-                                            tqdm.write("Unexpected Content-Range: %s" % content_range)
-                                        break
-
-                                    compressed_size = int(match.group(3))
-
-                                    # We may have started with a partially-downloaded file, so update the progress bar.
-                                    compressed_read = starting_length
-                                    original_read = compressed_read * original_size // compressed_size
-                                    with lock:
-                                        progress.update(original_read)
-                                    original_last_update = original_read
-
-                                    # Do the actual download.
-                                    for chunk in response.iter_content(CHUNK_SIZE):
-                                        output_file.write(chunk)
-                                        compressed_read += len(chunk)
-                                        original_read = compressed_read * original_size // compressed_size
-                                        with lock:
-                                            progress.update(original_read - original_last_update)
-                                        original_last_update = original_read
-
-                                success = True
-                                break  # Done!
-                            except requests.exceptions.ConnectionError as ex:
-                                if attempt < S3_TIMEOUT_RETRIES - 1:
-                                    with lock:
-                                        tqdm.write("Download for %s timed out; retrying..." % obj_hash)
-                                else:
-                                    with lock:
-                                        tqdm.write("Download failed for %s: %s" % (obj_hash, ex))
-                                    break
-
-                    if not success:
-                        # We've already printed an error, so not much to do - just move on to the next object.
-                        continue
-
-                    # Ungzip the downloaded fragment.
-                    temp_path = store.temporary_object_path(obj_hash)
-                    try:
-                        with gzip.open(temp_path_gz, 'rb') as f_in, open(temp_path, 'wb') as f_out:
-                            copyfileobj(f_in, f_out)
-                    finally:
-                        # Delete the file unconditionally - in case it's corrupted and cannot be ungzipped.
-                        os.remove(temp_path_gz)
-
-                    # Check the hash of the result.
-                    file_hash = digest_file(temp_path)
-                    if file_hash != obj_hash:
-                        os.remove(temp_path)
-                        with lock:
-                            tqdm.write("Fragment hashes do not match: expected %s, got %s." %
-                                       (obj_hash, file_hash))
-                            continue
-
-                    local_filename = store.object_path(obj_hash)
-                    move(temp_path, local_filename)
-
-                    # Success.
-                    with lock:
-                        downloaded.append(obj_hash)
-
-        threads = [
-            Thread(target=_worker_thread, name="download-worker-%d" % i)
-            for i in range(PARALLEL_DOWNLOADS)
-        ]
-        for thread in threads:
-            thread.daemon = True
-            thread.start()
-        for thread in threads:
-            thread.join()
+        with create_s3_session(concurrency.max_limit) as s3_session:
+            s3_session.hooks['response'].append(concurrency.response_hook)
+            _run_workers(_worker_thread, "download-worker", counter, concurrency)
 
     return len(downloaded) == total
 
-def upload_fragments(store, obj_urls, obj_sizes, reupload=False):
+_compression_pool = None
+_compression_pool_lock = Lock()
+
+def _get_compression_pool():
+    """
+    Returns the thread pool shared by all parallel compressions, and its number of threads.
+    """
+    global _compression_pool
+    with _compression_pool_lock:
+        if _compression_pool is None:
+            from multiprocessing import cpu_count
+            from multiprocessing.pool import ThreadPool
+            threads = cpu_count()
+            _compression_pool = (ThreadPool(threads), threads)
+        return _compression_pool
+
+def _gzip_block(data):
+    compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_chunks(input_file, progress_cb=None):
+    """
+    Compresses a file as it's read, yielding chunks of gzip'ed data.
+    Calls `progress_cb` with the number of uncompressed bytes read.
+
+    Files over PARALLEL_COMPRESSION_THRESHOLD are compressed in parallel blocks.
+    """
+    if os.fstat(input_file.fileno()).st_size > PARALLEL_COMPRESSION_THRESHOLD:
+        return _parallel_gzip_chunks(input_file, progress_cb)
+    return _serial_gzip_chunks(input_file, progress_cb)
+
+def _serial_gzip_chunks(input_file, progress_cb):
+    compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in iter(lambda: input_file.read(CHUNK_SIZE), b''):
+        if progress_cb is not None:
+            progress_cb(len(chunk))
+        output = compressor.compress(chunk)
+        if output:
+            yield output
+    yield compressor.flush()
+
+def _parallel_gzip_chunks(input_file, progress_cb):
+    empty = True
+    for _, member in _gzip_blocks(input_file, progress_cb):
+        empty = False
+        yield member
+    if empty:
+        # Still needs to be a valid gzip file.
+        yield _gzip_block(b'')
+
+def _gzip_blocks(input_file, progress_cb=None):
+    """
+    Compresses a file in COMPRESSION_BLOCK_SIZE blocks, in parallel, and yields
+    the size of each block and its gzip member, in order.
+    """
+    pool, threads = _get_compression_pool()
+    # Compressed blocks, in order. Only a few are read ahead, to bound the memory used.
+    pending = deque()
+    for block in iter(lambda: input_file.read(COMPRESSION_BLOCK_SIZE), b''):
+        if progress_cb is not None:
+            progress_cb(len(block))
+        pending.append((len(block), pool.apply_async(_gzip_block, (block,))))
+        if len(pending) > threads:
+            size, result = pending.popleft()
+            yield size, result.get()
+    while pending:
+        size, result = pending.popleft()
+        yield size, result.get()
+
+def _max_gzip_size(size):
+    """
+    Returns an upper bound of the gzip'ed size of `size` bytes: deflate can't expand data
+    by more than 5 bytes per 16K block, plus the header and trailer of each gzip member.
+    """
+    return size + 5 * (size // 16384 + 1) + 32 * (size // COMPRESSION_BLOCK_SIZE + 1) + 1024
+
+def _should_compress(path):
+    """
+    Returns whether an object is worth gzip'ing, by compressing a few samples
+    spread across it.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as fd:
+        head = fd.read(len(ZSTD_MAGIC))
+        if head.startswith(GZIP_MAGIC) or head == ZSTD_MAGIC:
+            # Always compressed, so downloads can tell it apart from a compressed fragment.
+            return True
+        if size <= COMPRESSION_SAMPLES * COMPRESSION_SAMPLE_SIZE:
+            offsets = [0]
+            sample_size = size
+        else:
+            step = (size - COMPRESSION_SAMPLE_SIZE) // (COMPRESSION_SAMPLES - 1)
+            offsets = [idx * step for idx in range(COMPRESSION_SAMPLES)]
+            sample_size = COMPRESSION_SAMPLE_SIZE
+
+        sampled = compressed = 0
+        for offset in offsets:
+            fd.seek(offset)
+            data = fd.read(sample_size)
+            sampled += len(data)
+            compressed += len(zlib.compress(data, ZLIB_LEVEL))
+    return not sampled or compressed < sampled * COMPRESSION_MAX_RATIO
+
+def _cache_compressed_object(store, obj_hash):
+    """
+    Creates the gzip'ed copy of an object, unless it already exists, and returns its path.
+    """
+    path = store.compressed_object_path(obj_hash)
+    if not os.path.exists(path):
+        gz_dir = os.path.dirname(path)
+        if not os.path.isdir(gz_dir):
+            try:
+                os.makedirs(gz_dir)
+            except OSError:
+                # Another thread created it.
+                pass
+        # Write to a temporary file first, so an interrupted upload doesn't leave truncated data behind.
+        temp_path = store.temporary_object_path('%s.gz.%s' % (obj_hash, uuid.uuid4()))
+        with open(store.object_path(obj_hash), 'rb') as input_file, open(temp_path, 'wb') as output_file:
+            for chunk in gzip_chunks(input_file):
+                output_file.write(chunk)
+        move(temp_path, path)
+    return path
+
+class MultipartUpload(object):
+    """
+    Upload of a large fragment in parts, using an S3 multipart upload.
+
+    Each part is compressed as it's read, as gzip members of COMPRESSION_BLOCK_SIZE blocks,
+    so there's no compressed copy of the object to write first. S3 needs parts of at least
+    5MB (except for the last one), so a part takes as many blocks as it needs to reach
+    `part_size` once compressed; since that isn't known in advance, the registry pre-signs
+    URLs for as many parts as there could be, and the unused ones are skipped.
+    With `cache_compressed`, the parts are read from the compressed copy in the store
+    instead; objects that don't compress well are read as they are, and the registry is
+    told not to mark them as gzip'ed.
+
+    The upload ID, the ETags of finished parts, and the range of the object in each of
+    them are saved in an `.upload` file in the store, so an interrupted push continues
+    the same upload: it picks up after the last part that all the previous ones were
+    uploaded before.
+    """
+    def __init__(self, store, obj_hash, cache_compressed):
+        self.obj_hash = obj_hash
+        self.object_path = store.object_path(obj_hash)
+        self.state_path = store.temporary_object_path(obj_hash + '.upload')
+        self.lock = Lock()
+        self.failed = False
+
+        state = None
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path, 'r') as fd:
+                    state = json.load(fd)
+            except (IOError, OSError, ValueError):
+                pass
+
+        self.original_size = os.path.getsize(self.object_path)
+        self.compress = _should_compress(self.object_path)
+        if not self.compress:
+            self.data_path = self.object_path
+        elif cache_compressed:
+            self.data_path = _cache_compressed_object(store, obj_hash)
+        else:
+            self.data_path = None  # Compressed part by part.
+
+        if self.data_path is not None:
+            self.data_size = os.path.getsize(self.data_path)
+        else:
+            self.data_size = _max_gzip_size(self.original_size)
+        self.part_size = max(MULTIPART_PART_SIZE, -(-self.data_size // MULTIPART_MAX_PARTS))
+        self.num_parts = max(1, -(-self.data_size // self.part_size))
+
+        self.upload_id = None
+        self.etags = {}
+        # Range of the object in each compressed part.
+        self.ranges = {}
+        try:
+            if (state['data_size'] == self.data_size and state['part_size'] == self.part_size and
+                    state['compress'] == self.compress):
+                self.upload_id = state['upload_id']
+                self.etags = {int(part): etag for part, etag in iteritems(state['etags'])}
+                self.ranges = {int(part): tuple(value) for part, value in iteritems(state['ranges'])}
+        except (TypeError, KeyError, ValueError):
+            pass
+
+        self.urls = None
+        if self.data_path is not None:
+            self.pending = [part for part in range(self.num_parts) if part not in self.etags]
+        else:
+            # Keep the parts up to the first missing one; the ones after it get uploaded again.
+            offset = 0
+            part = 0
+            while part in self.etags and self.ranges.get(part, (None,))[0] == offset:
+                offset = self.ranges[part][1]
+                part += 1
+            self.etags = {idx: self.etags[idx] for idx in range(part)}
+            self.ranges = {idx: self.ranges[idx] for idx in range(part)}
+            if part and offset == self.original_size:
+                self.pending = []
+            else:
+                self.pending = list(range(part, self.num_parts))
+
+            self._offset = offset
+            self._next_part = part
+            self._input_file = None
+            self._blocks = None
+            self._ready = {}
+
+        self.remaining = len(self.pending)
+
+    def _save(self):
+        with open(self.state_path, 'w') as fd:
+            json.dump(dict(upload_id=self.upload_id, data_size=self.data_size, part_size=self.part_size,
+                           compress=self.compress, etags=self.etags, ranges=self.ranges), fd)
+
+    def start(self, session, blob_url):
+        """
+        Starts the upload, or continues the saved one, and gets the URLs of the parts.
+        """
+        data = dict(parts=self.num_parts)
+        if not self.compress:
+            data['compressed'] = False
+        if self.upload_id is not None:
+            data['upload_id'] = self.upload_id
+        response = session.post("%s/%s/multipart" % (blob_url, self.obj_hash), data=json.dumps(data))
+        response.raise_for_status()
+        result = response.json()
+        with self.lock:
+            self.upload_id = result['upload_id']
+            self.urls = result['urls']
+            self._save()
+
+    def read_part(self, part):
+        """
+        Returns the (usually compressed) data of a part, and the number of bytes of the
+        object in it; or None if the part is past the end of the data.
+        """
+        if self.data_path is None:
+            with self.lock:
+                while self._next_part <= part and self._compress_next_part():
+                    pass
+                return self._ready.pop(part, None)
+
+        if part and part * self.part_size >= self.data_size:
+            return None
+        with open(self.data_path, 'rb') as fd:
+            fd.seek(part * self.part_size)
+            data = fd.read(self.part_size)
+        return data, len(data) * self.original_size // max(self.data_size, 1)
+
+    def _compress_next_part(self):
+        """
+        Compresses blocks of the object until they make up a part; returns False at the end.
+        """
+        if self._blocks is None:
+            self._input_file = open(self.object_path, 'rb')
+            self._input_file.seek(self._offset)
+            self._blocks = _gzip_blocks(self._input_file)
+
+        start = self._offset
+        members = []
+        compressed_size = 0
+        for size, member in self._blocks:
+            self._offset += size
+            members.append(member)
+            compressed_size += len(member)
+            if compressed_size >= self.part_size:
+                break
+
+        if not members:
+            self._input_file.close()
+            if self._next_part:
+                return False
+            members.append(_gzip_block(b''))  # An empty object.
+
+        part = self._next_part
+        self.ranges[part] = (start, self._offset)
+        self._ready[part] = (b''.join(members), self._offset - start)
+        self._next_part += 1
+        return True
+
+    def part_finished(self, part, etag, failed=False):
+        """
+        Records the result of a part (`etag` is None if it's past the end of the data);
+        returns True if it was the last one.
+        """
+        with self.lock:
+            if failed:
+                self.failed = True
+            elif etag is not None:
+                self.etags[part] = etag
+                self._save()
+            self.remaining -= 1
+            return self.remaining == 0
+
+    def complete(self, session, blob_url):
+        """
+        Assembles the object from its parts, and removes the local state.
+        """
+        parts = [dict(part_number=part + 1, etag=etag) for part, etag in sorted(iteritems(self.etags))]
+        response = session.post(
+            "%s/%s/multipart/%s/complete" % (blob_url, self.obj_hash, self.upload_id),
+            data=json.dumps(dict(parts=parts))
+        )
+        response.raise_for_status()
+        self.remove()
+
+    def remove(self):
+        if self.data_path is None and self._input_file is not None:
+            self._input_file.close()
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+
+def upload_fragments(store, obj_urls, obj_sizes, reupload=False, stream=False, cache_compressed=False,
+                     session=None, blob_url=None, threads=None, max_bandwidth=None, journal=None):
+    """
+    Uploads gzip'ed objects to the given URLs. Objects that don't compress well
+    (see `_should_compress`) are uploaded as they are, without `Content-Encoding`.
+
+    By default, each object is compressed into a temporary file before its upload, since the
+    upload needs to know its size. If the URLs include a `zstd_put` one, and `zstandard` is
+    installed, a zstd'ed copy is uploaded there, too; those objects are recorded in the
+    journal's `encodings`. Objects uploaded in parts, and ones that don't compress well,
+    only get the gzip'ed copy. With `cache_compressed`, the compressed copy is kept in the
+    store instead, so later uploads of the same object don't compress it again.
+
+    If the registry's `session` and its `blob_url` are given, objects over
+    MULTIPART_UPLOAD_THRESHOLD are uploaded in parts (see `MultipartUpload`), which are
+    compressed as they're uploaded. With `stream`, all objects are, so that no compressed
+    copies are written at all (unless the registry doesn't support multipart uploads).
+
+    `threads`, `max_bandwidth` and `journal` work the same way as for `download_fragments`,
+    with PARALLEL_UPLOADS as the initial concurrency.
+    """
     assert len(obj_urls) == len(obj_sizes)
 
-    obj_queue = sorted(iteritems(obj_urls), reverse=True)
+    concurrency = ConcurrencyLimit(threads or PARALLEL_UPLOADS, adaptive=threads is None)
+    bandwidth = BandwidthLimiter(_max_bandwidth_rate(max_bandwidth))
+
+    # Tasks are (object hash, URLs, part); the part is None for whole objects.
+    obj_queue = [(obj_hash, urls, None) for obj_hash, urls in sorted(iteritems(obj_urls), reverse=True)]
     total = len(obj_queue)
 
     total_bytes = sum(itervalues(obj_sizes))
 
     uploaded = []
+    multipart_uploads = {}
     lock = Lock()
 
     headers = {
         'Content-Encoding': 'gzip'
     }
+    multipart_threshold = 0 if stream else MULTIPART_UPLOAD_THRESHOLD
 
     print("Uploading %d fragments (%d bytes before compression)..." % (total, total_bytes))
 
     with tqdm(total=total_bytes, unit='B', unit_scale=True) as progress:
+        counter = ProgressCounter(progress)
+
+        def _upload_object(s3_session, obj_hash, obj_urls, original_size):
+            """
+            Uploads a whole object; returns 'zstd' if it uploaded a zstd'ed copy, too.
+            """
+            url = obj_urls['put']
+            compress = _should_compress(store.object_path(obj_hash))
+            # We need the compressed size, so create a gzip'ed file.
+            if not compress:
+                temp_file = open(store.object_path(obj_hash), 'rb')
+                temp_file.seek(0, os.SEEK_END)
+            elif cache_compressed:
+                temp_file = open(_cache_compressed_object(store, obj_hash), 'rb')
+                temp_file.seek(0, os.SEEK_END)
+            else:
+                temp_file = tempfile.TemporaryFile()
+                with open(store.object_path(obj_hash), 'rb') as input_file:
+                    for chunk in gzip_chunks(input_file):
+                        temp_file.write(chunk)
+
+            with temp_file:
+                compressed_size = temp_file.tell()
+                temp_file.seek(0)
+
+                # Workaround for non-local variables in Python 2.7
+                class Context:
+                    compressed_read = 0
+                    original_last_update = 0
+
+                def _progress_cb(count):
+                    Context.compressed_read += count
+                    original_read = Context.compressed_read * original_size // compressed_size
+                    counter.update(original_read - Context.original_last_update)
+                    bandwidth.consume(count)
+                    Context.original_last_update = original_read
+
+                with FileWithReadProgress(temp_file, _progress_cb) as fd:
+                    response = s3_session.put(url, data=fd, headers=headers if compress else {})
+                    response.raise_for_status()
+
+            zstd_url = obj_urls.get('zstd_put')
+            if zstd_url is None or not compress or not have_zstd():
+                return None
+            _upload_zstd_copy(s3_session, obj_hash, zstd_url)
+            return 'zstd'
+
+        def _upload_zstd_copy(s3_session, obj_hash, url):
+            """
+            Uploads a zstd'ed copy of an object; it's not part of the progress,
+            which only counts each object once.
+            """
+            import zstandard
+            with tempfile.TemporaryFile() as temp_file:
+                with open(store.object_path(obj_hash), 'rb') as input_file:
+                    zstandard.ZstdCompressor().copy_stream(input_file, temp_file)
+                temp_file.seek(0)
+                # No `Content-Encoding`: downloads tell zstd'ed data apart by its magic bytes.
+                with FileWithReadProgress(temp_file, bandwidth.consume) as fd:
+                    response = s3_session.put(url, data=fd)
+                    response.raise_for_status()
+
+        def _start_multipart(obj_hash, original_size):
+            """
+            Starts a multipart upload and queues its parts.
+            """
+            upload = MultipartUpload(store, obj_hash, cache_compressed)
+            upload.start(session, blob_url)
+            # Parts uploaded by a previous push.
+            if upload.data_path is None:
+                counter.update(sum(end - start for start, end in itervalues(upload.ranges)))
+            else:
+                counter.update(original_size * len(upload.etags) // upload.num_parts)
+            with lock:
+                if upload.pending:
+                    multipart_uploads[obj_hash] = upload
+                    # Queue the parts at the end, so they're picked up next.
+                    obj_queue.extend((obj_hash, None, part) for part in reversed(upload.pending))
+            return upload
+
+        def _upload_part(s3_session, upload, part, original_size):
+            """
+            Uploads a part, retrying a few times; returns its ETag, or None if the part
+            is past the end of the data.
+            """
+            result = upload.read_part(part)
+            if result is None:
+                return None
+            data, original_count = result
+            bandwidth.consume(len(data))
+            for attempt in range(MULTIPART_RETRIES):
+                try:
+                    response = s3_session.put(upload.urls[part], data=data)
+                    response.raise_for_status()
+                    break
+                except requests.exceptions.RequestException:
+                    if attempt == MULTIPART_RETRIES - 1:
+                        raise
+            counter.update(original_count)
+            return response.headers['ETag']
+
+        def _report_error(obj_hash, ex):
+            if isinstance(ex, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+                concurrency.congestion()
+            message = "Upload failed for %s:\n" % obj_hash
+            if getattr(ex, 'response', None) is not None:
+                message += "URL: %s\nStatus code: %s\nResponse: %r\n" % (
+                    ex.response.url, ex.response.status_code, ex.response.text
+                )
+            else:
+                message += "%s\n" % ex
+
+            with lock:
+                tqdm.write(message)
+
+        def _object_done(obj_hash, encoding=None):
+            with lock:
+                uploaded.append(obj_hash)
+            if journal is not None:
+                journal.object_done(obj_hash, encoding)
+
+        def _upload_task(obj_hash, obj_urls, part, original_size):
+            if part is not None:
+                upload = multipart_uploads[obj_hash]
+                etag = None
+                failed = False
+                try:
+                    etag = _upload_part(s3_session, upload, part, original_size)
+                except requests.exceptions.RequestException as ex:
+                    _report_error(obj_hash, ex)
+                    failed = True
+
+                if not upload.part_finished(part, etag, failed) or upload.failed:
+                    return
+                try:
+                    upload.complete(session, blob_url)
+                except (requests.exceptions.RequestException, QuiltException) as ex:
+                    _report_error(obj_hash, ex)
+                    return
+                _object_done(obj_hash)
+                return
+
+            try:
+                encoding = None
+                if reupload or not s3_session.head(obj_urls['head']).ok:
+                    upload = None
+                    if session is not None and original_size > multipart_threshold:
+                        try:
+                            upload = _start_multipart(obj_hash, original_size)
+                        except QuiltException as ex:
+                            response = getattr(ex, 'response', None)
+                            if response is None or response.status_code != requests.codes.not_found:
+                                raise
+                            # An older registry; upload the whole object instead.
+
+                    if upload is not None:
+                        if upload.pending:
+                            # The last part to finish completes the upload.
+                            return
+                        # All the parts were uploaded by a previous push.
+                        upload.complete(session, blob_url)
+                    else:
+                        encoding = _upload_object(s3_session, obj_hash, obj_urls, original_size)
+                else:
+                    with lock:
+                        tqdm.write("Fragment %s already uploaded; skipping." % obj_hash)
+                    counter.update(original_size)
+
+                _object_done(obj_hash, encoding)
+            except (requests.exceptions.RequestException, QuiltException) as ex:
+                _report_error(obj_hash, ex)
+
         def _worker_thread():
-            with create_s3_session() as s3_session:
-                while True:
+            while True:
+                with concurrency:
                     with lock:
                         if not obj_queue:
                             break
-                        obj_hash, obj_urls = obj_queue.pop()
+                        obj_hash, obj_urls, part = obj_queue.pop()
                         original_size = obj_sizes[obj_hash]
 
-                    try:
-                        if reupload or not s3_session.head(obj_urls['head']).ok:
-                            # Create a temporary gzip'ed file.
-                            with tempfile.TemporaryFile() as temp_file:
-                                with open(store.object_path(obj_hash), 'rb') as input_file:
-                                    with gzip.GzipFile(fileobj=temp_file, mode='wb',
-                                                       compresslevel=ZLIB_LEVEL) as gzip_file:
-                                        copyfileobj(input_file, gzip_file, CHUNK_SIZE)
-                                compressed_size = temp_file.tell()
-                                temp_file.seek(0)
-
-                                # Workaround for non-local variables in Python 2.7
-                                class Context:
-                                    compressed_read = 0
-                                    original_last_update = 0
-
-                                def _progress_cb(count):
-                                    Context.compressed_read += count
-                                    original_read = Context.compressed_read * original_size // compressed_size
-                                    with lock:
-                                        progress.update(original_read - Context.original_last_update)
-                                    Context.original_last_update = original_read
-
-                                with FileWithReadProgress(temp_file, _progress_cb) as fd:
-                                    url = obj_urls['put']
-                                    response = s3_session.put(url, data=fd, headers=headers)
-                                    response.raise_for_status()
-                        else:
-                            with lock:
-                                tqdm.write("Fragment %s already uploaded; skipping." % obj_hash)
-                                progress.update(original_size)
-
-                        with lock:
-                            uploaded.append(obj_hash)
-                    except requests.exceptions.RequestException as ex:
-                        message = "Upload failed for %s:\n" % obj_hash
-                        if ex.response is not None:
-                            message += "URL: %s\nStatus code: %s\nResponse: %r\n" % (
-                                ex.request.url, ex.response.status_code, ex.response.text
-                            )
-                        else:
-                            message += "%s\n" % ex
-
-                        with lock:
-                            tqdm.write(message)
-
-        threads = [
-            Thread(target=_worker_thread, name="upload-worker-%d" % i)
-            for i in range(PARALLEL_UPLOADS)
-        ]
-        for thread in threads:
-            thread.daemon = True
-            thread.start()
-        for thread in threads:
-            thread.join()
+                    _upload_task(obj_hash, obj_urls, part, original_size)
+
+        with create_s3_session(concurrency.max_limit) as s3_session:
+            s3_session.hooks['response'].append(concurrency.response_hook)
+            _run_workers(_worker_thread, "upload-worker", counter, concurrency)
 
     return len(uploaded) == total
@@ -7,13 +7,13 @@ from __future__ import print_function
 import argparse
 import sys
 import os
-import pkg_resources
 
-import requests
+from six import PY2
 
 import quilt
 from . import command
 from .const import DEFAULT_QUILT_YML, QuiltException
+from .util import get_version
 
 # Mock `command` when running as a subprocess during testing
 if os.environ.get('QUILT_TEST_CLI_SUBPROC') == "True":
@@ -22,18 +22,31 @@ if os.environ.get('QUILT_TEST_CLI_SUBPROC') == "True":
 
 
 HANDLE = "owner/package_name"
-VERSION = command.VERSION
 
 def get_full_version():
+    import pkg_resources
+
     # attempt to return egg name with version
     try:
         quilt = pkg_resources.get_distribution('quilt')
     except pkg_resources.DistributionNotFound:
         pass
     else:
-        return "quilt {} ({})".format(VERSION, quilt.egg_name())
+        return "quilt {} ({})".format(get_version(), quilt.egg_name())
     # ..otherwise, just the version
-    return "quilt " + VERSION
+    return "quilt " + get_version()
+
+class VersionAction(argparse.Action):
+    """Argparse action to print the version; only looks it up when used"""
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS,
+                 help=None):  # pylint:disable=W0622
+        super(VersionAction, self).__init__(option_strings=option_strings, dest=dest, default=default,
+                                            nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        # Same streams as argparse's own 'version' action.
+        print(get_full_version(), file=sys.stderr if PY2 else sys.stdout)
+        parser.exit()
 
 class UsageAction(argparse.Action):
     """Argparse action to print usage (short help)"""
@@ -64,8 +77,7 @@ def argument_parser():
     description = ("Quilt Command Line\n"
                    "Visit our online docs at https://docs.quiltdata.com/")
     parser = CustomHelpParser(description=description, add_help=False)
-    parser.add_argument('--version', action='version', version=get_full_version(),
-                        help="Show version number and exit")
+    parser.add_argument('--version', action=VersionAction, help="Show version number and exit")
 
     # Hidden option '--dev' for development
     parser.add_argument('--dev', action='store_true', help=argparse.SUPPRESS)
@@ -115,6 +127,10 @@ def argument_parser():
     build_p = subparsers.add_parser("build", description=shorthelp, help=shorthelp)
     build_p.add_argument("package", type=str, help=HANDLE)
     build_p.add_argument("path", type=str, help="Path to source directory or YAML file")
+    build_p.add_argument("--plan", action="store_true",
+                         help="Show which nodes changed since the last build and only rebuild those")
+    build_p.add_argument("--watch", action="store_true",
+                         help="Keep rebuilding the nodes whose source files change")
     build_p.set_defaults(func=command.build)
 
     # quilt check
@@ -135,6 +151,15 @@ def argument_parser():
     delete_p.add_argument("package", type=str, help="Owner/Package Name")
     delete_p.set_defaults(func=command.delete)
 
+    # quilt diff
+    shorthelp = "Show the nodes that differ between two package instances"
+    diff_p = subparsers.add_parser("diff", description=shorthelp, help=shorthelp)
+    diff_p.add_argument("package_a", type=str,
+                        help="owner/package_name[:h:<hash> or :t:<tag> or :v:<version>]")
+    diff_p.add_argument("package_b", type=str,
+                        help="owner/package_name[:h:<hash> or :t:<tag> or :v:<version>]")
+    diff_p.set_defaults(func=command._cli_diff)
+
     # quilt export
     shorthelp = "Export file data from package or subpackage to filesystem"
     export_p = subparsers.add_parser("export", description=shorthelp, help=shorthelp)
@@ -176,6 +201,16 @@ def argument_parser():
     install_p.set_defaults(func=command.install)
     install_p.add_argument("-f", "--force", action="store_true", help="Overwrite without prompting")
     install_p.add_argument("-m", "--meta-only", action="store_true", help="Only download the metadata")
+    install_p.add_argument("--lazy", action="store_true",
+                           help="Only download the metadata; download the data when it's first used")
+    install_p.add_argument("--include", action="append", metavar="PATTERN",
+                           help="Only download the nodes matching PATTERN, e.g. 'raw/2017*' (can be repeated)")
+    install_p.add_argument("--exclude", action="append", metavar="PATTERN",
+                           help="Don't download the nodes matching PATTERN, e.g. '*/images/**' (can be repeated)")
+    install_p.add_argument("--resume", action="store_true",
+                           help="Continue an interrupted install of the package")
+    install_p.add_argument("--max-bandwidth", type=float, metavar="MBPS",
+                           help="Limit the download rate, in MB/s (default: $QUILT_MAX_BANDWIDTH)")
     # not a threading mutex, obv.
     install_mutex_group = install_p.add_mutually_exclusive_group()
     install_mutex_group.add_argument("-x", "--hash", help="Package hash", type=str)
@@ -216,6 +251,17 @@ def argument_parser():
                               "(fails if the package exists and is private)"))
     push_p.add_argument("--reupload", action="store_true",
                         help="Re-upload all fragments, even if fragment is already in registry")
+    push_p.add_argument("--stream", action="store_true",
+                        help=("Compress fragments while uploading them, without temporary files " +
+                              "(requires a registry that supports multipart uploads)"))
+    push_p.add_argument("--cache-compressed", action="store_true",
+                        help="Keep compressed fragments in the local store for later pushes")
+    push_p.add_argument("--verify-existing", action="store_true",
+                        help="Have the registry check its storage for fragments it already has")
+    push_p.add_argument("--max-bandwidth", type=float, metavar="MBPS",
+                        help="Limit the upload rate, in MB/s (default: $QUILT_MAX_BANDWIDTH)")
+    push_p.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted push of the package")
     push_p.set_defaults(func=command.push)
 
     # quilt rm
@@ -362,6 +408,10 @@ def main(args=None):
     except QuiltException as ex:
         print(ex.message, file=sys.stderr)
         return 1
-    except requests.exceptions.ConnectionError as ex:
+    except Exception as ex:
+        # Only commands that talk to the registry import `requests`.
+        requests = sys.modules.get('requests')
+        if requests is None or not isinstance(ex, requests.exceptions.ConnectionError):
+            raise
         print("Failed to connect: %s" % ex, file=sys.stderr)
         return 1
@@ -0,0 +1,372 @@
+"""
+Binary format for package manifests (the files in `<package>/contents/`).
+
+Layout:
+
+    header:  MAGIC, format version
+    records: one zlib-compressed record per group, written post-order
+    trailer: offset and length of the root group's record
+
+A group record holds the group's metadata and a table of its children,
+sorted by name. File and table children are stored inline, with their
+hashes as raw 32-byte digests. Child groups are stored as the offset and
+length of their own record, so any subtree can be decoded without touching
+the rest of the file. Strings (names, metadata keys and values) are
+deduplicated within each record.
+
+JSON manifests (the interchange format used by the registry, and the
+format written by older versions) are still accepted by the readers.
+"""
+import binascii
+import io
+import json
+import struct
+import zlib
+
+from six import iteritems, string_types
+
+from .core import (CompactManifest, Node, GroupNode, RootNode, TableNode, FileNode,
+                   PackageFormat, decode_node, find_object_hashes)
+
+MAGIC = b'QMAN'
+VERSION = 1
+
+NODE_TYPES = (GroupNode, RootNode, TableNode, FileNode)
+DIGEST_SIZE = 32
+
+_HEADER = struct.Struct('>4sH')
+_TRAILER = struct.Struct('>QQ')
+_PREFIX = struct.Struct('>IIIIII')  # Metadata start, count; string, entry, child, digest counts.
+_CHILD_FORMAT = 'IBIIQQ'            # Name, type, metadata start, count; digest range or record location.
+_CHILD_FIELDS = len(_CHILD_FORMAT)
+_JSON_VALUE = 0x80000000            # Metadata value is a JSON-encoded string.
+
+
+class ManifestException(Exception):
+    """
+    Exception class for malformed manifests
+    """
+    pass
+
+
+def _node_type(node):
+    for code, node_cls in reversed(list(enumerate(NODE_TYPES))):
+        if isinstance(node, node_cls):
+            return code
+    raise TypeError("Unexpected type: %r" % type(node))
+
+
+class _RecordWriter(object):
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.entries = []
+        self.children = []
+        self.digests = []
+
+    def _string(self, value):
+        idx = self.string_ids.get(value)
+        if idx is None:
+            idx = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return idx
+
+    def metadata(self, metadata):
+        start = len(self.entries) // 2
+        for key, value in sorted(iteritems(metadata or {})):
+            if isinstance(value, string_types):
+                value_id = self._string(value)
+            else:
+                value_id = self._string(json.dumps(value, sort_keys=True)) | _JSON_VALUE
+            self.entries.extend([self._string(key), value_id])
+        return start, len(self.entries) // 2 - start
+
+    def child(self, name, node, location=None):
+        if location is None:
+            meta_start, meta_count = self.metadata(node.metadata)
+            first = len(self.digests)
+            for objhash in node.hashes:
+                # Hashes must survive the round trip unchanged, or the package hash would change.
+                if len(objhash) != 2 * DIGEST_SIZE or objhash != objhash.lower():
+                    raise ManifestException("Invalid object hash: %r" % objhash)
+                try:
+                    self.digests.append(binascii.unhexlify(objhash))
+                except (TypeError, ValueError):
+                    raise ManifestException("Invalid object hash: %r" % objhash)
+            location = (first, len(self.digests) - first)
+        else:
+            # Groups keep their metadata in their own record.
+            meta_start, meta_count = 0, 0
+        self.children.extend([self._string(name), _node_type(node), meta_start, meta_count])
+        self.children.extend(location)
+
+    def encode(self, group_metadata):
+        meta_start, meta_count = self.metadata(group_metadata)
+        strings = [s.encode('utf-8') for s in self.strings]
+        nchildren = len(self.children) // _CHILD_FIELDS
+        return b''.join([
+            _PREFIX.pack(meta_start, meta_count, len(strings), len(self.entries) // 2,
+                         nchildren, len(self.digests)),
+            struct.pack('>%dI' % len(strings), *[len(s) for s in strings]),
+            b''.join(strings),
+            struct.pack('>%dI' % len(self.entries), *self.entries),
+            struct.pack('>' + _CHILD_FORMAT * nchildren, *self.children),
+            b''.join(self.digests),
+        ])
+
+
+def dump(contents, fp):
+    """
+    Writes `contents` (a RootNode) to a binary file object.
+    """
+    assert isinstance(contents, RootNode)
+    fp.write(_HEADER.pack(MAGIC, VERSION))
+    offset = _HEADER.size
+
+    # Iterative post-order, like `CompactManifest.from_node`: each group's record is
+    # written after the records of its subgroups, so it knows their locations.
+    stack = [(contents, None)]
+    locations = []
+    while stack:
+        group, names = stack.pop()
+        if names is None:
+            names = sorted(name for name, child in iteritems(group.children) if isinstance(child, GroupNode))
+            stack.append((group, names))
+            stack.extend((group.children[name], None) for name in reversed(names))
+            continue
+
+        child_locations = dict(zip(names, locations[len(locations) - len(names):]))
+        del locations[len(locations) - len(names):]
+        writer = _RecordWriter()
+        for name, child in sorted(iteritems(group.children)):
+            writer.child(name, child, child_locations.get(name))
+        record = zlib.compress(writer.encode(group.metadata))
+        fp.write(record)
+        locations.append((offset, len(record)))
+        offset += len(record)
+
+    fp.write(_TRAILER.pack(*locations[0]))
+
+
+def dumps(contents):
+    """
+    Same as `dump`, but returns bytes.
+    """
+    buf = io.BytesIO()
+    dump(contents, buf)
+    return buf.getvalue()
+
+
+class _Record(object):
+    """
+    A decoded group record.
+    """
+    def __init__(self, data):
+        (meta_start, meta_count, nstrings, nentries,
+         nchildren, ndigests) = _PREFIX.unpack_from(data, 0)
+        pos = _PREFIX.size
+
+        lengths = struct.unpack_from('>%dI' % nstrings, data, pos)
+        pos += 4 * nstrings
+        blob = data[pos:pos + sum(lengths)]
+        pos += len(blob)
+        try:
+            # Usually, everything is ASCII, and character offsets are byte offsets.
+            blob = blob.decode('ascii')
+        except UnicodeDecodeError:
+            pass
+        strings = []
+        start = 0
+        for length in lengths:
+            strings.append(blob[start:start + length])
+            start += length
+        if isinstance(blob, bytes):
+            strings = [string.decode('utf-8') for string in strings]
+
+        entries = struct.unpack_from('>%dI' % (2 * nentries), data, pos)
+        pos += 8 * nentries
+        self.children = struct.unpack_from('>' + _CHILD_FORMAT * nchildren, data, pos)
+        pos += struct.calcsize('>' + _CHILD_FORMAT * nchildren)
+        self.hexdigests = binascii.hexlify(data[pos:pos + ndigests * DIGEST_SIZE]).decode('ascii')
+
+        self.strings = strings
+        self.entries = entries
+        # Decoded (key, value) pairs, unless some values are JSON: those
+        # must be decoded for each node, so nodes don't share mutable values.
+        if any(value_id & _JSON_VALUE for value_id in entries[1::2]):
+            self.pairs = None
+        else:
+            self.pairs = [(strings[key_id], strings[value_id])
+                          for key_id, value_id in zip(entries[0::2], entries[1::2])]
+        self.metadata = self.get_metadata(meta_start, meta_count)
+
+    def get_metadata(self, start, count):
+        if self.pairs is not None:
+            return dict(self.pairs[start:start + count])
+        metadata = {}
+        strings = self.strings
+        for pos in range(2 * start, 2 * (start + count), 2):
+            value_id = self.entries[pos + 1]
+            if value_id & _JSON_VALUE:
+                value = json.loads(strings[value_id & ~_JSON_VALUE])
+            else:
+                value = strings[value_id]
+            metadata[strings[self.entries[pos]]] = value
+        return metadata
+
+    def get_hashes(self, first, count):
+        hexdigests = self.hexdigests
+        size = 2 * DIGEST_SIZE
+        return [hexdigests[pos * size:(pos + 1) * size] for pos in range(first, first + count)]
+
+    def iter_children(self):
+        """
+        Yields (name, node type, metadata start, metadata count, a, b) tuples, where
+        (a, b) is the digest range for leaves and the record location for groups.
+        """
+        children = self.children
+        strings = self.strings
+        fields = [children[pos::_CHILD_FIELDS] for pos in range(_CHILD_FIELDS)]
+        for name_id, code, meta_start, meta_count, a, b in zip(*fields):
+            yield strings[name_id], NODE_TYPES[code], meta_start, meta_count, a, b
+
+    def make_children(self, reader):
+        """
+        Returns the group's children: regular nodes for files and tables,
+        and lazy nodes for groups.
+        """
+        # This is the hot loop when loading a whole package, so it's inlined.
+        children = {}
+        strings = self.strings
+        hexdigests = self.hexdigests
+        pairs = self.pairs
+        get_metadata = self.get_metadata
+        size = 2 * DIGEST_SIZE
+        parquet = PackageFormat.PARQUET.value
+        fields = [self.children[pos::_CHILD_FIELDS] for pos in range(_CHILD_FIELDS)]
+        for name_id, code, meta_start, meta_count, a, b in zip(*fields):
+            node_cls = NODE_TYPES[code]
+            if node_cls is GroupNode:
+                children[strings[name_id]] = _LazyGroupNode(reader, (a, b))
+                continue
+            if pairs is not None:
+                metadata = dict(pairs[meta_start:meta_start + meta_count])
+            else:
+                metadata = get_metadata(meta_start, meta_count)
+            hashes = [hexdigests[pos * size:(pos + 1) * size] for pos in range(a, a + b)]
+            if node_cls is TableNode:
+                children[strings[name_id]] = TableNode(hashes, parquet, metadata)
+            else:
+                children[strings[name_id]] = FileNode(hashes, metadata)
+        return children
+
+
+class _Reader(object):
+    def __init__(self, data):
+        if len(data) < _HEADER.size + _TRAILER.size:
+            raise ManifestException("Manifest is truncated")
+        magic, version = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ManifestException("Not a binary manifest")
+        if version != VERSION:
+            raise ManifestException("Unsupported manifest version: %d" % version)
+        self.data = data
+        self.root_location = _TRAILER.unpack_from(data, len(data) - _TRAILER.size)
+
+    def record(self, location):
+        offset, length = location
+        return _Record(zlib.decompress(self.data[offset:offset + length]))
+
+    def iter_object_hashes(self):
+        stack = [self.root_location]
+        while stack:
+            record = self.record(stack.pop())
+            for _, node_cls, _, _, a, b in record.iter_children():
+                if node_cls is GroupNode:
+                    stack.append((a, b))
+                else:
+                    for objhash in record.get_hashes(a, b):
+                        yield objhash
+
+
+class _LazyGroup(object):
+    """
+    A group whose record is only decoded when its children or metadata are accessed.
+    After that, it behaves (and can be modified) like a regular group.
+    """
+    __slots__ = ()
+
+    def __init__(self, reader, location):
+        self._reader = reader
+        self._location = location
+
+    def _is_loaded(self):
+        return self._reader is None
+
+    def _load(self):
+        record = self._reader.record(self._location)
+        GroupNode.children.fset(self, record.make_children(self._reader))
+        Node.metadata.__set__(self, record.metadata)
+        self._reader = None
+
+    @property
+    def children(self):
+        if not self._is_loaded():
+            self._load()
+        return GroupNode.children.fget(self)
+
+    @children.setter
+    def children(self, value):
+        if not self._is_loaded():
+            self._load()
+        GroupNode.children.fset(self, value)
+
+    @property
+    def metadata(self):
+        if not self._is_loaded():
+            self._load()
+        return Node.metadata.__get__(self)
+
+    @metadata.setter
+    def metadata(self, value):
+        if not self._is_loaded():
+            self._load()
+        Node.metadata.__set__(self, value)
+
+class _LazyGroupNode(_LazyGroup, GroupNode):
+    __slots__ = ('_reader', '_location')
+
+class _LazyRootNode(_LazyGroup, RootNode):
+    __slots__ = ('_reader', '_location')
+
+
+def is_binary(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def loads(data):
+    """
+    Decodes a manifest: binary manifests are decoded lazily, one group at a time;
+    JSON ones are parsed right away.
+    """
+    if is_binary(data):
+        reader = _Reader(data)
+        return _LazyRootNode(reader, reader.root_location)
+    return json.loads(data.decode('utf-8'), object_hook=decode_node)
+
+
+def load(fp):
+    """
+    Same as `loads`, but reads from a binary file object.
+    """
+    return loads(fp.read())
+
+
+def iter_object_hashes(fp):
+    """
+    Yields the hashes of all objects in a manifest without building its tree.
+    """
+    data = fp.read()
+    if is_binary(data):
+        return _Reader(data).iter_object_hashes()
+    return find_object_hashes(CompactManifest.loads(data.decode('utf-8')).root)
@@ -1,9 +1,11 @@
 import json
 import os
+import threading
 
 from .compat import pathlib
 from .const import TargetType, QuiltException
-from .core import (decode_node, encode_node, hash_contents,
+from . import manifest
+from .core import (hash_contents, find_object_hashes,
                    FileNode, GroupNode, TableNode,
                    PackageFormat)
 from .util import is_nodename
@@ -16,11 +18,15 @@ class PackageException(QuiltException):
     pass
 
 
+LAZY_PREFETCH_ENV = 'QUILT_LAZY_PREFETCH'
+
+
 class Package(object):
     CONTENTS_DIR = 'contents'
     TAGS_DIR = 'tags'
     VERSIONS_DIR = 'versions'
     LATEST = 'latest'
+    REMOTE_DIR = 'remote'
 
     def __init__(self, store, user, package, path, contents=None, pkghash=None):
         self._store = store
@@ -34,10 +40,14 @@ class Package(object):
             os.mkdir(os.path.join(self._path, self.TAGS_DIR))
             os.mkdir(os.path.join(self._path, self.VERSIONS_DIR))
 
+        # The hash of the instance the contents were loaded from, so that it doesn't need
+        # to be computed, which would decode all of the lazily-loaded groups.
+        self._instance_hash = None
         if contents is None:
             contents = self._load_contents(pkghash)
 
         self._contents = contents
+        self._prefetch_thread = None
 
     def __getitem__(self, item):
         """Get a (core) node from this package.
@@ -102,14 +112,18 @@ class Package(object):
             msg = "Invalid hash for package {owner}/{pkg}: {hash}"
             raise PackageException(msg.format(hash=instance_hash, owner=self._user, pkg=self._package))
 
-        with open(contents_path, 'r') as contents_file:
-            return json.load(contents_file, object_hook=decode_node)
+        # Groups are only decoded when accessed.
+        with open(contents_path, 'rb') as contents_file:
+            contents = manifest.load(contents_file)
+        self._instance_hash = instance_hash
+        return contents
 
     def save_package_tree(self, node_path, pkgnode):
         """
         Adds a package or sub-package tree from an existing package to this package's
         contents.
         """
+        self._instance_hash = None
         contents = self.get_contents()
         if node_path:
             ptr = contents
@@ -141,6 +155,13 @@ class Package(object):
         """
         filehash = self._store.save_file(srcfile)
         self._add_to_contents(node_path, [filehash], '', source_path, target)
+        return filehash
+
+    def save_cached_file(self, hashes, node_path, source_path, target):
+        """
+        Save a (raw) file that is already in the store.
+        """
+        self._add_to_contents(node_path, hashes, '', source_path, target)
 
     def save_group(self, node_path):
         """
@@ -160,6 +181,7 @@ class Package(object):
         Sets a new contents.
         """
         self._contents = contents
+        self._instance_hash = None
 
     def save_contents(self):
         """
@@ -168,8 +190,9 @@ class Package(object):
         """
         instance_hash = self.get_hash()
         dest = os.path.join(self._path, self.CONTENTS_DIR, instance_hash)
-        with open(dest, 'w') as contents_file:
-            json.dump(self._contents, contents_file, default=encode_node, indent=2, sort_keys=True)
+        with open(dest, 'wb') as contents_file:
+            manifest.dump(self._contents, contents_file)
+        self._store.upgrade_format_version()
 
         tag_dir = os.path.join(self._path, self.TAGS_DIR)
         if not os.path.isdir(tag_dir):
@@ -179,6 +202,8 @@ class Package(object):
         with open (latest_tag, 'w') as tagfile:
             tagfile.write("{hsh}".format(hsh=instance_hash))
 
+        self._store.update_catalog(self._path)
+
     def get_hash(self):
         """
         Returns the hash digest of the package data.
@@ -197,10 +222,113 @@ class Package(object):
         """
         return self._store
 
+    def _remote_path(self):
+        # Per instance: other instances of the package may be installed differently.
+        instance_hash = self._instance_hash or self.get_hash()
+        return os.path.join(self._path, self.REMOTE_DIR, instance_hash + '.json')
+
+    def set_remote(self, team):
+        """
+        Marks this instance as installed lazily: its fragments get downloaded
+        from `team`'s registry when they're first used.
+        """
+        remote_dir = os.path.join(self._path, self.REMOTE_DIR)
+        if not os.path.isdir(remote_dir):
+            os.mkdir(remote_dir)
+        with open(self._remote_path(), 'w') as fd:
+            json.dump(dict(team=team), fd)
+
+    def get_remote(self):
+        """
+        Returns the remote info of a lazily-installed instance, or None.
+        """
+        try:
+            with open(self._remote_path()) as fd:
+                return json.load(fd)
+        except IOError:
+            return None
+
+    def clear_remote(self):
+        """
+        Marks this instance as fully installed; only once all of its fragments are there.
+        """
+        try:
+            os.remove(self._remote_path())
+        except OSError:
+            pass
+
+    def fetch_fragments(self, node, parent=None):
+        """
+        Downloads the missing fragments of a (core) node of a lazily-installed package.
+        If $QUILT_LAZY_PREFETCH is set and the node's `parent` group is given, also starts
+        downloading the node's siblings in the background.
+        """
+        remote = self.get_remote()
+        if remote is None:
+            return
+
+        # Wait for the prefetch; it may be downloading the same fragments.
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
+
+        from .command import _fetch_fragments
+
+        missing = self._missing_hashes([node])
+        if missing:
+            _fetch_fragments(remote['team'], self._store, missing)
+
+        if parent is not None and os.environ.get(LAZY_PREFETCH_ENV):
+            siblings = self._missing_hashes(
+                child for child in parent.children.values()
+                if child is not node and not isinstance(child, GroupNode)
+            )
+            if siblings:
+                def prefetch():
+                    try:
+                        _fetch_fragments(remote['team'], self._store, siblings)
+                    except Exception:   # pylint:disable=W0703
+                        pass            # They'll get fetched (or fail) when used.
+
+                self._prefetch_thread = threading.Thread(target=prefetch, name='quilt-prefetch')
+                self._prefetch_thread.daemon = True
+                self._prefetch_thread.start()
+
+    def fetch_missing_fragments(self, nodes):
+        """
+        Downloads all the missing fragments of (core) `nodes`, e.g., before the package
+        is pushed or copied. Raises PackageException if some are missing, and the package
+        wasn't installed lazily.
+        """
+        missing = self._missing_hashes(nodes)
+        if not missing:
+            return
+
+        remote = self.get_remote()
+        if remote is None:
+            raise PackageException("Package {owner}/{pkg} is missing {count} fragments; install it again.".format(
+                owner=self._user, pkg=self._package, count=len(missing)))
+
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
+
+        from .command import _fetch_fragments
+        _fetch_fragments(remote['team'], self._store, self._missing_hashes(nodes))
+
+    def _missing_hashes(self, nodes):
+        missing = set()
+        for node in nodes:
+            for objhash in find_object_hashes(node):
+                if not os.path.exists(self._store.object_path(objhash)):
+                    missing.add(objhash)
+        return missing
+
     def _add_to_contents(self, node_path, hashes, ext, source_path, target):
         """
         Adds an object (name-hash mapping) or group to package contents.
         """
+        self._instance_hash = None
         assert isinstance(node_path, list)
 
         contents = self.get_contents()
@@ -1,20 +1,22 @@
 """
 Build: parse and add user-supplied files to store
 """
+import hashlib
 import os
 from shutil import copyfile, move, rmtree
 import uuid
 
 from enum import Enum
-import pandas as pd
 
-from .const import DEFAULT_TEAM, PACKAGE_DIR_NAME, QuiltException
-from .core import FileNode, RootNode, TableNode, find_object_hashes
+from .const import DEFAULT_TEAM, HASH_TYPE, PACKAGE_DIR_NAME, QuiltException
+from .core import FileNode, RootNode, TableNode
+from . import catalog, manifest
 from .hashing import digest_file
 from .package import Package, PackageException
 from .util import BASE_DIR, sub_dirs, sub_files, is_nodename
 
 CHUNK_SIZE = 4096
+COPY_CHUNK_SIZE = 1024 * 1024
 
 # Helper function to return the default package store path
 def default_store_location():
@@ -32,6 +34,18 @@ class StoreException(QuiltException):
     pass
 
 
+def _copy_and_digest(src, dest):
+    """
+    Copies a file; returns the hash of its contents.
+    """
+    hval = hashlib.new(HASH_TYPE)
+    with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+        for chunk in iter(lambda: src_file.read(COPY_CHUNK_SIZE), b''):
+            hval.update(chunk)
+            dest_file.write(chunk)
+    return hval.hexdigest()
+
+
 class PackageStore(object):
     """
     Base class for managing Quilt data package repositories. This
@@ -43,7 +57,11 @@ class PackageStore(object):
     TMP_OBJ_DIR = 'tmp'
     PKG_DIR = 'pkgs'
     CACHE_DIR = 'cache'
-    VERSION = '1.3'
+    GZ_OBJ_DIR = 'gzobjs'
+    VERSION = '1.4'
+    # The last format without binary manifests; clients that only read JSON ones accept it.
+    # Stores stay in it until a binary manifest is written to them.
+    LEGACY_VERSION = '1.3'
 
     __parquet_lib = None
 
@@ -83,8 +101,8 @@ class PackageStore(object):
             os.mkdir(os.path.join(pkgdir, DEFAULT_TEAM))
             for old_dir in old_dirs:
                 os.rename(os.path.join(pkgdir, old_dir), os.path.join(pkgdir, DEFAULT_TEAM, old_dir))
-            self._write_format_version()
-        elif version not in (None, self.VERSION):
+            self._write_format_version(self.LEGACY_VERSION)
+        elif version not in (None, self.LEGACY_VERSION, self.VERSION):
             msg = (
                 "The package repository at {0} is not compatible"
                 " with this version of quilt. Revert to an"
@@ -104,7 +122,7 @@ class PackageStore(object):
             if not os.path.isdir(path):
                 os.mkdir(path)
         if not os.path.exists(self._version_path()):
-            self._write_format_version()
+            self._write_format_version(self.LEGACY_VERSION)
 
     @classmethod
     def find_store_dirs(cls):
@@ -124,8 +142,12 @@ class PackageStore(object):
         """
         cls.check_name(team, user, package)
         dirs = cls.find_store_dirs()
+        key = catalog.package_key(team, user, package)
         for store_dir in dirs:
             store = PackageStore(store_dir)
+            # The catalog can be behind if the package is still being created.
+            if key not in store.get_catalog() and not os.path.isdir(store.package_path(team, user, package)):
+                continue
             pkg = store.get_package(team, user, package)
             if pkg is not None:
                 return pkg
@@ -155,15 +177,25 @@ class PackageStore(object):
         else:
             return None
 
-    def _write_format_version(self):
+    def _write_format_version(self, version):
         with open(self._version_path(), 'w') as versionfile:
-            versionfile.write(self.VERSION)
+            versionfile.write(version)
+
+    def upgrade_format_version(self):
+        """
+        Marks the store as having binary manifests, once one is written to it. Only the
+        primary store is ever upgraded; the others may be shared with older clients.
+        """
+        if os.path.abspath(self._path) != os.path.abspath(default_store_location()):
+            return
+        if self._read_format_version() != self.VERSION:
+            self._write_format_version(self.VERSION)
 
     # TODO: find a package instance other than 'latest', e.g. by
     # looking-up by hash, tag or version in the local store.
-    def get_package(self, team, user, package):
+    def get_package(self, team, user, package, pkghash=None):
         """
-        Gets a package from this store.
+        Gets a package from this store: the latest instance, or the one with the given hash.
         """
         self.check_name(team, user, package)
         path = self.package_path(team, user, package)
@@ -173,12 +205,33 @@ class PackageStore(object):
                     store=self,
                     user=user,
                     package=package,
-                    path=path
+                    path=path,
+                    pkghash=pkghash
                     )
             except PackageException:
                 pass
         return None
 
+    def find_instance(self, team, user, package, hash_prefix=None, tag=Package.LATEST):
+        """
+        Returns the hash of an installed instance of a package, looked up by
+        a hash prefix or by a tag, or None if there isn't one.
+        """
+        self.check_name(team, user, package)
+        entry = self.get_catalog().get(catalog.package_key(team, user, package))
+        if entry is None:
+            # Not in the catalog (yet); check the directory itself.
+            entry = catalog.scan_package(self.package_path(team, user, package))
+            if entry is None:
+                return None
+        if hash_prefix is not None:
+            matches = [h for h in entry['instances'] if h.startswith(hash_prefix.lower())]
+            if len(matches) > 1:
+                raise StoreException("Ambiguous hash for package {owner}/{pkg}: {hash!r}".format(
+                    owner=user, pkg=package, hash=hash_prefix))
+            return matches[0] if matches else None
+        return entry['tags'].get(tag)
+
     def install_package(self, team, user, package, contents):
         """
         Creates a new package in the default package store
@@ -227,17 +280,40 @@ class PackageStore(object):
             # Collect objects from all instances for potential cleanup
             contents_path = os.path.join(path, Package.CONTENTS_DIR)
             for instance in os.listdir(contents_path):
-                pkg = Package(self, user, package, path, pkghash=instance)
-                remove_objs.update(find_object_hashes(pkg.get_contents()))
+                remove_objs.update(self._instance_object_hashes(path, instance))
             # Remove package manifests
             rmtree(path)
+            self.update_catalog(path)
 
         return self.prune(remove_objs)
 
+    def get_catalog(self):
+        """
+        Returns the store's catalog: a dict of "team/user/package" keys to
+        {"tags": {tag: hash}, "instances": [hash, ...]}.
+        """
+        return catalog.load(self._path, os.path.join(self._path, self.PKG_DIR))
+
+    def update_catalog(self, pkgpath):
+        """
+        Updates the catalog after a package directory has been changed.
+        """
+        pkgs_path = os.path.abspath(os.path.join(self._path, self.PKG_DIR))
+        relpath = os.path.relpath(os.path.abspath(pkgpath), pkgs_path)
+        parts = relpath.split(os.sep)
+        if len(parts) != 3 or os.pardir in parts:
+            # Not a package in this store, e.g., a dry run.
+            return
+        catalog.update(self._path, pkgs_path, '/'.join(parts))
+
     def iterpackages(self):
         """
         Return an iterator over all the packages in the PackageStore.
         """
+        for _, user, pkg, pkgpath, hsh in self._iterinstances():
+            yield Package(self, user, pkg, pkgpath, pkghash=hsh)
+
+    def _iterinstances(self):
         pkgdir = os.path.join(self._path, self.PKG_DIR)
         if not os.path.isdir(pkgdir):
             return
@@ -246,34 +322,35 @@ class PackageStore(object):
                 for pkg in sub_dirs(self.user_path(team, user)):
                     pkgpath = self.package_path(team, user, pkg)
                     for hsh in sub_files(os.path.join(pkgpath, Package.CONTENTS_DIR)):
-                        yield Package(self, user, pkg, pkgpath, pkghash=hsh)
+                        yield team, user, pkg, pkgpath, hsh
+
+    def _instance_object_hashes(self, pkgpath, instance_hash):
+        """
+        Returns the set of objects used by a package instance, without
+        building its tree.
+        """
+        contents_path = os.path.join(pkgpath, Package.CONTENTS_DIR, instance_hash)
+        with open(contents_path, 'rb') as contents_file:
+            return set(manifest.iter_object_hashes(contents_file))
 
     def ls_packages(self):
         """
         List packages in this store.
         """
         packages = []
-        pkgdir = os.path.join(self._path, self.PKG_DIR)
-        if not os.path.isdir(pkgdir):
-            return []
-        for team in sub_dirs(pkgdir):
-            for user in sub_dirs(self.team_path(team)):
-                for pkg in sub_dirs(self.user_path(team, user)):
-                    pkgpath = self.package_path(team, user, pkg)
-                    pkgmap = {h : [] for h in sub_files(os.path.join(pkgpath, Package.CONTENTS_DIR))}
-                    for tag in sub_files(os.path.join(pkgpath, Package.TAGS_DIR)):
-                        with open(os.path.join(pkgpath, Package.TAGS_DIR, tag), 'r') as tagfile:
-                            pkghash = tagfile.read()
-                            pkgmap[pkghash].append(tag)
-                    for pkghash, tags in pkgmap.items():
-                        # add teams here if any other than DEFAULT_TEAM should be hidden.
-                        team_token = '' if team in (DEFAULT_TEAM,) else team + ':'
-                        fullpkg = "{team}{owner}/{pkg}".format(team=team_token, owner=user, pkg=pkg)
-                        # Add an empty string tag for untagged hashes
-                        displaytags = tags if tags else [""]
-                        # Display a separate full line per tag like Docker
-                        for tag in displaytags:
-                            packages.append((fullpkg, str(tag), pkghash))
+        for team, user, pkg, entry in catalog.iter_packages(self.get_catalog()):
+            pkgmap = {h : [] for h in entry['instances']}
+            for tag, pkghash in sorted(entry['tags'].items()):
+                pkgmap.setdefault(pkghash, []).append(tag)
+            for pkghash, tags in pkgmap.items():
+                # add teams here if any other than DEFAULT_TEAM should be hidden.
+                team_token = '' if team is None else team + ':'
+                fullpkg = "{team}{owner}/{pkg}".format(team=team_token, owner=user, pkg=pkg)
+                # Add an empty string tag for untagged hashes
+                displaytags = tags if tags else [""]
+                # Display a separate full line per tag like Docker
+                for tag in displaytags:
+                    packages.append((fullpkg, str(tag), pkghash))
 
         return packages
 
@@ -309,6 +386,49 @@ class PackageStore(object):
         """
         return os.path.join(self._path, self.TMP_OBJ_DIR, name)
 
+    def link_object(self, objhash, size=None):
+        """
+        Looks for an object in the other package directories (see `find_store_dirs`),
+        and hardlinks it into this store - or copies it, if it's on another filesystem.
+        Returns True if it was found.
+
+        Hardlinked objects are trusted, like the ones in this store: they're the same file,
+        and reading it to check its hash would cost as much as the copy. Copies are checked
+        while they're made, and discarded if the hash doesn't match.
+        """
+        for store_dir in self.find_store_dirs():
+            if os.path.abspath(store_dir) == os.path.abspath(self._path):
+                continue
+            path = os.path.join(store_dir, self.OBJ_DIR, objhash)
+            if not os.path.isfile(path) or (size is not None and os.path.getsize(path) != size):
+                continue
+
+            objpath = self.object_path(objhash)
+            try:
+                os.link(path, objpath)
+            except OSError:
+                tmppath = self.temporary_object_path(objhash)
+                if _copy_and_digest(path, tmppath) != objhash:
+                    os.remove(tmppath)
+                    continue
+                move(tmppath, objpath)
+            return True
+        return False
+
+    def journal_path(self, operation, team, user, package):
+        """
+        Returns the path to the journal of an install or push of a package.
+        """
+        name = '%s.%s.%s.%s.journal' % (operation, team or DEFAULT_TEAM, user, package)
+        return os.path.join(self._path, self.TMP_OBJ_DIR, name)
+
+    def compressed_object_path(self, objhash):
+        """
+        Returns the path to the gzip'ed copy of an object, kept so it doesn't
+        need to be compressed again for each upload.
+        """
+        return os.path.join(self._path, self.GZ_OBJ_DIR, objhash + '.gz')
+
     def cache_path(self, name):
         """
         Returns the path to a temporary object, before we know its hash.
@@ -325,13 +445,16 @@ class PackageStore(object):
             objs = os.listdir(objdir)
         remove_objs = set(objs)
 
-        for pkg in self.iterpackages():
-            remove_objs.difference_update(find_object_hashes(pkg.get_contents()))
+        for _, _, _, pkgpath, hsh in self._iterinstances():
+            remove_objs.difference_update(self._instance_object_hashes(pkgpath, hsh))
 
         for obj in remove_objs:
             path = self.object_path(obj)
             if os.path.exists(path):
                 os.remove(path)
+            compressed_path = self.compressed_object_path(obj)
+            if os.path.exists(compressed_path):
+                os.remove(compressed_path)
         return remove_objs
 
     def _read_parquet_arrow(self, hash_list):
@@ -377,6 +500,8 @@ class PackageStore(object):
         """
         Save a DataFrame to the store.
         """
+        import pandas as pd
+
         storepath = self.temporary_object_path(str(uuid.uuid4()))
 
         # switch parquet lib
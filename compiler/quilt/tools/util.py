@@ -18,6 +18,7 @@ APP_NAME = "QuiltCli"
 APP_AUTHOR = "QuiltData"
 BASE_DIR = user_data_dir(APP_NAME, APP_AUTHOR)
 CONFIG_DIR = user_config_dir(APP_NAME, APP_AUTHOR)
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
 PYTHON_IDENTIFIER_RE = re.compile(r'^[a-zA-Z_]\w*$')
 EXTENDED_PACKAGE_RE = re.compile(
     r'^((?:\w+:)?\w+/[\w/]+)(?::h(?:ash)?:(.+)|:v(?:ersion)?:(.+)|:t(?:ag)?:(.+))?$'
@@ -127,6 +128,33 @@ def gzip_compress(data):
     return buf.getvalue()
 
 
+def have_zstd():
+    """
+    Returns whether the optional `zstandard` package is installed.
+    """
+    try:
+        import zstandard        # pylint:disable=W0612
+        return True
+    except ImportError:
+        return False
+
+
+def zstd_compress(data):
+    """
+    Compress a string with zstd. Requires `zstandard`.
+    """
+    import zstandard
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def zstd_decompress(data):
+    """
+    Decompress a zstd'ed string, even if it doesn't record its size. Requires `zstandard`.
+    """
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
 def sub_dirs(path, invisible=False):
     """
     Child directories (non-recursive)
@@ -265,6 +293,18 @@ def to_nodename(string, invalid=None, raise_exc=False):
 
     return result
 
+def format_bytes(num):
+    """
+    Formats a byte count for display, e.g. 1536 -> '1.5 KB'.
+    """
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(num) < 1024 or unit == 'TB':
+            break
+        num /= 1024.0
+    if unit == 'B':
+        return "%d %s" % (num, unit)
+    return "%.1f %s" % (num, unit)
+
 def get_free_space(directory):
     if hasattr(shutil, 'disk_usage'):
         # Python3
@@ -277,3 +317,20 @@ def get_free_space(directory):
         # Python2, win32
         # Not implemented - but we don't support this combination, anyway.
         raise NotImplementedError
+
+_version = None
+
+def get_version():
+    """
+    Returns the installed version of quilt. Looked up on first use, since
+    importing `pkg_resources` takes a while.
+    """
+    global _version         # pylint:disable=C0103
+    if _version is None:
+        try:
+            from importlib.metadata import version  # Python 3.8+
+            _version = version('quilt')
+        except ImportError:
+            import pkg_resources
+            _version = pkg_resources.get_distribution('quilt').version
+    return _version
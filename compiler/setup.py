@@ -57,7 +57,11 @@ setup(
             'mock; python_version<"3.3"',
             'pytest',
             'responses>=0.7.0',
-        ]
+        ],
+        # Use: pip install quilt[zstd]
+        'zstd': [
+            'zstandard',
+        ],
     },
     include_package_data=True,
     entry_points={
@@ -20,6 +20,7 @@ from .core import decode_node, encode_node
 
 app = Flask(__name__.split('.')[0])
 app.wsgi_app = middleware.RequestEncodingMiddleware(app.wsgi_app)
+app.after_request(middleware.encode_response)
 app.config.from_object('quilt_server.config')
 app.config.from_envvar('QUILT_SERVER_CONFIG')
 
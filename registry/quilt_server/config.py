@@ -17,6 +17,9 @@ SQLALCHEMY_ECHO = False  # Turn it on for debugging.
 
 PACKAGE_URL_EXPIRATION = 60*60*24 # 24 hours
 
+# Let clients that support it upload zstd'ed copies of the objects, next to the gzip'ed ones.
+ZSTD_FRAGMENTS = bool(os.getenv('ZSTD_FRAGMENTS', ''))
+
 JSON_USE_ENCODE_METHODS = True  # Support the __json__ method in Node
 
 # 100MB max for request body.
@@ -1,14 +1,53 @@
 # Copyright (c) 2017 Quilt Data, Inc. All rights reserved.
 
 """
-Middleware: handling gzip encoding, etc.
+Middleware: handling gzip and zstd encoding, etc.
 """
 
 import gzip
 import zlib
 
-from werkzeug.exceptions import BadRequest
+from flask import request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
 from werkzeug.wsgi import get_input_stream
+import zstandard
+
+# Request encodings we can decode; sent to clients in the `Accept-Encoding` response header
+# (RFC 7694), so they know they can use zstd.
+ACCEPTED_ENCODINGS = 'zstd, gzip'
+
+# Responses smaller than this aren't worth compressing.
+ZSTD_MIN_SIZE = 1024
+
+# Limit of decoded zstd request bodies, like MAX_CONTENT_LENGTH for the others:
+# a small request could otherwise expand to gigabytes.
+ZSTD_MAX_SIZE = 100 * 1024 * 1024
+ZSTD_READ_SIZE = 64 * 1024
+
+class _ZstdInput(object):
+    """
+    Decodes a zstd'ed request body as it's read, up to ZSTD_MAX_SIZE bytes.
+    """
+    def __init__(self, reader):
+        self._reader = reader
+        self._size = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(ZSTD_READ_SIZE), b''))
+        try:
+            data = self._reader.read(size)
+        except zstandard.ZstdError as ex:
+            raise BadRequest("Failed to decode input: %s" % ex)
+        self._size += len(data)
+        if self._size > ZSTD_MAX_SIZE:
+            raise RequestEntityTooLarge()
+        return data
+
+    def readline(self, size=-1):
+        # Only used for form data, which isn't sent zstd'ed; JSON bodies are read whole.
+        return self.read(size)
+
 
 class RequestEncodingMiddleware(object):
     def __init__(self, app):
@@ -16,19 +55,68 @@ class RequestEncodingMiddleware(object):
 
     def __call__(self, environ, start_response):
         encoding = environ.pop('HTTP_CONTENT_ENCODING', 'identity')
+        zstd_reader = None
         if encoding == 'gzip':
             environ['wsgi.input'] = gzip.GzipFile(fileobj=get_input_stream(environ), mode='rb')
             # Content length is no longer correct after unzipping.
             environ.pop('CONTENT_LENGTH', None)
             # HACK: Force werkzeug to read the stream without the content length.
             environ['wsgi.input_terminated'] = True
+        elif encoding == 'zstd':
+            zstd_reader = zstandard.ZstdDecompressor().stream_reader(get_input_stream(environ))
+            environ['wsgi.input'] = _ZstdInput(zstd_reader)
+            environ.pop('CONTENT_LENGTH', None)
+            environ['wsgi.input_terminated'] = True
         elif encoding != 'identity':
             error = "Unsupported content encoding: %r" % encoding
             return BadRequest(error)(environ, start_response)
 
+        def _start_response(status, headers, exc_info=None):
+            headers.append(('Accept-Encoding', ACCEPTED_ENCODINGS))
+            return start_response(status, headers, exc_info)
+
         try:
-            return self.app(environ, start_response)
-        except (OSError, zlib.error) as ex:
+            if zstd_reader is not None:
+                with zstd_reader:
+                    return self.app(environ, _start_response)
+            return self.app(environ, _start_response)
+        except (OSError, zlib.error, zstandard.ZstdError) as ex:
             # gzip raises OSError on invalid input... blah.
             error = "Failed to decode input: %s" % ex
             return BadRequest(error)(environ, start_response)
+
+def _zstd_chunks(chunks):
+    compressor = zstandard.ZstdCompressor().compressobj()
+    for chunk in chunks:
+        output = compressor.compress(chunk)
+        if output:
+            yield output
+    yield compressor.flush()
+
+def accepts_zstd():
+    """
+    Returns whether the client accepts zstd'ed data; only if it asks for it explicitly, not for `*`.
+    """
+    return any(value == 'zstd' and quality > 0 for value, quality in request.accept_encodings)
+
+def encode_response(response):
+    """
+    Compresses large responses (e.g., package manifests) with zstd if the client accepts it.
+    Other clients get gzip from the web server, which leaves encoded responses alone.
+    """
+    if not accepts_zstd() or response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+
+    if response.is_streamed:
+        # Compress the chunks as they're generated, so the response keeps streaming.
+        response.response = _zstd_chunks(response.iter_encoded())
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < ZSTD_MIN_SIZE:
+            return response
+        response.set_data(zstandard.ZstdCompressor().compress(data))
+
+    response.headers['Content-Encoding'] = 'zstd'
+    response.vary.add('Accept-Encoding')
+    return response
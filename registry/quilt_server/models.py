@@ -91,6 +91,10 @@ class S3Blob(db.Model):
     hash = db.Column(db.String(64), nullable=False)
     size = db.Column(db.BigInteger)
 
+    # 'gzip': the object is gzip'ed (or stored as is, if it doesn't compress well).
+    # 'zstd': there's also a zstd'ed copy, with a `.zst` key, for clients that accept it.
+    encoding = db.Column(db.String(16), nullable=False, server_default='gzip')
+
     # Preview of the content - only used for the READMEs.
     preview = deferred(db.Column(db.TEXT))
 
@@ -15,6 +15,12 @@ PACKAGE_SCHEMA = {
         'dry_run': {
             'type': 'boolean'
         },
+        'skip_existing': {  # Only used for dry runs.
+            'type': 'boolean'
+        },
+        'verify_existing': {  # Only used for dry runs.
+            'type': 'boolean'
+        },
         'is_public': {
             'type': 'boolean'
         },
@@ -109,6 +115,12 @@ PACKAGE_SCHEMA = {
             'additionalProperties': {
                 'type': 'integer'
             }
+        },
+        'encodings': {
+            'type': 'object',
+            'additionalProperties': {
+                'enum': ['gzip', 'zstd']
+            }
         }
     },
     'required': ['description', 'contents'],
@@ -165,3 +177,52 @@ GET_OBJECTS_SCHEMA = {
         'pattern': SHA256_PATTERN
     }
 }
+
+# S3 limit on the number of parts in a multipart upload.
+MAX_MULTIPART_PARTS = 10000
+
+MULTIPART_UPLOAD_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'parts': {
+            'type': 'integer',
+            'minimum': 1,
+            'maximum': MAX_MULTIPART_PARTS
+        },
+        'upload_id': {
+            'type': 'string'
+        },
+        'compressed': {
+            'type': 'boolean'
+        }
+    },
+    'required': ['parts'],
+    'additionalProperties': False
+}
+
+COMPLETE_MULTIPART_UPLOAD_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'parts': {
+            'type': 'array',
+            'minItems': 1,
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'part_number': {
+                        'type': 'integer',
+                        'minimum': 1,
+                        'maximum': MAX_MULTIPART_PARTS
+                    },
+                    'etag': {
+                        'type': 'string'
+                    }
+                },
+                'required': ['part_number', 'etag'],
+                'additionalProperties': False
+            }
+        }
+    },
+    'required': ['parts'],
+    'additionalProperties': False
+}
@@ -15,6 +15,7 @@ from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 from functools import wraps
 import gzip
+from io import BytesIO
 import json
 import pathlib
 import time
@@ -39,11 +40,13 @@ import stripe
 from . import app, db
 from .analytics import MIXPANEL_EVENT, mp
 from .const import FTS_LANGUAGE, PaymentPlan, PUBLIC, TEAM, VALID_NAME_RE, VALID_EMAIL_RE
-from .core import (decode_node, find_object_hashes, hash_contents,
+from .core import (decode_node, find_object_hashes, find_matching_object_hashes, hash_contents,
                    FileNode, GroupNode, RootNode, TableNode, LATEST_TAG, README)
+from .middleware import accepts_zstd
 from .models import (Access, Customer, Event, Instance, InstanceBlobAssoc, Invitation, Log, Package,
                      S3Blob, Tag, Version)
-from .schemas import GET_OBJECTS_SCHEMA, LOG_SCHEMA, PACKAGE_SCHEMA, USERNAME_EMAIL_SCHEMA, USERNAME_SCHEMA
+from .schemas import (COMPLETE_MULTIPART_UPLOAD_SCHEMA, GET_OBJECTS_SCHEMA, LOG_SCHEMA, MULTIPART_UPLOAD_SCHEMA,
+                      PACKAGE_SCHEMA, USERNAME_EMAIL_SCHEMA, USERNAME_SCHEMA)
 from .search import keywords_tsvector, tsvector_concat
 
 QUILT_CDN = 'https://cdn.quiltdata.com/'
@@ -78,12 +81,18 @@ ALLOW_TEAM_ACCESS = app.config['ALLOW_TEAM_ACCESS']
 
 ENABLE_USER_ENDPOINTS = app.config['ENABLE_USER_ENDPOINTS']
 
+ZSTD_FRAGMENTS = app.config['ZSTD_FRAGMENTS']
+
 S3_HEAD_OBJECT = 'head_object'
 S3_GET_OBJECT = 'get_object'
 S3_PUT_OBJECT = 'put_object'
+S3_UPLOAD_PART = 'upload_part'
 
 OBJ_DIR = 'objs'
 
+# Suffix of the zstd'ed copies of objects (see `S3Blob.encoding`).
+ZSTD_SUFFIX = '.zst'
+
 # Limit the JSON metadata to 100MB.
 # This is mostly a sanity check; it's already limited by app.config['MAX_CONTENT_LENGTH'].
 MAX_METADATA_SIZE = 100 * 1024 * 1024
@@ -92,6 +101,7 @@ PREVIEW_MAX_CHILDREN = 10
 PREVIEW_MAX_DEPTH = 4
 
 MAX_PREVIEW_SIZE = 640 * 1024  # 640KB ought to be enough for anybody...
+GZIP_MAGIC = b'\x1f\x8b'
 
 s3_client = boto3.client(
     's3',
@@ -459,12 +469,13 @@ def _mp_track(**kwargs):
 
     mp.track(distinct_id, MIXPANEL_EVENT, all_args)
 
-def _generate_presigned_url(method, owner, blob_hash):
+def _generate_presigned_url(method, owner, blob_hash, encoding='gzip'):
+    suffix = ZSTD_SUFFIX if encoding == 'zstd' else ''
     return s3_client.generate_presigned_url(
         method,
         Params=dict(
             Bucket=PACKAGE_BUCKET_NAME,
-            Key='%s/%s/%s' % (OBJ_DIR, owner, blob_hash)
+            Key='%s/%s/%s%s' % (OBJ_DIR, owner, blob_hash, suffix)
         ),
         ExpiresIn=PACKAGE_URL_EXPIRATION
     )
@@ -547,6 +558,97 @@ def blob_get(owner, blob_hash):
         put=_generate_presigned_url(S3_PUT_OBJECT, owner, blob_hash),
     )
 
+@app.route('/api/blob/<owner>/<blob_hash>/multipart', methods=['POST'])
+@api(schema=MULTIPART_UPLOAD_SCHEMA)
+@as_json
+def blob_multipart_upload(owner, blob_hash):
+    """
+    Starts a multipart upload of a large object - or continues an existing one,
+    if `upload_id` is given - and returns pre-signed URLs for its parts.
+    The object is gzip'ed unless `compressed` is false.
+    """
+    if g.auth.user != owner:
+        raise ApiException(requests.codes.forbidden,
+                           "Only the owner can upload objects.")
+
+    data = request.get_json()
+    key = '%s/%s/%s' % (OBJ_DIR, owner, blob_hash)
+
+    upload_id = data.get('upload_id')
+    if upload_id is None:
+        params = dict(
+            Bucket=PACKAGE_BUCKET_NAME,
+            Key=key
+        )
+        if data.get('compressed', True):
+            params.update(ContentEncoding='gzip')
+        resp = s3_client.create_multipart_upload(**params)
+        upload_id = resp['UploadId']
+
+    urls = [
+        s3_client.generate_presigned_url(
+            S3_UPLOAD_PART,
+            Params=dict(
+                Bucket=PACKAGE_BUCKET_NAME,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number
+            ),
+            ExpiresIn=PACKAGE_URL_EXPIRATION
+        )
+        for part_number in range(1, data['parts'] + 1)
+    ]
+
+    return dict(
+        upload_id=upload_id,
+        urls=urls
+    )
+
+@app.route('/api/blob/<owner>/<blob_hash>/multipart/<upload_id>/complete', methods=['POST'])
+@api(schema=COMPLETE_MULTIPART_UPLOAD_SCHEMA)
+@as_json
+def blob_multipart_complete(owner, blob_hash, upload_id):
+    if g.auth.user != owner:
+        raise ApiException(requests.codes.forbidden,
+                           "Only the owner can upload objects.")
+
+    parts = sorted(request.get_json()['parts'], key=lambda part: part['part_number'])
+
+    try:
+        s3_client.complete_multipart_upload(
+            Bucket=PACKAGE_BUCKET_NAME,
+            Key='%s/%s/%s' % (OBJ_DIR, owner, blob_hash),
+            UploadId=upload_id,
+            MultipartUpload=dict(
+                Parts=[dict(PartNumber=part['part_number'], ETag=part['etag']) for part in parts]
+            )
+        )
+    except ClientError as ex:
+        raise ApiException(requests.codes.bad_request,
+                           "Failed to complete the upload: %s" % ex.response['Error']['Message'])
+
+    return dict()
+
+@app.route('/api/blob/<owner>/<blob_hash>/multipart/<upload_id>', methods=['DELETE'])
+@api()
+@as_json
+def blob_multipart_abort(owner, blob_hash, upload_id):
+    if g.auth.user != owner:
+        raise ApiException(requests.codes.forbidden,
+                           "Only the owner can upload objects.")
+
+    try:
+        s3_client.abort_multipart_upload(
+            Bucket=PACKAGE_BUCKET_NAME,
+            Key='%s/%s/%s' % (OBJ_DIR, owner, blob_hash),
+            UploadId=upload_id
+        )
+    except ClientError as ex:
+        raise ApiException(requests.codes.bad_request,
+                           "Failed to abort the upload: %s" % ex.response['Error']['Message'])
+
+    return dict()
+
 @app.route('/api/get_objects', methods=['POST'])
 @api(require_login=False, schema=GET_OBJECTS_SCHEMA)
 @as_json
@@ -562,9 +664,13 @@ def get_objects():
         .filter(_access_filter(g.auth))
     ).all()
 
+    # The zstd'ed copies are only for clients that can decode them.
+    zstd = accepts_zstd()
+
     return dict(
         urls={
-            blob.hash: _generate_presigned_url(S3_GET_OBJECT, blob.owner, blob.hash)
+            blob.hash: _generate_presigned_url(S3_GET_OBJECT, blob.owner, blob.hash,
+                                               blob.encoding if zstd else 'gzip')
             for blob in results
         },
         sizes={
@@ -579,9 +685,13 @@ def download_object_preview_impl(owner, obj_hash):
         Range='bytes=-%d' % MAX_PREVIEW_SIZE  # Limit the size of the gzip'ed content.
     )
 
-    body = resp['Body']
-    with gzip.GzipFile(fileobj=body, mode='rb') as fd:
-        data = fd.read(MAX_PREVIEW_SIZE)
+    # Objects that don't compress well are stored as is.
+    body = resp['Body'].read()
+    if body[:2] == GZIP_MAGIC:
+        with gzip.GzipFile(fileobj=BytesIO(body), mode='rb') as fd:
+            data = fd.read(MAX_PREVIEW_SIZE)
+    else:
+        data = body[:MAX_PREVIEW_SIZE]
 
     return data.decode(errors='ignore')  # Data may be truncated in the middle of a UTF-8 character.
 
@@ -633,10 +743,13 @@ def package_put(owner, package_name, package_hash):
     # TODO: Description.
     data = json.loads(request.data.decode('utf-8'), object_hook=decode_node)
     dry_run = data.get('dry_run', False)
+    skip_existing = data.get('skip_existing', False)
+    verify_existing = data.get('verify_existing', False)
     public = data.get('is_public', data.get('public', False))
     team = data.get('is_team', False)
     contents = data['contents']
     sizes = data.get('sizes', {})
+    encodings = data.get('encodings', {})
 
     if public and not ALLOW_ANONYMOUS_ACCESS:
         raise ApiException(requests.codes.forbidden, "Public access not allowed")
@@ -651,6 +764,8 @@ def package_put(owner, package_name, package_hash):
     # Old clients don't send sizes. But if sizes are present, make sure they match the hashes.
     if sizes and set(sizes) != all_hashes:
         raise ApiException(requests.codes.bad_request, "Sizes don't match the hashes")
+    if not set(encodings) <= all_hashes:
+        raise ApiException(requests.codes.bad_request, "Encodings don't match the hashes")
 
     # Insert a package if it doesn't already exist.
     # TODO: Separate endpoint for just creating a package with no versions?
@@ -746,18 +861,54 @@ def package_put(owner, package_name, package_hash):
 
     # No more error checking at this point, so return from dry-run early.
     if dry_run:
+        # With `skip_existing`, mark the blobs that have already been uploaded - by any push
+        # from this owner - so the client doesn't need to check each of them in S3.
+        existing_sizes = {}
+        if skip_existing:
+            existing_sizes = dict(
+                db.session.query(S3Blob.hash, S3Blob.size)
+                .filter(S3Blob.owner == owner)
+                .filter(S3Blob.hash.in_(all_hashes))
+            )
+
         db.session.rollback()
 
+        def _exists(blob_hash):
+            if blob_hash not in existing_sizes:
+                return False
+            size = existing_sizes[blob_hash]
+            if size is not None and sizes and sizes[blob_hash] != size:
+                return False
+            if verify_existing:
+                # Don't trust the database; check the object itself.
+                try:
+                    s3_client.head_object(
+                        Bucket=PACKAGE_BUCKET_NAME,
+                        Key='%s/%s/%s' % (OBJ_DIR, owner, blob_hash)
+                    )
+                except ClientError:
+                    return False
+            return True
+
+        # Clients that can read zstd'ed objects upload a zstd'ed copy of each one, too,
+        # and list them in `encodings` when they push the package.
+        zstd_put = ZSTD_FRAGMENTS and accepts_zstd()
+
         # List of signed URLs is potentially huge, so stream it.
 
         def _generate():
             yield '{"upload_urls":{'
             for idx, blob_hash in enumerate(all_hashes):
                 comma = ('' if idx == 0 else ',')
-                value = dict(
-                    head=_generate_presigned_url(S3_HEAD_OBJECT, owner, blob_hash),
-                    put=_generate_presigned_url(S3_PUT_OBJECT, owner, blob_hash)
-                )
+                if _exists(blob_hash):
+                    value = dict(exists=True)
+                else:
+                    value = dict(
+                        head=_generate_presigned_url(S3_HEAD_OBJECT, owner, blob_hash),
+                        put=_generate_presigned_url(S3_PUT_OBJECT, owner, blob_hash)
+                    )
+                    if zstd_put:
+                        value['zstd_put'] = _generate_presigned_url(S3_PUT_OBJECT, owner, blob_hash, 'zstd')
                 yield '%s%s:%s' % (comma, json.dumps(blob_hash), json.dumps(value))
             yield '}}'
 
@@ -817,6 +968,8 @@ def package_put(owner, package_name, package_hash):
             blob = blob_by_hash.get(blob_hash)
             if blob is None:
                 blob = S3Blob(owner=owner, hash=blob_hash, size=blob_size)
+            if encodings.get(blob_hash) == 'zstd':
+                blob.encoding = 'zstd'
             if blob_hash == readme_hash:
                 if readme_preview is not None:
                     # If we've just downloaded the README, save it in the blob.
@@ -838,6 +991,17 @@ def package_put(owner, package_name, package_hash):
         instance.updated_by = g.auth.user
         instance.keywords_tsv = keywords_tsv
 
+        zstd_hashes = [blob_hash for blob_hash, encoding in encodings.items() if encoding == 'zstd']
+        if zstd_hashes:
+            (
+                S3Blob.query
+                .filter(sa.and_(
+                    S3Blob.owner == owner,
+                    S3Blob.hash.in_(zstd_hashes)
+                ))
+                .update(dict(encoding='zstd'), synchronize_session=False)
+            )
+
     db.session.add(instance)
 
     # Insert a log.
@@ -880,6 +1044,8 @@ def package_put(owner, package_name, package_hash):
 def package_get(owner, package_name, package_hash):
     subpath = request.args.get('subpath')
     meta_only = bool(request.args.get('meta_only', ''))
+    include = request.args.getlist('include')
+    exclude = request.args.getlist('exclude')
 
     instance = _get_instance(g.auth, owner, package_name, package_hash)
 
@@ -892,7 +1058,13 @@ def package_get(owner, package_name, package_hash):
         except (AttributeError, KeyError):
             raise ApiException(requests.codes.not_found, "Invalid subpath: %r" % component)
 
-    all_hashes = set() if meta_only else set(find_object_hashes(subnode))
+    if meta_only:
+        all_hashes = set()
+    else:
+        all_hashes = set(find_object_hashes(subnode))
+        if include or exclude:
+            # Patterns are relative to the package root, even with a subpath.
+            all_hashes &= set(find_matching_object_hashes(instance.contents, include, exclude))
 
     blobs = (
         S3Blob.query
@@ -905,8 +1077,12 @@ def package_get(owner, package_name, package_hash):
         .all()
     ) if all_hashes else []
 
+    # The zstd'ed copies are only for clients that can decode them.
+    encodings = {blob.hash: blob.encoding for blob in blobs} if accepts_zstd() else {}
+
     urls = {
-        blob_hash: _generate_presigned_url(S3_GET_OBJECT, owner, blob_hash)
+        blob_hash: _generate_presigned_url(S3_GET_OBJECT, owner, blob_hash,
+                                           encodings.get(blob_hash, 'gzip'))
         for blob_hash in all_hashes
     }
 
@@ -918,7 +1094,9 @@ def package_get(owner, package_name, package_hash):
         package_name=package_name,
         package_hash=package_hash,
         extra=dict(
-            subpath=subpath
+            subpath=subpath,
+            include=include,
+            exclude=exclude,
         )
     )
     db.session.add(event)
@@ -930,6 +1108,8 @@ def package_get(owner, package_name, package_hash):
         package_owner=owner,
         package_name=package_name,
         subpath=subpath,
+        include=include,
+        exclude=exclude,
     )
 
     return dict(
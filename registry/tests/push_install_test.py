@@ -9,6 +9,7 @@ from unittest.mock import patch
 import urllib
 
 import requests
+import zstandard
 
 from quilt_server import app, db
 from quilt_server.const import PaymentPlan
@@ -235,6 +236,175 @@ class PushInstallTestCase(QuiltTestCase):
         assert not data['sizes']
         assert not data['urls']
 
+    @patch('quilt_server.middleware.ZSTD_MIN_SIZE', 0)
+    def testZstdEncoding(self):
+        # Requests can be zstd'ed, and the registry says so.
+        data = json.dumps(dict(
+            is_public=True,
+            description="",
+            contents=self.CONTENTS
+        ), default=encode_node).encode('utf8')
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            data=zstandard.ZstdCompressor().compress(data),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user',
+                'Content-Encoding': 'zstd'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        assert 'zstd' in resp.headers['Accept-Encoding']
+
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            data=b'garbage',
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user',
+                'Content-Encoding': 'zstd'
+            }
+        )
+        assert resp.status_code == requests.codes.bad_request
+
+        # Decoding stops at the size limit, however small the request is.
+        with patch('quilt_server.middleware.ZSTD_MAX_SIZE', len(data) - 1):
+            resp = self.app.put(
+                '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+                data=zstandard.ZstdCompressor().compress(data),
+                content_type='application/json',
+                headers={
+                    'Authorization': 'test_user',
+                    'Content-Encoding': 'zstd'
+                }
+            )
+        assert resp.status_code == requests.codes.request_entity_too_large
+
+        # Responses are only zstd'ed if the client asks for it.
+        resp = self.app.get(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        assert 'Content-Encoding' not in resp.headers
+        expected = json.loads(resp.data.decode('utf8'), object_hook=decode_node)['contents']
+
+        resp = self.app.get(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            headers={
+                'Authorization': 'test_user',
+                'Accept-Encoding': 'gzip, zstd'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        assert resp.headers['Content-Encoding'] == 'zstd'
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(resp.data)
+        assert json.loads(data.decode('utf8'), object_hook=decode_node)['contents'] == expected
+
+    def testZstdDryRun(self):
+        # The streamed list of upload URLs is compressed as it's generated.
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            data=json.dumps(dict(
+                dry_run=True,
+                is_public=True,
+                description="",
+                contents=self.CONTENTS
+            ), default=encode_node),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user',
+                'Accept-Encoding': 'zstd'
+            },
+            buffered=False
+        )
+        assert resp.status_code == requests.codes.ok
+        assert resp.is_streamed
+        assert resp.headers['Content-Encoding'] == 'zstd'
+        assert 'Content-Length' not in resp.headers
+
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(b''.join(resp.response))
+        urls = json.loads(data.decode('utf8'))['upload_urls']
+        assert set(urls) == {self.HASH1, self.HASH2, self.HASH3}
+
+    @patch('quilt_server.views.ZSTD_FRAGMENTS', True)
+    def testZstdFragments(self):
+        def _put(accept_encoding, **kwargs):
+            resp = self.app.put(
+                '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+                data=json.dumps(dict(
+                    is_public=True,
+                    description="",
+                    contents=self.CONTENTS,
+                    **kwargs
+                ), default=encode_node),
+                content_type='application/json',
+                headers={
+                    'Authorization': 'test_user',
+                    'Accept-Encoding': accept_encoding
+                }
+            )
+            data = resp.data
+            if resp.headers.get('Content-Encoding') == 'zstd':
+                data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+            return resp, json.loads(data.decode('utf8'))
+
+        def _paths(urls):
+            return {
+                obj_hash: urllib.parse.urlparse(url).path.split('/')[-1]
+                for obj_hash, url in urls.items()
+            }
+
+        # Only clients that can read zstd get URLs for the zstd'ed copies.
+        resp, data = _put('gzip', dry_run=True)
+        assert resp.status_code == requests.codes.ok
+        assert all('zstd_put' not in urls for urls in data['upload_urls'].values())
+
+        resp, data = _put('gzip, zstd', dry_run=True)
+        assert resp.status_code == requests.codes.ok
+        assert _paths({obj_hash: urls['zstd_put'] for obj_hash, urls in data['upload_urls'].items()}) == {
+            obj_hash: obj_hash + '.zst' for obj_hash in (self.HASH1, self.HASH2, self.HASH3)
+        }
+
+        resp, data = _put('gzip, zstd', encodings={'0' * 64: 'zstd'})
+        assert resp.status_code == requests.codes.bad_request
+
+        resp, data = _put('gzip, zstd', encodings={self.HASH1: 'zstd', self.HASH2: 'gzip'})
+        assert resp.status_code == requests.codes.ok
+        assert S3Blob.query.filter_by(hash=self.HASH1).one().encoding == 'zstd'
+        assert S3Blob.query.filter_by(hash=self.HASH2).one().encoding == 'gzip'
+
+        # Installs get the zstd'ed copies only if they accept zstd.
+        for accept_encoding, expected in [('gzip', self.HASH1), ('gzip, zstd', self.HASH1 + '.zst')]:
+            resp = self.app.get(
+                '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+                headers={
+                    'Authorization': 'test_user',
+                    'Accept-Encoding': accept_encoding
+                }
+            )
+            assert resp.status_code == requests.codes.ok
+            data = resp.data
+            if resp.headers.get('Content-Encoding') == 'zstd':
+                data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+            paths = _paths(json.loads(data.decode('utf8'))['urls'])
+            assert paths == {self.HASH1: expected, self.HASH2: self.HASH2, self.HASH3: self.HASH3}
+
+            resp = self.app.post(
+                '/api/get_objects',
+                data=json.dumps([self.HASH1, self.HASH2]),
+                content_type='application/json',
+                headers={
+                    'Authorization': 'test_user',
+                    'Accept-Encoding': accept_encoding
+                }
+            )
+            assert resp.status_code == requests.codes.ok
+            paths = _paths(json.loads(resp.data.decode('utf8'))['urls'])
+            assert paths == {self.HASH1: expected, self.HASH2: self.HASH2}
+
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
     def testPushNewMetadata(self):
         # Push the original contents.
@@ -474,6 +644,117 @@ class PushInstallTestCase(QuiltTestCase):
         )
         assert resp.status_code == requests.codes.forbidden
 
+    def testMultipartUpload(self):
+        bucket = app.config['PACKAGE_BUCKET_NAME']
+        key = 'objs/test_user/%s' % self.HASH1
+
+        self.s3_stubber.add_response('create_multipart_upload', dict(
+            UploadId='upload1'
+        ), dict(
+            Bucket=bucket,
+            Key=key,
+            ContentEncoding='gzip'
+        ))
+
+        resp = self.app.post(
+            '/api/blob/test_user/%s/multipart' % self.HASH1,
+            data=json.dumps(dict(parts=3)),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        data = json.loads(resp.data.decode('utf8'))
+        assert data['upload_id'] == 'upload1'
+        assert len(data['urls']) == 3
+
+        for part_number, part_url in enumerate(data['urls'], 1):
+            url = urllib.parse.urlparse(part_url)
+            assert url.path == '/%s/%s' % (bucket, key)
+            query = urllib.parse.parse_qs(url.query)
+            assert query['uploadId'] == ['upload1']
+            assert query['partNumber'] == [str(part_number)]
+
+        # Continuing an existing upload only signs the URLs.
+        resp = self.app.post(
+            '/api/blob/test_user/%s/multipart' % self.HASH1,
+            data=json.dumps(dict(parts=2, upload_id='upload1')),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        data = json.loads(resp.data.decode('utf8'))
+        assert data['upload_id'] == 'upload1'
+        assert len(data['urls']) == 2
+
+        self.s3_stubber.add_response('complete_multipart_upload', dict(), dict(
+            Bucket=bucket,
+            Key=key,
+            UploadId='upload1',
+            MultipartUpload=dict(Parts=[
+                dict(PartNumber=1, ETag='"etag1"'),
+                dict(PartNumber=2, ETag='"etag2"'),
+            ])
+        ))
+
+        resp = self.app.post(
+            '/api/blob/test_user/%s/multipart/upload1/complete' % self.HASH1,
+            data=json.dumps(dict(parts=[
+                dict(part_number=2, etag='"etag2"'),
+                dict(part_number=1, etag='"etag1"'),
+            ])),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        self.s3_stubber.assert_no_pending_responses()
+
+        # Objects that don't compress well are uploaded as is.
+        self.s3_stubber.add_response('create_multipart_upload', dict(
+            UploadId='upload2'
+        ), dict(
+            Bucket=bucket,
+            Key=key
+        ))
+
+        resp = self.app.post(
+            '/api/blob/test_user/%s/multipart' % self.HASH1,
+            data=json.dumps(dict(parts=1, compressed=False)),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        self.s3_stubber.assert_no_pending_responses()
+
+        # Only the owner can upload.
+        resp = self.app.post(
+            '/api/blob/test_user/%s/multipart' % self.HASH1,
+            data=json.dumps(dict(parts=1)),
+            content_type='application/json',
+            headers={
+                'Authorization': 'bad_user'
+            }
+        )
+        assert resp.status_code == requests.codes.forbidden
+
+        # S3 doesn't allow more than 10000 parts.
+        resp = self.app.post(
+            '/api/blob/test_user/%s/multipart' % self.HASH1,
+            data=json.dumps(dict(parts=10001)),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.bad_request
+
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
     @mock_customer(plan=PaymentPlan.INDIVIDUAL)
     def testCreatePublic(self, customer):
@@ -616,6 +897,78 @@ class PushInstallTestCase(QuiltTestCase):
         )
         assert resp.status_code == requests.codes.bad_request
 
+    def testDryRunSkipExisting(self):
+        sizes = {self.HASH1: 1, self.HASH2: 2, self.HASH3: 3}
+
+        def _dry_run(**kwargs):
+            resp = self.app.put(
+                '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+                data=json.dumps(dict(
+                    dry_run=True,
+                    skip_existing=True,
+                    is_public=True,
+                    description="",
+                    contents=self.CONTENTS,
+                    **kwargs
+                ), default=encode_node),
+                content_type='application/json',
+                headers={
+                    'Authorization': 'test_user'
+                }
+            )
+            assert resp.status_code == requests.codes.ok
+            return json.loads(resp.data.decode('utf8'))['upload_urls']
+
+        # Nothing has been uploaded yet.
+        urls = _dry_run(sizes=sizes)
+        for obj_hash in (self.HASH1, self.HASH2, self.HASH3):
+            assert set(urls[obj_hash]) == {'head', 'put'}
+
+        # Push it.
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            data=json.dumps(dict(
+                is_public=True,
+                description="",
+                contents=self.CONTENTS,
+                sizes=sizes
+            ), default=encode_node),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+
+        # Now, all the blobs exist.
+        urls = _dry_run(sizes=sizes)
+        for obj_hash in (self.HASH1, self.HASH2, self.HASH3):
+            assert urls[obj_hash] == dict(exists=True)
+
+        # ...unless the sizes don't match.
+        urls = _dry_run(sizes=dict(sizes, **{self.HASH2: 5}))
+        assert urls[self.HASH1] == dict(exists=True)
+        assert set(urls[self.HASH2]) == {'head', 'put'}
+
+        # Check that they're actually in S3. (Mismatched sizes skip the check, so there's
+        # only one S3 request each time.)
+        bucket = app.config['PACKAGE_BUCKET_NAME']
+        self.s3_stubber.add_client_error('head_object', http_status_code=404, expected_params=dict(
+            Bucket=bucket,
+            Key='objs/test_user/%s' % self.HASH3
+        ))
+        urls = _dry_run(sizes=dict(sizes, **{self.HASH1: 5, self.HASH2: 5}), verify_existing=True)
+        assert set(urls[self.HASH3]) == {'head', 'put'}
+
+        self.s3_stubber.add_response('head_object', dict(), dict(
+            Bucket=bucket,
+            Key='objs/test_user/%s' % self.HASH1
+        ))
+        urls = _dry_run(sizes=dict(sizes, **{self.HASH2: 5, self.HASH3: 5}), verify_existing=True)
+        assert urls[self.HASH1] == dict(exists=True)
+
+        self.s3_stubber.assert_no_pending_responses()
+
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
     def testInstallSubpath(self):
         """
@@ -698,6 +1051,52 @@ class PushInstallTestCase(QuiltTestCase):
         )
         assert resp.status_code == requests.codes.not_found
 
+    @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
+    def testInstallIncludeExclude(self):
+        """
+        Push a package, then install the nodes matching some patterns.
+        """
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % self.CONTENTS_HASH,
+            data=json.dumps(dict(
+                is_public=True,
+                description="",
+                contents=self.CONTENTS,
+                sizes={self.HASH1: 1, self.HASH2: 2, self.HASH3: 3}
+            ), default=encode_node),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+
+        def _install(**params):
+            resp = self.app.get(
+                '/api/package/test_user/foo/%s?%s' % (
+                    self.CONTENTS_HASH,
+                    urllib.parse.urlencode(params, doseq=True),
+                ),
+                headers={
+                    'Authorization': 'test_user'
+                }
+            )
+            assert resp.status_code == requests.codes.ok
+            return json.loads(resp.data.decode('utf8'), object_hook=decode_node)
+
+        # "group1/**" only matches group1/group2/bar.
+        data = _install(include=['fi*', 'group1/**'])
+        assert data['contents'] == self.CONTENTS
+        assert set(data['urls']) == {self.HASH1, self.HASH3}
+
+        # Excluded groups are skipped entirely.
+        data = _install(exclude=['group?', 'file'])
+        assert set(data['urls']) == {self.HASH1, self.HASH2}
+
+        # Patterns are relative to the root, even with a subpath.
+        data = _install(subpath='group1', include=['file'])
+        assert data['urls'] == {}
+
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
     def testPreview(self):
         huge_contents_hash = hash_contents(self.HUGE_CONTENTS)
@@ -789,6 +1188,42 @@ class PushInstallTestCase(QuiltTestCase):
         assert ts['frequency'] == 'week'
         assert ts['timeSeries'] == [1]
 
+    @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
+    def testPreviewUncompressed(self):
+        contents = RootNode(dict(
+            README=FileNode(
+                hashes=[self.HASH1]
+            )
+        ))
+        contents_hash = hash_contents(contents)
+
+        readme_contents = 'Hello, World!'
+        self._mock_object('test_user', self.HASH1, readme_contents.encode(), compressed=False)
+
+        resp = self.app.put(
+            '/api/package/test_user/foo/%s' % contents_hash,
+            data=json.dumps(dict(
+                is_public=True,
+                description="",
+                contents=contents
+            ), default=encode_node),
+            content_type='application/json',
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+
+        resp = self.app.get(
+            '/api/package_preview/test_user/foo/%s' % contents_hash,
+            headers={
+                'Authorization': 'test_user'
+            }
+        )
+        assert resp.status_code == requests.codes.ok
+        data = json.loads(resp.data.decode('utf8'), object_hook=decode_node)
+        assert data['readme_preview'] == readme_contents
+
     @patch('quilt_server.views.ALLOW_ANONYMOUS_ACCESS', True)
     def testPreviewStats(self):
         contents_hash = hash_contents(self.CONTENTS_WITH_Q_EXT)
@@ -173,11 +173,11 @@ class QuiltTestCase(TestCase):
             }
         )
 
-    def _mock_object(self, owner, blob_hash, contents):
-        contents_gzipped = gzip.compress(contents)
+    def _mock_object(self, owner, blob_hash, contents, compressed=True):
+        body = gzip.compress(contents) if compressed else contents
 
         self.s3_stubber.add_response('get_object', dict(
-            Body=BytesIO(contents_gzipped)
+            Body=BytesIO(body)
         ), dict(
             Bucket=quilt_server.app.config['PACKAGE_BUCKET_NAME'],
             Key='objs/%s/%s' % (owner, blob_hash),